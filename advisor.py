@@ -4,14 +4,21 @@
 from __future__ import annotations
 
 import os
+import json
 import uuid
-from typing import Any, Dict, List, Optional
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional
 from pathlib import Path
 from urllib.parse import quote as urlquote
 
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from answer_cache import SemanticAnswerCache, context_digest
+from executors import run_blocking
+from sessions import SessionStore
+
 # =========================
 # Config por ENV
 # =========================
@@ -22,6 +29,19 @@ STRICT_CONTEXT = os.getenv("STRICT_CONTEXT", "0").strip().lower() in ("1", "true
 PDFJS_ENABLE = os.getenv("PDFJS_ENABLE", "0").strip().lower() in ("1", "true", "yes")
 PDFJS_VIEWER = os.getenv("PDFJS_VIEWER", "/static/pdfjs/web/viewer.html")  # si copias PDF.js en /static/pdfjs
 
+# Sesiones: memoria acotada (LRU + TTL) con respaldo en SQLite
+SESSIONS_DB = os.getenv("ADVISOR_SESSIONS_DB", "./data/advisor_sessions.db")
+SESSIONS_MAX = int(os.getenv("ADVISOR_SESSIONS_MAX", "1000"))
+SESSIONS_MAX_BYTES = int(os.getenv("ADVISOR_SESSIONS_MAX_BYTES", str(32 * 1024 * 1024)))
+SESSION_TTL_SECONDS = int(os.getenv("ADVISOR_SESSION_TTL", str(6 * 3600)))
+
+# Caché semántica de respuestas (se vacía sola si cambia el índice en PERSIST_DIR)
+ANSWER_CACHE_ENABLE = os.getenv("ANSWER_CACHE", "1").strip().lower() in ("1", "true", "yes")
+ANSWER_CACHE_DB = os.getenv("ANSWER_CACHE_DB", "./data/advisor_cache.db")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX = int(os.getenv("ANSWER_CACHE_MAX", "2000"))
+ANSWER_CACHE_INDEX_CHECK = float(os.getenv("ANSWER_CACHE_INDEX_CHECK", "30"))  # s entre comprobaciones del índice
+
 # =========================
 # Modelos Pydantic
 # =========================
@@ -50,11 +70,25 @@ class ChatResp(BaseModel):
     answer: str
     session_id: str
     sources: List[Citation]
+    cached: bool = False
 
 # =========================
-# Estado simple en memoria
+# Estado de sesiones (memoria acotada + SQLite)
 # =========================
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+SESSIONS = SessionStore(
+    SESSIONS_DB,
+    max_sessions=SESSIONS_MAX,
+    max_bytes=SESSIONS_MAX_BYTES,
+    ttl_seconds=SESSION_TTL_SECONDS,
+)
+
+ANSWER_CACHE: Optional[SemanticAnswerCache] = SemanticAnswerCache(
+    ANSWER_CACHE_DB,
+    persist_dir=os.getenv("PERSIST_DIR", "./chroma"),
+    threshold=ANSWER_CACHE_THRESHOLD,
+    max_entries=ANSWER_CACHE_MAX,
+    index_check_every=ANSWER_CACHE_INDEX_CHECK,
+) if ANSWER_CACHE_ENABLE else None
 
 # =========================
 # Helpers
@@ -100,6 +134,32 @@ def _llm_invoke(llm: Any, prompt: str) -> str:
         return (llm(prompt) or "").strip()
     raise RuntimeError("LLM no compatible (invoke/predict/callable).")
 
+async def _allm_invoke(llm: Any, prompt: str) -> str:
+    """Versión async de _llm_invoke: usa .ainvoke y, si no existe, corre la sync en un hilo."""
+    if hasattr(llm, "ainvoke"):
+        out = await llm.ainvoke(prompt)
+        content = getattr(out, "content", None)
+        if isinstance(content, str) and content.strip():
+            return content.strip()
+        if isinstance(out, str):
+            return out.strip()
+        return str(out).strip()
+    return await asyncio.to_thread(_llm_invoke, llm, prompt)
+
+async def _allm_stream(llm: Any, prompt: str) -> AsyncIterator[str]:
+    """Itera los fragmentos de texto del LLM a medida que llegan (fallback: respuesta completa)."""
+    if hasattr(llm, "astream"):
+        async for chunk in llm.astream(prompt):
+            piece = getattr(chunk, "content", chunk)
+            if isinstance(piece, str) and piece:
+                yield piece
+        return
+    yield await _allm_invoke(llm, prompt)
+
+def _sse(event: str, data: Any) -> str:
+    """Serializa un frame Server-Sent Events (data en JSON, una sola línea)."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 def _crop(txt: str, n: int = 240) -> str:
     if not txt:
         return ""
@@ -141,6 +201,22 @@ def _build_source_url(source: str, page: Optional[int], snippet: str) -> str:
         return f"{path}#page={int(page)}"
     return path
 
+NO_CONTEXT_ANSWER = (
+    "No encontré base en el índice para responder con respaldo documental. "
+    "Carga o indexa la norma o sentencia pertinente y vuelve a preguntar.\n\n"
+    "Fuentes:\n- (sin fuentes en el índice)\n\n"
+    f"{DISCLAIMER}"
+)
+
+def _sources_text(citations: List[Citation]) -> str:
+    return "\n".join(
+        f"- {c.source}" + (f" (p. {c.page})" if c.page is not None else "") + (f" — `{c.chunk_id}`" if c.chunk_id else "")
+        for c in citations
+    ) or "- (sin fuentes en el índice)"
+
+def _compose_answer(raw_answer: str, citations: List[Citation]) -> str:
+    return f"{raw_answer}\n\nFuentes:\n{_sources_text(citations)}\n\n{DISCLAIMER}".strip()
+
 # =========================
 # Core (fábrica de routers)
 # =========================
@@ -156,61 +232,53 @@ def _build_router(
     router = APIRouter(prefix=prefix, tags=["advisor"] if prefix else None)
 
     @router.post("/start", response_model=StartResp)
-    def start(req: StartReq = StartReq()) -> StartResp:
+    async def start(req: StartReq = StartReq()) -> StartResp:
         sid = str(uuid.uuid4())
         system_msg = req.system_hint or "Actúa como asesor en acciones de tutela (Colombia)."
-        SESSIONS[sid] = {"messages": [{"role": "system", "content": system_msg}]}
+        await run_blocking(SESSIONS.put, sid, {"messages": [{"role": "system", "content": system_msg}]})
         return StartResp(session_id=sid, message="¡Hola! Soy tu asesor en acciones de tutela (Colombia). ¿Qué te preocupa?")
 
-    @router.post("/answer", response_model=ChatResp)
-    def answer(req: ChatReq) -> ChatResp:
-        sid = (req.session_id or "").strip()
-        if not sid or sid not in SESSIONS:
+    async def _session(session_id: str) -> Dict[str, Any]:
+        sess = await run_blocking(SESSIONS.get, (session_id or "").strip())
+        if sess is None:
             raise HTTPException(status_code=400, detail="session_id inválido o inexistente.")
+        sess.setdefault("messages", [])
+        return sess
 
-        top_k = req.top_k if req.top_k and req.top_k > 0 else top_k_default
-        _ = req.max_tokens or max_tokens_default  # reservado para LLMs que lo soporten
+    async def _save_turn(sid: str, sess: Dict[str, Any], question: str, answer_text: str) -> None:
+        turn = [{"role": "user", "content": question}, {"role": "assistant", "content": answer_text}]
+        sess["messages"].extend(turn)
 
-        sess = SESSIONS[sid]
-        messages: List[Dict[str, str]] = sess.setdefault("messages", [])
+        # Escritura condicionada a la revisión leída: si otro worker respondió en paralelo
+        # se reaplica el turno sobre su historial en vez de pisarlo.
+        def _append(data: Dict[str, Any]) -> None:
+            data.setdefault("messages", []).extend(turn)
 
-        # ===== 1) Recuperación
+        await run_blocking(SESSIONS.update, sid, _append)
+
+    async def _retrieve(query: str) -> List[Any]:
         try:
+            if hasattr(retriever, "ainvoke"):
+                return await retriever.ainvoke(query)
             if hasattr(retriever, "invoke"):
-                docs = retriever.invoke(req.message)
-            elif hasattr(retriever, "get_relevant_documents"):
-                docs = retriever.get_relevant_documents(req.message)
-            else:
-                docs = []
+                return await asyncio.to_thread(retriever.invoke, query)
+            if hasattr(retriever, "get_relevant_documents"):
+                return await asyncio.to_thread(retriever.get_relevant_documents, query)
         except Exception:
-            docs = []
-
-        # ===== 2) Sin contexto (modo estricto)
-        if not docs and STRICT_CONTEXT:
-            answer_text = (
-                "No encontré base en el índice para responder con respaldo documental. "
-                "Carga o indexa la norma o sentencia pertinente y vuelve a preguntar.\n\n"
-                "Fuentes:\n- (sin fuentes en el índice)\n\n"
-                f"{DISCLAIMER}"
-            )
-            messages.append({"role": "user", "content": req.message})
-            messages.append({"role": "assistant", "content": answer_text})
-            return ChatResp(answer=answer_text, session_id=sid, sources=[])
+            pass
+        return []
 
-        # ===== 3) Contexto + historial
-        context = _format_docs(docs)
-        history_text = _format_history(messages)
-
-        # ===== 4) Prompt y LLM
-        system_hint = next((m.get("content") for m in messages if m.get("role") == "system"), None)
-        prompt = _build_prompt(req.message, history_text, context, system_hint)
-        raw_answer = _llm_invoke(llm, prompt).strip()
-
-        # ===== 5) Citas (con score si hay vectordb)
+    async def _citations(query: str, docs: List[Any], top_k: int) -> List[Citation]:
+        # Los docs del ScoredMMRRetriever ya traen su score; sólo si ninguno lo trae
+        # (retriever genérico) se hace una segunda búsqueda para adjuntarlo.
         score_by_chunk: Dict[str, float] = {}
-        if vectordb is not None:
+        for d in docs:
+            meta = getattr(d, "metadata", {}) or {}
+            if meta.get("chunk_id") and meta.get("score") is not None:
+                score_by_chunk[meta["chunk_id"]] = float(meta["score"])
+        if not score_by_chunk and docs and vectordb is not None:
             try:
-                scored = vectordb.similarity_search_with_score(req.message, k=top_k)
+                scored = await asyncio.to_thread(vectordb.similarity_search_with_score, query, k=top_k)
                 for d, s in scored:
                     cid = (getattr(d, "metadata", {}) or {}).get("chunk_id")
                     if cid:
@@ -234,25 +302,180 @@ def _build_router(
                     url=_build_source_url(src, pg, snip),
                 )
             )
+        return citations
 
-        # ===== 6) Texto final (Fuentes + disclaimer una sola vez)
-        sources_text = "\n".join(
-            f"- {c.source}" + (f" (p. {c.page})" if c.page is not None else "") + (f" — `{c.chunk_id}`" if c.chunk_id else "")
-            for c in citations
-        ) or "- (sin fuentes en el índice)"
+    def _embed_query(query: str) -> Optional[List[float]]:
+        # ScoredMMRRetriever memoiza el embedding de la búsqueda: aquí no se recalcula.
+        if hasattr(retriever, "embed_query"):
+            return retriever.embed_query(query)
+        emb = getattr(vectordb, "embeddings", None)
+        return emb.embed_query(query) if emb is not None else None
+
+    def _history_key(messages: List[Dict[str, str]]) -> str:
+        # Lo mismo que _prompt_for mete en el prompt además de pregunta y contexto.
+        system_hint = next((m.get("content") for m in messages if m.get("role") == "system"), None)
+        return context_digest(system_hint or "", _format_history(messages))
+
+    async def _cache_lookup(query: str, docs: List[Any], history_key: str):
+        """(embedding, chunk_ids, hit|None). Sin caché o sin embeddings → (None, [], None)."""
+        if ANSWER_CACHE is None:
+            return None, [], None
+        chunk_ids = [(getattr(d, "metadata", {}) or {}).get("chunk_id") for d in docs]
+        try:
+            emb = await asyncio.to_thread(_embed_query, query)
+        except Exception:
+            emb = None
+        if emb is None:
+            return None, [], None
+        hit = await run_blocking(ANSWER_CACHE.lookup, emb, chunk_ids, history_key)
+        return emb, chunk_ids, hit
+
+    async def _cache_store(emb, chunk_ids: List[str], raw_answer: str, citations: List[Citation],
+                           history_key: str) -> None:
+        if ANSWER_CACHE is None or emb is None:
+            return
+        await run_blocking(ANSWER_CACHE.store, emb, chunk_ids, raw_answer, [c.dict() for c in citations], history_key)
+
+    def _prompt_for(messages: List[Dict[str, str]], question: str, docs: List[Any]) -> str:
+        context = _format_docs(docs)
+        history_text = _format_history(messages)
+        system_hint = next((m.get("content") for m in messages if m.get("role") == "system"), None)
+        return _build_prompt(question, history_text, context, system_hint)
+
+    @router.post("/answer", response_model=ChatResp)
+    async def answer(req: ChatReq) -> ChatResp:
+        sid = (req.session_id or "").strip()
+        sess = await _session(sid)
+        messages: List[Dict[str, str]] = sess["messages"]
+        history_key = _history_key(messages)
 
-        final_answer = f"{raw_answer}\n\nFuentes:\n{sources_text}\n\n{DISCLAIMER}".strip()
+        top_k = req.top_k if req.top_k and req.top_k > 0 else top_k_default
+        _ = req.max_tokens or max_tokens_default  # reservado para LLMs que lo soporten
+
+        # ===== 1) Recuperación
+        docs = await _retrieve(req.message)
+
+        # ===== 2) Sin contexto (modo estricto)
+        if not docs and STRICT_CONTEXT:
+            answer_text = NO_CONTEXT_ANSWER
+            await _save_turn(sid, sess, req.message, answer_text)
+            return ChatResp(answer=answer_text, session_id=sid, sources=[])
+
+        # ===== 3) Caché semántica (misma pregunta + mismos chunks → sin LLM)
+        emb, chunk_ids, hit = await _cache_lookup(req.message, docs, history_key)
+        if hit is not None:
+            raw_answer, cached_cites = hit
+            citations = [Citation(**c) for c in cached_cites]
+            final_answer = _compose_answer(raw_answer, citations)
+            await _save_turn(sid, sess, req.message, final_answer)
+            return ChatResp(answer=final_answer, session_id=sid, sources=citations, cached=True)
+
+        # ===== 4) Contexto + historial → prompt y LLM
+        prompt = _prompt_for(messages, req.message, docs)
+        raw_answer = (await _allm_invoke(llm, prompt)).strip()
+
+        # ===== 5) Citas (con score si hay vectordb)
+        citations = await _citations(req.message, docs, top_k)
+        await _cache_store(emb, chunk_ids, raw_answer, citations, history_key)
+
+        # ===== 6) Texto final (Fuentes + disclaimer una sola vez)
+        final_answer = _compose_answer(raw_answer, citations)
 
         # Persistir conversación
-        messages.append({"role": "user", "content": req.message})
-        messages.append({"role": "assistant", "content": final_answer})
+        await _save_turn(sid, sess, req.message, final_answer)
 
         return ChatResp(answer=final_answer, session_id=sid, sources=citations)
 
+    @router.post("/answer/stream")
+    async def answer_stream(req: ChatReq) -> StreamingResponse:
+        """
+        Variante SSE de /answer. Emite, en orden:
+          - event: citations → lista de Citation (antes de llamar al LLM)
+          - event: token     → {"text": "..."} por cada fragmento del LLM
+          - event: done      → {"answer", "sources_text", "disclaimer", "session_id", "cached"}
+          - event: error     → {"detail": "..."} si el LLM falla a mitad de camino
+        El turno se guarda en la sesión al terminar.
+        """
+        sid = (req.session_id or "").strip()
+        sess = await _session(sid)
+        messages: List[Dict[str, str]] = sess["messages"]
+        history_key = _history_key(messages)
+        top_k = req.top_k if req.top_k and req.top_k > 0 else top_k_default
+
+        async def _events() -> AsyncIterator[str]:
+            docs = await _retrieve(req.message)
+
+            if not docs and STRICT_CONTEXT:
+                yield _sse("citations", [])
+                await _save_turn(sid, sess, req.message, NO_CONTEXT_ANSWER)
+                yield _sse("done", {
+                    "answer": NO_CONTEXT_ANSWER,
+                    "sources_text": "- (sin fuentes en el índice)",
+                    "disclaimer": DISCLAIMER,
+                    "session_id": sid,
+                })
+                return
+
+            emb, chunk_ids, hit = await _cache_lookup(req.message, docs, history_key)
+            if hit is not None:
+                raw_answer, cached_cites = hit
+                citations = [Citation(**c) for c in cached_cites]
+                yield _sse("citations", cached_cites)
+                yield _sse("token", {"text": raw_answer})
+                final_answer = _compose_answer(raw_answer, citations)
+                await _save_turn(sid, sess, req.message, final_answer)
+                yield _sse("done", {
+                    "answer": final_answer,
+                    "sources_text": _sources_text(citations),
+                    "disclaimer": DISCLAIMER,
+                    "session_id": sid,
+                    "cached": True,
+                })
+                return
+
+            citations = await _citations(req.message, docs, top_k)
+            yield _sse("citations", [c.dict() for c in citations])
+
+            prompt = _prompt_for(messages, req.message, docs)
+            parts: List[str] = []
+            try:
+                async for piece in _allm_stream(llm, prompt):
+                    parts.append(piece)
+                    yield _sse("token", {"text": piece})
+            except Exception as e:
+                yield _sse("error", {"detail": f"Fallo del LLM: {e}"})
+                return
+
+            raw_answer = "".join(parts).strip()
+            await _cache_store(emb, chunk_ids, raw_answer, citations, history_key)
+            final_answer = _compose_answer(raw_answer, citations)
+            await _save_turn(sid, sess, req.message, final_answer)
+            yield _sse("done", {
+                "answer": final_answer,
+                "sources_text": _sources_text(citations),
+                "disclaimer": DISCLAIMER,
+                "session_id": sid,
+                "cached": False,
+            })
+
+        return StreamingResponse(
+            _events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @router.get("/metrics")
+    async def metrics() -> Dict[str, Any]:
+        """Sesiones vivas en memoria, bytes retenidos y contadores de caché/evicción."""
+        return {
+            "sessions": await run_blocking(SESSIONS.metrics),
+            "answer_cache": await run_blocking(ANSWER_CACHE.metrics) if ANSWER_CACHE is not None else None,
+        }
+
     # Alias opcional por compatibilidad con front antiguo (/chat)
     @router.post("/chat", response_model=ChatResp)
-    def chat(req: ChatReq) -> ChatResp:
-        return answer(req)
+    async def chat(req: ChatReq) -> ChatResp:
+        return await answer(req)
 
     return router
 
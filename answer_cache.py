@@ -0,0 +1,240 @@
+# answer_cache.py
+# Caché semántica de respuestas del asesor.
+# - Clave: embedding de la pregunta + conjunto de chunk_ids recuperados + huella del historial
+#   (el historial entra en el prompt: una repregunta dentro de una conversación no comparte
+#   respuesta con la misma pregunta hecha en frío).
+# - Hit: misma clave y similitud coseno >= umbral → respuesta y citas guardadas, sin LLM.
+# - Acotada (LRU en memoria), persistida en SQLite y vaciada automáticamente cuando cambia el
+#   índice de Chroma (huella = contadores de secuencia y colecciones de chroma.sqlite3,
+#   recalculada como mucho cada `index_check_every` segundos).
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+
+CHROMA_DB = "chroma.sqlite3"
+
+# Cada add/delete de Chroma avanza el seq_id de su cola y el de los segmentos que lo consumen;
+# recrear una colección cambia su id. Nada de esto se mueve con un checkpoint del WAL.
+_CHROMA_FP_QUERIES = (
+    "SELECT segment_id, seq_id FROM max_seq_id ORDER BY segment_id",
+    "SELECT 'queue', MAX(seq_id) FROM embeddings_queue",
+    "SELECT id, name FROM collections ORDER BY id",
+)
+
+
+def _chroma_counters(db_path: str) -> Optional[str]:
+    """Contadores de chroma.sqlite3 (leídos en solo lectura; ven también lo que sigue en el -wal)."""
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=5)
+    except sqlite3.Error:
+        return None
+    try:
+        parts: List[str] = []
+        for sql in _CHROMA_FP_QUERIES:
+            try:
+                parts += [f"{a}={b}" for a, b in conn.execute(sql)]
+            except sqlite3.Error:  # tabla de otra versión de Chroma
+                continue
+        return "|".join(parts) or None
+    finally:
+        conn.close()
+
+
+def chroma_fingerprint(persist_dir: str) -> str:
+    """Huella barata del contenido del índice: cambia con cada escritura de Chroma, no con la
+    mecánica de SQLite (checkpoints del -wal, -shm) ni con el volcado diferido del HNSW."""
+    db_path = os.path.join(persist_dir, CHROMA_DB)
+    counters = _chroma_counters(db_path) if os.path.isfile(db_path) else None
+    if counters is not None:
+        return hashlib.sha1(counters.encode("utf-8")).hexdigest()
+    # Otro formato de índice: tamaño/mtime de los archivos, sin los auxiliares de SQLite
+    parts: List[str] = []
+    for root, _, files in os.walk(persist_dir):
+        for f in sorted(files):
+            if f.endswith(("-shm", "-wal")):
+                continue
+            try:
+                st = os.stat(os.path.join(root, f))
+            except OSError:
+                continue
+            parts.append(f"{f}:{st.st_size}:{st.st_mtime_ns}")
+    return hashlib.sha1("|".join(sorted(parts)).encode("utf-8")).hexdigest()
+
+
+def context_digest(*parts: str) -> str:
+    """Huella del resto del prompt (historial, indicación de sistema) que acompaña a la pregunta."""
+    return hashlib.sha1("\0".join(p or "" for p in parts).encode("utf-8")).hexdigest()
+
+
+def _chunk_key(chunk_ids: Sequence[str], context: str = "") -> str:
+    key = "|".join(sorted(set(c for c in chunk_ids if c)))
+    return f"{key}#{context}" if key and context else key
+
+
+def _unit(vec: Sequence[float]) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        db_path: str,
+        *,
+        persist_dir: str,
+        threshold: float = 0.95,
+        max_entries: int = 2000,
+        index_check_every: float = 30.0,
+    ):
+        self.db_path = db_path
+        self.persist_dir = persist_dir
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.index_check_every = index_check_every
+
+        # entry_id -> (chunk_key, vector unitario, answer, citations)
+        self._mem: "OrderedDict[str, Tuple[str, np.ndarray, str, List[Dict[str, Any]]]]" = OrderedDict()
+        self._by_key: Dict[str, Set[str]] = {}
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._fingerprint: Optional[str] = None
+        self._index_checked_at = 0.0
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+    # ---------- SQLite ----------
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            d = os.path.dirname(self.db_path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    id TEXT PRIMARY KEY,
+                    chunk_key TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    answer TEXT NOT NULL,
+                    citations_json TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )""")
+            conn.execute("CREATE TABLE IF NOT EXISTS answer_cache_meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.commit()
+            self._conn = conn
+            self._load()
+        return self._conn
+
+    def _load(self) -> None:
+        conn = self._conn
+        row = conn.execute("SELECT value FROM answer_cache_meta WHERE key='fingerprint'").fetchone()
+        self._fingerprint = row[0] if row else None
+        rows = conn.execute(
+            "SELECT id, chunk_key, embedding, answer, citations_json FROM answer_cache ORDER BY created_at DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for eid, key, blob, answer, cites in reversed(rows):
+            self._mem_put(eid, key, np.frombuffer(blob, dtype=np.float32), answer, json.loads(cites))
+
+    def _check_index(self) -> None:
+        """Si el índice de Chroma cambió desde que se guardaron las entradas, vacía la caché.
+        Recorrer PERSIST_DIR cuesta un stat por archivo: se hace como mucho cada index_check_every s."""
+        now = time.monotonic()
+        if self._fingerprint is not None and now - self._index_checked_at < self.index_check_every:
+            return
+        self._index_checked_at = now
+        fp = chroma_fingerprint(self.persist_dir)
+        if fp == self._fingerprint:
+            return
+        if self._mem or self._fingerprint is not None:
+            self._stats["invalidations"] += 1
+        self._mem.clear()
+        self._by_key.clear()
+        conn = self._db()
+        conn.execute("DELETE FROM answer_cache")
+        conn.execute("INSERT OR REPLACE INTO answer_cache_meta (key, value) VALUES ('fingerprint', ?)", (fp,))
+        conn.commit()
+        self._fingerprint = fp
+
+    # ---------- Memoria (LRU) ----------
+    def _mem_put(self, eid: str, key: str, vec: np.ndarray, answer: str, citations: List[Dict[str, Any]]) -> List[str]:
+        self._mem[eid] = (key, vec, answer, citations)
+        self._by_key.setdefault(key, set()).add(eid)
+        evicted: List[str] = []
+        while len(self._mem) > self.max_entries:
+            old_id, (old_key, *_rest) = self._mem.popitem(last=False)
+            ids = self._by_key.get(old_key)
+            if ids:
+                ids.discard(old_id)
+                if not ids:
+                    self._by_key.pop(old_key, None)
+            evicted.append(old_id)
+            self._stats["evictions"] += 1
+        return evicted
+
+    # ---------- API ----------
+    def lookup(self, embedding: Sequence[float], chunk_ids: Sequence[str],
+               context: str = "") -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        """Devuelve (answer, citations) si hay una pregunta equivalente con los mismos chunks
+        y el mismo contexto de conversación (`context_digest`)."""
+        key = _chunk_key(chunk_ids, context)
+        with self._lock:
+            self._db()
+            self._check_index()
+            best_id, best_sim = None, -1.0
+            if key:
+                q = _unit(embedding)
+                for eid in self._by_key.get(key, ()):
+                    sim = float(np.dot(q, self._mem[eid][1]))
+                    if sim > best_sim:
+                        best_id, best_sim = eid, sim
+            if best_id is None or best_sim < self.threshold:
+                self._stats["misses"] += 1
+                return None
+            self._mem.move_to_end(best_id)
+            self._stats["hits"] += 1
+            _, _, answer, citations = self._mem[best_id]
+            return answer, citations
+
+    def store(self, embedding: Sequence[float], chunk_ids: Sequence[str],
+              answer: str, citations: List[Dict[str, Any]], context: str = "") -> None:
+        key = _chunk_key(chunk_ids, context)
+        if not key or not (answer or "").strip():
+            return
+        vec = _unit(embedding)
+        eid = uuid.uuid4().hex
+        with self._lock:
+            conn = self._db()
+            self._check_index()
+            evicted = self._mem_put(eid, key, vec, answer, citations)
+            conn.execute(
+                "INSERT INTO answer_cache (id, chunk_key, embedding, answer, citations_json, created_at) VALUES (?,?,?,?,?,?)",
+                (eid, key, vec.tobytes(), answer, json.dumps(citations, ensure_ascii=False), time.time()),
+            )
+            if evicted:
+                conn.executemany("DELETE FROM answer_cache WHERE id=?", [(e,) for e in evicted])
+            conn.commit()
+            self._stats["stores"] += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                "entries": len(self._mem),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hit_rate": round(self._stats["hits"] / total, 4) if total else 0.0,
+                **self._stats,
+            }
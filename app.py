@@ -1,5 +1,6 @@
 # app.py
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
 from datetime import datetime
 
@@ -7,12 +8,13 @@ from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse
 
-# Vector & LLM (compartidos)
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-from langchain_openai import ChatOpenAI
+# Vector & LLM (compartidos): carga diferida + warm-up en segundo plano
+from executors import run_blocking, shutdown_process_pool
+from jobs import JobQueue
+from runtime import LazyLLM, LazyRetriever, LazyVectorDB, ModelRuntime
+from sqlite_pool import close_all as close_sqlite_pools
 
 # Routers modulares
 from advisor import create_advisor_router           # /advisor (prefijo interno en el router)
@@ -38,11 +40,48 @@ OPENAI_API_KEY   = os.getenv("OPENAI_API_KEY", "lm-studio")
 LLM_MODEL        = os.getenv("LLM_MODEL", "openai/gpt-oss-20b")
 LLM_TEMPERATURE  = float(os.getenv("LLM_TEMPERATURE", "0.2"))
 MAX_TOKENS_STEP  = int(os.getenv("MAX_TOKENS_STEP", "1024"))
+READY_TIMEOUT    = float(os.getenv("READY_TIMEOUT", "60"))    # espera máx. de una petición durante el warm-up
+WARMUP_ON_START  = os.getenv("WARMUP_ON_START", "1").strip().lower() in ("1", "true", "yes")
 
 EXPORT_DIR       = os.getenv("EXPORT_DIR", "./exports")
+JOBS_DB          = os.getenv("JOBS_DB", "./data/jobs.db")       # cola persistente (cadena / pipeline)
 os.makedirs(EXPORT_DIR, exist_ok=True)
 os.makedirs(PERSIST_DIR, exist_ok=True)  # asegura la carpeta de Chroma
 
+# =======================
+# RAG COMPARTIDO (1 sola vez, diferido)
+# =======================
+# Embeddings, Chroma y LLM se cargan en el warm-up; los routers reciben proxies que los
+# resuelven al primer uso (y esperan hasta READY_TIMEOUT si el warm-up sigue en curso).
+RUNTIME = ModelRuntime(
+    persist_dir=PERSIST_DIR,
+    embedding_model=EMBEDDING_MODEL,
+    top_k=TOP_K_DEFAULT,
+    llm_model=LLM_MODEL,
+    llm_api_base=OPENAI_API_BASE,
+    llm_api_key=OPENAI_API_KEY,
+    llm_temperature=LLM_TEMPERATURE,
+    max_tokens=MAX_TOKENS_STEP,
+    ready_timeout=READY_TIMEOUT,
+)
+retriever = LazyRetriever(RUNTIME)
+vectordb = LazyVectorDB(RUNTIME)
+llm = LazyLLM(RUNTIME)
+
+# Trabajos largos del wizard: sobreviven reinicios (los pendientes se reanudan al arrancar)
+JOBS = JobQueue(JOBS_DB)
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    if WARMUP_ON_START:
+        RUNTIME.start()  # no bloquea: el puerto abre ya, /readyz dice cuándo está caliente
+    JOBS.start()
+    yield
+    await JOBS.stop()
+    await RUNTIME.stop()
+    close_sqlite_pools()
+    shutdown_process_pool()
+
 # =======================
 # FASTAPI APP
 # =======================
@@ -50,6 +89,7 @@ app = FastAPI(
     title="Asistente Jurídico (Tutela COL) – Modular",
     version="1.3.0",
     description="Backend FastAPI que une el asesor jurídico (RAG+memoria) y el generador de tutelas (wizard).",
+    lifespan=lifespan,
 )
 
 # CORS (endurece en producción)
@@ -90,42 +130,22 @@ def go_render():
     # nueva pantalla final editable
     return RedirectResponse("/ui/render.html", status_code=302)
 
+# Liveness: el proceso responde (no dice nada de los modelos)
 @app.get("/healthz")
 def healthz():
     return {"ok": True, "ts": datetime.utcnow().isoformat()}
 
-# =======================
-# RAG COMPARTIDO (1 sola vez)
-# =======================
-# Embeddings deben coincidir con ingest.py
-embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
-
-# Vector store persistente
-vectordb = Chroma(embedding_function=embeddings, persist_directory=PERSIST_DIR)
-
-# Retriever con MMR para mayor diversidad de pasajes
-retriever = vectordb.as_retriever(
-    search_type="mmr",
-    search_kwargs={
-        "k": TOP_K_DEFAULT,
-        "fetch_k": max(12, TOP_K_DEFAULT * 3),
-        "lambda_mult": 0.7
-    },
-)
-
-# LLM (LM Studio / OpenAI-compatible)
-llm = ChatOpenAI(
-    model=LLM_MODEL,
-    openai_api_base=OPENAI_API_BASE,
-    openai_api_key=OPENAI_API_KEY,
-    temperature=LLM_TEMPERATURE,
-    max_tokens=MAX_TOKENS_STEP,
-)
+# Readiness: 200 sólo cuando embeddings, Chroma y el endpoint del LLM están listos
+@app.get("/readyz")
+async def readyz():
+    body = await run_blocking(RUNTIME.readiness)
+    body["ts"] = datetime.utcnow().isoformat()
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
 
 # =======================
 # INTEGRAR MÓDULOS
 # =======================
-# advisor: recibe vectordb para calcular scores en citas.
+# advisor: los scores llegan en los docs; vectordb queda como respaldo para retrievers sin score.
 advisor_router = create_advisor_router(
     retriever=retriever,
     llm=llm,
@@ -140,6 +160,7 @@ tutela_router = create_tutela_router(
     export_dir=EXPORT_DIR,
     top_k_default=TOP_K_DEFAULT,
     max_tokens_default=MAX_TOKENS_STEP,
+    job_queue=JOBS,
 )
 
 # Montamos los routers
@@ -0,0 +1,219 @@
+# case_store.py
+# Repositorio de lectura de casos del wizard.
+# - load_case(): caso + partes + secciones + derechos en una sola ronda de consultas (4 SELECT),
+#   como CaseSnapshot inmutable; composición, contexto del LLM y grafo de dependencias leen de ahí
+#   en vez de hacer un SELECT por sección (N+1).
+# - require_case(): validación de existencia barata (un SELECT por clave primaria).
+# - case_revision(): revisión del caso (la incrementan triggers en cada escritura); sirve de
+#   ETag para responder 304 sin cargar nada más.
+# - case_changes(): delta desde una revisión (filas con revision > since), para clientes que ya
+#   tienen el caso y sólo quieren lo que cambió.
+# - list_cases(): listado paginado por keyset (updated_at, id) sobre idx_cases_updated:
+#   cada página cuesta lo mismo sin importar cuántos casos haya antes (sin OFFSET).
+
+from __future__ import annotations
+
+import base64
+import json
+import sqlite3
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from fastapi import HTTPException
+
+Row = Mapping[str, Any]
+
+
+def _freeze(row: sqlite3.Row) -> Row:
+    return MappingProxyType(dict(row))
+
+
+class CaseSnapshot:
+    """Vista inmutable de un caso en un instante (filas como mappings de sólo lectura)."""
+
+    __slots__ = ("case_id", "case", "parties", "sections", "rights")
+
+    def __init__(self, case: Row, parties: Iterable[Row], sections: Iterable[Row], rights: Iterable[Row]):
+        set_ = object.__setattr__
+        set_(self, "case_id", case["id"])
+        set_(self, "case", case)
+        set_(self, "parties", tuple(parties))                       # orden de creación
+        set_(self, "sections", MappingProxyType({s["name"]: s for s in sections}))
+        set_(self, "rights", tuple(rights))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("CaseSnapshot es inmutable")
+
+    @property
+    def revision(self) -> int:
+        return int(self.case.get("revision") or 0)
+
+    # ---------- secciones ----------
+    def section(self, name: str) -> Optional[Row]:
+        return self.sections.get(name)
+
+    def best(self, name: str) -> str:
+        """Mejor texto de una sección: final > ai > user."""
+        r = self.sections.get(name)
+        return (r["final_text"] or r["ai_text"] or r["user_text"] or "").strip() if r else ""
+
+    def texts(self, names: Iterable[str]) -> Dict[str, str]:
+        return {n: self.best(n) for n in names}
+
+    # ---------- partes ----------
+    def people(self, role: str) -> Tuple[Row, ...]:
+        return tuple(p for p in self.parties if p["role"] == role)
+
+    # ---------- serialización ----------
+    def as_bundle(self) -> Dict[str, Any]:
+        """Mismo formato que devolvía el bundle de /case/{id} (dicts mutables, copias)."""
+        return {
+            "case": dict(self.case),
+            "parties": [dict(p) for p in sorted(self.parties, key=lambda p: (p["role"] or "", p["created_at"] or ""))],
+            "sections": [dict(s) for s in sorted(self.sections.values(), key=lambda s: s["id"])],
+            "rights_detected": [dict(r) for r in self.rights],
+        }
+
+
+def require_case(conn: sqlite3.Connection, case_id: str) -> None:
+    if conn.execute("SELECT 1 FROM cases WHERE id=?", (case_id,)).fetchone() is None:
+        raise HTTPException(status_code=404, detail="Caso no encontrado")
+
+
+def case_revision(conn: sqlite3.Connection, case_id: str) -> int:
+    row = conn.execute("SELECT revision FROM cases WHERE id=?", (case_id,)).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Caso no encontrado")
+    return int(row[0] or 0)
+
+
+def load_case(conn: sqlite3.Connection, case_id: str) -> CaseSnapshot:
+    """Carga el caso completo (404 si no existe), coherente: las 4 lecturas ven el mismo estado."""
+    own_tx = not conn.in_transaction
+    if own_tx:
+        conn.execute("BEGIN")  # WAL: una transacción de lectura = una sola instantánea
+    try:
+        case = conn.execute("SELECT * FROM cases WHERE id=?", (case_id,)).fetchone()
+        if not case:
+            raise HTTPException(status_code=404, detail="Caso no encontrado")
+        parties = conn.execute("SELECT * FROM parties WHERE case_id=? ORDER BY created_at, rowid", (case_id,))
+        parties = [_freeze(r) for r in parties]
+        sections = [_freeze(r) for r in conn.execute("SELECT * FROM sections WHERE case_id=? ORDER BY id", (case_id,))]
+        rights = [_freeze(r) for r in conn.execute(
+            "SELECT * FROM rights_detected WHERE case_id=? ORDER BY right_name", (case_id,))]
+    finally:
+        if own_tx:
+            conn.execute("COMMIT")
+    return CaseSnapshot(_freeze(case), parties, sections, rights)
+
+
+def case_changes(conn: sqlite3.Connection, case_id: str, since: int) -> Dict[str, Any]:
+    """
+    Secciones, partes y derechos escritos después de la revisión `since` (misma instantánea).
+    Si `since` es mayor que la revisión actual (base restaurada, caso recreado) el cliente no
+    puede aplicar un delta: se devuelve todo con reset=True.
+    """
+    own_tx = not conn.in_transaction
+    if own_tx:
+        conn.execute("BEGIN")
+    try:
+        case = conn.execute("SELECT * FROM cases WHERE id=?", (case_id,)).fetchone()
+        if not case:
+            raise HTTPException(status_code=404, detail="Caso no encontrado")
+        revision = int(case["revision"] or 0)
+        reset = since < 0 or since > revision
+        since = 0 if reset else since
+
+        def rows(sql: str) -> List[Dict[str, Any]]:
+            return [dict(r) for r in conn.execute(sql, (case_id, since))]
+
+        out = {
+            "case_id": case_id,
+            "since": since,
+            "revision": revision,
+            "reset": reset,
+            "case": dict(case) if revision > since else None,
+            "sections": rows("SELECT * FROM sections WHERE case_id=? AND revision>? ORDER BY id"),
+            "parties": rows("SELECT * FROM parties WHERE case_id=? AND revision>? ORDER BY created_at, rowid"),
+            "rights_detected": rows(
+                "SELECT * FROM rights_detected WHERE case_id=? AND revision>? ORDER BY right_name"),
+        }
+    finally:
+        if own_tx:
+            conn.execute("COMMIT")
+    return out
+
+
+# ---------- listado ----------
+COUNT_CAP = 10_000  # por encima, el total con filtros se informa como estimado
+
+
+def encode_cursor(updated_at: str, case_id: str) -> str:
+    raw = json.dumps([updated_at, case_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated_at, case_id = json.loads(raw)
+        return str(updated_at), str(case_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def list_cases(
+    conn: sqlite3.Connection,
+    *,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    statuses: Optional[List[str]] = None,
+    updated_from: Optional[str] = None,
+    updated_to: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Una página de casos, más recientes primero. `updated_from`/`updated_to` acotan updated_at
+    (ISO, inclusivos). Devuelve items, next_cursor (None en la última página) y el total:
+    exacto hasta COUNT_CAP; sin filtros, MAX(rowid) (O(log n); los casos no se borran).
+    """
+    where: List[str] = []
+    params: List[Any] = []
+    if statuses:
+        where.append(f"status IN ({','.join('?' * len(statuses))})")
+        params += statuses
+    if updated_from:
+        where.append("updated_at >= ?")
+        params.append(updated_from)
+    if updated_to:
+        where.append("updated_at <= ?")
+        params.append(updated_to)
+    filters = " AND ".join(where)
+
+    page_where = list(where)
+    page_params = list(params)
+    if cursor:
+        page_where.append("(updated_at, id) < (?, ?)")
+        page_params += decode_cursor(cursor)
+    sql = "SELECT id, title, status, created_at, updated_at FROM cases"
+    if page_where:
+        sql += " WHERE " + " AND ".join(page_where)
+    sql += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+    rows = conn.execute(sql, (*page_params, limit + 1)).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]["updated_at"], rows[-1]["id"]) if has_more and rows else None
+
+    if filters:
+        n = conn.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM cases WHERE {filters} LIMIT ?)",
+                         (*params, COUNT_CAP + 1)).fetchone()[0]
+        total, exact = min(n, COUNT_CAP), n <= COUNT_CAP
+    else:
+        total, exact = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM cases").fetchone()[0], False
+
+    return {
+        "items": [dict(r) for r in rows],
+        "next_cursor": next_cursor,
+        "total_estimate": total,
+        "total_exact": exact,
+    }
@@ -0,0 +1,66 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import tutela
+from jobs import JobQueue
+
+
+class FakeLLM:
+    """LLM determinista: cada llamada devuelve un texto numerado y queda registrada."""
+
+    model_name = "fake-llm"
+    temperature = 0.0
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.prompts = []
+
+    @property
+    def calls(self) -> int:
+        return len(self.prompts)
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(str(prompt))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        class Resp:
+            content = f"Texto generado #{len(self.prompts)}"
+
+        return Resp()
+
+
+@pytest.fixture
+def llm():
+    return FakeLLM()
+
+
+@pytest.fixture
+def wizard_app(tmp_path, llm, monkeypatch):
+    """App con sólo el router del wizard, sobre una base SQLite temporal y sin caché de LLM."""
+    monkeypatch.setattr(tutela, "LLM_CACHE", None)
+    monkeypatch.setattr(tutela, "_LLM_SLOTS", None)  # el semáforo no debe cruzar event loops
+    app = FastAPI()
+    app.state.db_path = os.path.join(tmp_path, "tutelas.db")
+    app.include_router(tutela.create_router(
+        llm=llm,
+        db_path=app.state.db_path,
+        export_dir=os.path.join(tmp_path, "exports"),
+        job_queue=JobQueue(os.path.join(tmp_path, "jobs.db")),
+    ), prefix="/wizard")
+    return app
+
+
+@pytest.fixture
+def client(wizard_app):
+    with TestClient(wizard_app) as c:
+        yield c
+
+
+@pytest.fixture
+def case_id(client):
+    return client.post("/wizard/case").json()["case_id"]
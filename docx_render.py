@@ -0,0 +1,244 @@
+# docx_render.py
+# Render del escrito de tutela a Word (.docx) con python-docx.
+# - Función pura de datos: recibe el dict de tutela._docx_inputs (textos elegidos, personas,
+#   encabezado, plantilla) y escribe el archivo; no toca la base ni el resto de la app.
+# - Documento base cacheado: estilos "Tutela *" + encabezado fijo se arman UNA vez por
+#   (plantilla, encabezado) y se guardan como bytes; cada export sólo reabre esa copia.
+#   Los párrafos referencian estilos (sin fuente/tamaño por run): menos trabajo y archivos
+#   más chicos.
+# - Plantilla con membrete: un .docx del despacho (encabezado/pie de página, logo, estilos).
+#   Se conserva lo que traiga; los estilos "Tutela *" que ya defina mandan sobre los nuestros.
+# - Módulo liviano a propósito: los procesos del pool de render (exportación masiva) sólo
+#   importan esto y python-docx.
+
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+FONT_NAME = "Times New Roman"
+FONT_SIZE = 12
+
+# Estilos propios (los puede redefinir la plantilla del despacho)
+STYLE_BOLD = "Tutela Negrita"     # encabezado, partes, "FIRMAS:"
+STYLE_TITLE = "Tutela Título"     # títulos de sección: centrado + negrita
+STYLE_BODY = "Tutela Cuerpo"      # texto de secciones: justificado
+STYLE_CENTER = "Tutela Centro"    # línea de firma
+STYLE_SIGNER = "Tutela Firmante"  # nombre/identificación bajo la firma: centrado + negrita
+STYLE_LABEL = "Tutela Etiqueta"   # carácter: "REF: " en negrita
+
+_BASES: Dict[Tuple[Any, ...], bytes] = {}  # (plantilla, mtime, tamaño, encabezado) -> .docx base
+_BASES_LOCK = threading.Lock()
+_SIGNATURES: Dict[Tuple[str, float, int], str] = {}
+
+
+def _stat_key(template: Optional[str]) -> Tuple[Any, ...]:
+    if not template:
+        return ("", 0.0, 0)
+    st = os.stat(template)
+    return (os.path.abspath(template), st.st_mtime, st.st_size)
+
+
+def template_signature(template: Optional[str]) -> str:
+    """Hash del contenido de la plantilla (entra en el hash del export); cacheado por mtime/tamaño."""
+    if not template:
+        return ""
+    key = _stat_key(template)
+    sig = _SIGNATURES.get(key)
+    if sig is None:
+        with open(template, "rb") as f:
+            sig = _SIGNATURES[key] = hashlib.sha256(f.read()).hexdigest()[:16]
+    return sig
+
+
+def _ensure_styles(doc, *, own_normal: bool) -> None:
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.shared import Pt
+
+    styles = doc.styles
+    if own_normal:  # con plantilla, la fuente base es la del despacho
+        styles["Normal"].font.name = FONT_NAME
+        styles["Normal"].font.size = Pt(FONT_SIZE)
+    existing = {s.name for s in styles}
+
+    def para(name: str, *, bold: bool = False, align=None) -> None:
+        if name in existing:
+            return
+        st = styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+        st.base_style = styles["Normal"]
+        st.quick_style = True
+        if bold:
+            st.font.bold = True
+        if align is not None:
+            st.paragraph_format.alignment = align
+
+    para(STYLE_BOLD, bold=True)
+    para(STYLE_TITLE, bold=True, align=WD_ALIGN_PARAGRAPH.CENTER)
+    para(STYLE_BODY, align=WD_ALIGN_PARAGRAPH.JUSTIFY)
+    para(STYLE_CENTER, align=WD_ALIGN_PARAGRAPH.CENTER)
+    para(STYLE_SIGNER, bold=True, align=WD_ALIGN_PARAGRAPH.CENTER)
+    if STYLE_LABEL not in existing:
+        styles.add_style(STYLE_LABEL, WD_STYLE_TYPE.CHARACTER).font.bold = True
+
+
+def _build_base(template: Optional[str], header: str) -> bytes:
+    from docx import Document
+
+    doc = Document(template) if template else Document()
+    _ensure_styles(doc, own_normal=not template)
+    # ===== Encabezado (SIN la línea extra), MAYÚSCULA + NEGRITA =====
+    for line in header.split("\n"):
+        doc.add_paragraph(line.upper(), style=STYLE_BOLD)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def base_document(template: Optional[str], header: str):
+    """Copia fresca del documento base (plantilla + estilos + encabezado), armado una sola vez."""
+    try:
+        from docx import Document
+    except Exception as e:
+        raise RuntimeError("Instala 'python-docx' para exportar a Word: pip install python-docx") from e
+
+    key = (*_stat_key(template), header)
+    data = _BASES.get(key)
+    if data is None:
+        with _BASES_LOCK:
+            data = _BASES.get(key)
+            if data is None:
+                data = _BASES[key] = _build_base(template, header)
+    return Document(io.BytesIO(data))
+
+
+def _join_people(rows: List[Dict[str, str]]) -> str:
+    out = []
+    for r in rows:
+        nombre = " ".join([(r["nombres"] or "").strip(), (r["apellidos"] or "").strip()]).strip()
+        ident  = " ".join([(r["tipo_id"] or "").strip(), (r["numero_id"] or "").strip()]).strip()
+        label = nombre if not ident else f"{nombre} — {ident}"
+        if label:
+            out.append(label)
+    return "; ".join(out)
+
+
+def render_docx(inputs: Dict[str, Any], docx_path: str) -> None:
+    """Escribe el .docx de `inputs` (ver tutela._docx_inputs) en `docx_path`."""
+    doc = base_document(inputs.get("template") or None, inputs["header"])
+    # style_id resuelto una vez: asignar por nombre (paragraph.style = ...) recorre todos los
+    # estilos del documento en cada párrafo y se come la ganancia
+    sid = {name: doc.styles[name].style_id
+           for name in (STYLE_BOLD, STYLE_TITLE, STYLE_BODY, STYLE_CENTER, STYLE_SIGNER, STYLE_LABEL)}
+
+    def _p(text: str = "", style: Optional[str] = None):
+        par = doc.add_paragraph(text or "")
+        if style:
+            par._p.style = sid[style]
+        return par
+
+    def _title(text: str):
+        # Título en MAYÚSCULAS, centrado y en NEGRITA (estilo propio, no Heading: misma fuente)
+        return _p((text or "").upper(), STYLE_TITLE)
+
+    def _body(text: str):
+        return _p(text, STYLE_BODY)
+
+    accionantes = inputs["accionantes"]
+    accionados = inputs["accionados"]
+
+    # Selección de textos
+    ref        = inputs["ref"]
+    intro      = inputs["intro"]
+    hechos     = inputs["hechos"]
+    der_vuln   = inputs["der_vuln"]
+    fund_j     = inputs["fund_j"]
+    fund_d     = inputs["fund_d"]
+    pret       = inputs["pret"]
+    notifs     = inputs["notifs"]
+    juramento  = inputs["juramento"]
+    pya        = inputs["pya"]
+
+    # REF
+    if ref:
+        _p()  # espacio
+        par = _p()
+        par.add_run("REF: ")._r.style = sid[STYLE_LABEL]
+        par.add_run(ref)
+
+    # Partes (nombres e identificaciones en MAYÚSCULA + NEGRITA)
+    _p()  # espacio
+    _p("ACCIONANTE(S): " + _join_people(accionantes).upper(), STYLE_BOLD)
+    _p("ACCIONADO(S): " + _join_people(accionados).upper(), STYLE_BOLD)
+
+    # ===== Secciones =====
+    if intro:
+        _title("Introducción")
+        _body(intro)
+
+    if hechos:
+        _title("Hechos")
+        _body(hechos)
+
+    if der_vuln:
+        _title("Derechos vulnerados")
+        _body(der_vuln)
+
+    if fund_j:
+        _title("Fundamentos jurídicos")
+        _body(fund_j)
+
+    # Pruebas y Anexos
+    _title("Pruebas y Anexos")
+    _body("Con el fin de establecer la vulneración de los derechos, solicito señor Juez se sirva tener en cuenta las siguientes pruebas y anexos:")
+    if pya.strip():
+        for i, line in enumerate([l for l in pya.splitlines() if l.strip()], start=1):
+            _body(f"{i}. {line.strip()}")
+
+    # Pretensiones
+    if pret.strip():
+        _title("Pretensiones")
+        for i, line in enumerate([l for l in pret.splitlines() if l.strip()], start=1):
+            _body(f"{i}. {line.strip()}")
+
+    # Fundamentos de derecho
+    if fund_d:
+        _title("Fundamentos de derecho")
+        for i, line in enumerate([l for l in fund_d.splitlines() if l.strip()], start=1):
+            _body(f"{i}. {line.strip()}")
+
+    # Juramento
+    if juramento:
+        _title("Cumplimiento art. 37 del Decreto 2591/1991 — Juramento")
+        _body(juramento)
+
+    # Notificaciones
+    if notifs:
+        _title("Notificaciones")
+        _body(notifs)
+
+    # ===== FIRMAS personalizadas =====
+    _p()
+    _p("FIRMAS:", STYLE_BOLD)
+    _p(); _p(); _p()  # 3 saltos
+
+    # Bloques por cada accionante: línea para firma + NOMBRE + TIPO_ID NÚMERO (todo MAYÚSCULA + NEGRITA)
+    if not accionantes:
+        # Si no hay accionantes, deja un bloque vacío para firmar
+        _p("______________________________", STYLE_CENTER)
+        _p("(NOMBRE DEL ACCIONANTE)", STYLE_SIGNER)
+        _p("(TIPO DE ID Y NÚMERO)", STYLE_SIGNER)
+    else:
+        for a in accionantes:
+            nombre = " ".join([(a["nombres"] or "").strip(), (a["apellidos"] or "").strip()]).strip() or "(SIN NOMBRE)"
+            ident  = " ".join([(a["tipo_id"] or "").strip(), (a["numero_id"] or "").strip()]).strip() or "ID — (PENDIENTE)"
+            _p("______________________________", STYLE_CENTER)
+            _p(nombre.upper(), STYLE_SIGNER)
+            _p(ident.upper(), STYLE_SIGNER)
+            _p()  # espacio entre firmantes
+
+    # Guardar DOCX
+    doc.save(docx_path)
@@ -0,0 +1,249 @@
+# embedding_cache.py
+# Caché persistente de embeddings direccionada por contenido, compartida por ingest.py y app.py.
+# - Clave: sha1(tipo + texto) dentro de un directorio por modelo → (modelo, hash del texto).
+# - Vectores en un archivo float32 memory-mapped (numpy.memmap): leer N vectores no carga
+#   el archivo completo en RAM, aunque haya cientos de miles de chunks.
+# - Índice clave → fila en SQLite (WAL), seguro entre procesos (ingesta + servidor).
+# - Tope de filas con evicción LRU: las filas menos usadas se reutilizan para vectores nuevos.
+#   La escritura reserva filas antes de sobrescribirlas y la lectura revalida clave → fila,
+#   así que varios procesos escritores pueden compartir la caché.
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBED_CACHE_ENABLE = os.getenv("EMBED_CACHE", "1").strip().lower() in ("1", "true", "yes")
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "./data/embed_cache")
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", "500000"))
+
+_SQL_BATCH = 500
+_PENDING = "~pending:"  # prefijo de las filas reservadas por un put_many en curso
+
+
+def text_key(text: str, kind: str = "d") -> str:
+    """kind: 'd' (documento/chunk) o 'q' (consulta); algunos modelos los embeben distinto."""
+    return hashlib.sha1(f"{kind}\0{text or ''}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str, model_name: str, max_rows: int = 500_000):
+        safe = re.sub(r"[^A-Za-z0-9._-]+", "_", model_name).strip("_") or "model"
+        self.dir = os.path.join(cache_dir, safe)
+        os.makedirs(self.dir, exist_ok=True)
+        self.model_name = model_name
+        self.max_rows = max(1, max_rows)
+        self.vec_path = os.path.join(self.dir, "vectors.f32")
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.dir, "index.sqlite"), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS vectors (
+                key TEXT PRIMARY KEY,
+                row INTEGER NOT NULL UNIQUE,
+                last_used REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_vectors_last_used ON vectors(last_used)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        self._mm: Optional[np.memmap] = None
+        self._dim: Optional[int] = None
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    # ---------- memmap ----------
+    def _read_dim(self) -> Optional[int]:
+        if self._dim is None:
+            row = self._conn.execute("SELECT value FROM meta WHERE key='dim'").fetchone()
+            self._dim = int(row[0]) if row else None
+        return self._dim
+
+    def _map(self, min_rows: int = 0) -> Optional[np.memmap]:
+        """(Re)mapea el archivo de vectores; lo agranda (x2, hasta max_rows) si hace falta."""
+        dim = self._read_dim()
+        if dim is None:
+            return None
+        row_bytes = dim * 4
+        size = os.path.getsize(self.vec_path) if os.path.exists(self.vec_path) else 0
+        cap = size // row_bytes
+        if min_rows > cap:
+            new_cap = min(self.max_rows, max(min_rows, cap * 2, 1024))
+            with open(self.vec_path, "ab") as f:
+                f.truncate(new_cap * row_bytes)
+            cap = new_cap
+            self._mm = None
+        if self._mm is None or self._mm.shape[0] != cap:
+            self._mm = np.memmap(self.vec_path, dtype=np.float32, mode="r+", shape=(cap, dim)) if cap else None
+        return self._mm
+
+    # ---------- API ----------
+    def _rows_for(self, keys: Sequence[str]) -> Dict[str, int]:
+        found: Dict[str, int] = {}
+        for i in range(0, len(keys), _SQL_BATCH):
+            part = list(keys[i:i + _SQL_BATCH])
+            q = ",".join("?" * len(part))
+            for k, r in self._conn.execute(f"SELECT key, row FROM vectors WHERE key IN ({q})", part):
+                found[k] = r
+        return found
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        uniq = list(dict.fromkeys(keys))
+        with self._lock:
+            found = self._rows_for(uniq)
+            out: Dict[str, np.ndarray] = {}
+            if found:
+                mm = self._map()
+                if mm is None or max(found.values()) >= mm.shape[0]:
+                    self._mm = None  # otro proceso agrandó el archivo
+                    mm = self._map()
+                for k, r in found.items():
+                    out[k] = np.array(mm[r])
+                # Otro proceso pudo desalojar la fila y escribir otro vector entre la consulta
+                # y la lectura del memmap: sólo vale lo que sigue apuntando a la misma fila.
+                still = self._rows_for(list(found))
+                for k, r in found.items():
+                    if still.get(k) != r:
+                        out.pop(k, None)
+                if out:
+                    now = time.time()
+                    hit_keys = list(out)
+                    for i in range(0, len(hit_keys), _SQL_BATCH):
+                        part = hit_keys[i:i + _SQL_BATCH]
+                        q = ",".join("?" * len(part))
+                        self._conn.execute(f"UPDATE vectors SET last_used=? WHERE key IN ({q})", [now, *part])
+                    self._conn.commit()
+            self._stats["hits"] += len(out)
+            self._stats["misses"] += len(uniq) - len(out)
+            return out
+
+    def put_many(self, items: Sequence[Tuple[str, Sequence[float]]]) -> None:
+        """Escribe en dos fases para no pisar filas que otro proceso está leyendo:
+        1) reserva las filas (libres o desalojadas) con claves provisionales y confirma,
+           de modo que ningún lector nuevo las encuentre;
+        2) escribe los vectores en el memmap y publica las claves reales.
+        `get_many` revalida clave → fila tras leer, así que un lector que ya tenía la
+        fila antigua descarta el vector sobrescrito en vez de devolverlo."""
+        if not items:
+            return
+        items = list(dict(items).items())[-self.max_rows:]
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")  # asigna filas sin carreras entre procesos
+            try:
+                if self._read_dim() is None:
+                    self._dim = len(items[0][1])
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dim', ?)", (str(self._dim),))
+                existing = set(self._rows_for([k for k, _ in items]))
+                fresh = [(k, v) for k, v in items if k not in existing]
+                if not fresh:
+                    conn.execute("COMMIT")
+                    return
+
+                used = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+                free = max(0, self.max_rows - used)
+                slots = list(range(used, used + min(free, len(fresh))))
+                need = len(fresh) - len(slots)
+                if need > 0:
+                    # Las reservas de otro put_many en curso no se tocan (salvo que lleven
+                    # colgadas más de una hora: restos de un proceso que murió a mitad).
+                    victims = conn.execute(
+                        "SELECT key, row FROM vectors WHERE key NOT LIKE ? OR last_used < ? "
+                        "ORDER BY last_used LIMIT ?",
+                        (_PENDING + "%", time.time() - 3600, need),
+                    ).fetchall()
+                    conn.executemany("DELETE FROM vectors WHERE key=?", [(k,) for k, _ in victims])
+                    slots.extend(r for _, r in victims)
+                    self._stats["evictions"] += len(victims)
+                fresh = fresh[:len(slots)]
+
+                tag = uuid.uuid4().hex
+                pending = [f"{_PENDING}{tag}:{slot}" for slot in slots]
+                now = time.time()
+                conn.executemany(
+                    "INSERT INTO vectors (key, row, last_used) VALUES (?,?,?)",
+                    [(p, slot, now) for p, slot in zip(pending, slots)],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            mm = self._map(min_rows=max(slots) + 1)
+            for (_, vec), slot in zip(fresh, slots):
+                mm[slot] = np.asarray(vec, dtype=np.float32)
+            mm.flush()  # vectores en disco antes de publicar el índice
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                taken = set(self._rows_for([k for k, _ in fresh]))  # otro proceso pudo insertarlas
+                for (k, _), p in zip(fresh, pending):
+                    if k in taken:
+                        # La fila queda reservada pero sin clave útil: la próxima evicción la reutiliza.
+                        conn.execute("UPDATE vectors SET last_used=0 WHERE key=?", (p,))
+                    else:
+                        conn.execute("UPDATE vectors SET key=?, last_used=? WHERE key=?", (k, now, p))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+            return {
+                "model": self.model_name,
+                "rows": rows,
+                "max_rows": self.max_rows,
+                "dim": self._read_dim(),
+                "bytes_on_disk": os.path.getsize(self.vec_path) if os.path.exists(self.vec_path) else 0,
+                **self._stats,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """Envuelve un Embeddings de LangChain: sólo los textos no vistos llegan al modelo."""
+
+    def __init__(self, base: Embeddings, cache: EmbeddingCache):
+        self.base = base
+        self.cache = cache
+
+    def _embed(self, texts: List[str], kind: str) -> List[List[float]]:
+        keys = [text_key(t, kind) for t in texts]
+        hit = self.cache.get_many(keys)
+        missing: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in hit and k not in missing:
+                missing[k] = t
+        if missing:
+            miss_keys = list(missing)
+            if kind == "q":
+                vecs = [self.base.embed_query(missing[k]) for k in miss_keys]
+            else:
+                vecs = self.base.embed_documents([missing[k] for k in miss_keys])
+            self.cache.put_many(list(zip(miss_keys, vecs)))
+            for k, v in zip(miss_keys, vecs):
+                hit[k] = np.asarray(v, dtype=np.float32)
+        return [hit[k].tolist() for k in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(list(texts), "d")
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], "q")[0]
+
+
+def with_embedding_cache(base: Embeddings, model_name: str) -> Embeddings:
+    """Devuelve `base` envuelto en la caché (o tal cual si EMBED_CACHE=0)."""
+    if not EMBED_CACHE_ENABLE:
+        return base
+    return CachedEmbeddings(base, EmbeddingCache(EMBED_CACHE_DIR, model_name, EMBED_CACHE_MAX_ROWS))
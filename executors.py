@@ -0,0 +1,58 @@
+# executors.py
+# Pool acotado y dedicado para trabajo bloqueante (SQLite, python-docx, IO de disco).
+# Los endpoints son async: el LLM se espera con ainvoke/astream en el event loop y sólo
+# lo bloqueante pasa por aquí, así una generación lenta no ocupa hilos del threadpool
+# de Starlette (que sigue libre para /healthz, estáticos, etc.).
+# Lo CPU-bound y pesado en GIL (render .docx masivo) va a un pool de PROCESOS aparte, creado
+# al primer uso (spawn: seguro aunque el servidor tenga hilos vivos).
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "8"))
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", str(min(4, os.cpu_count() or 2))))
+
+BLOCKING_POOL = ThreadPoolExecutor(max_workers=max(1, BLOCKING_WORKERS), thread_name_prefix="blocking-io")
+
+
+async def run_blocking(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Ejecuta fn(*args, **kwargs) en BLOCKING_POOL y espera su resultado."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BLOCKING_POOL, functools.partial(fn, *args, **kwargs))
+
+
+_PROCESS_POOL: Optional[ProcessPoolExecutor] = None
+_PROCESS_POOL_LOCK = threading.Lock()
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is None:
+            _PROCESS_POOL = ProcessPoolExecutor(max_workers=max(1, PROCESS_WORKERS),
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _PROCESS_POOL
+
+
+async def run_in_process(fn: Callable[..., T], *args: Any) -> T:
+    """fn(*args) en el pool de procesos (fn y args deben ser picklables: función de módulo)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), functools.partial(fn, *args))
+
+
+def shutdown_process_pool() -> None:
+    """Apagado de la app: termina los procesos del pool si llegaron a crearse."""
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        pool, _PROCESS_POOL = _PROCESS_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
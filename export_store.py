@@ -0,0 +1,155 @@
+# export_store.py
+# Artefactos exportados del wizard (DOCX/JSON) en EXPORT_DIR, direccionados por contenido.
+# - Nombre = tutela_{case_id}_{hash}.{ext}; el hash cubre todo lo que determina el archivo:
+#   si ya existe se devuelve tal cual, sin volver a renderizar.
+# - Escritura atómica (temporal + os.replace): /exports nunca sirve un archivo a medio escribir.
+# - Retención: gc() borra los artefactos sin usar desde max_age y, si el directorio pasa de
+#   max_bytes, los menos usados primero. Cada hit renueva la fecha del archivo (os.utime).
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+EXPORT_PREFIX = "tutela_"
+EXPORT_EXTS = (".docx", ".json")
+TMP_MAX_AGE = 3600  # temporales huérfanos (proceso caído a mitad de escritura)
+
+
+def content_hash(*parts: Any) -> str:
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class ExportStore:
+    def __init__(self, export_dir: str, *, max_age: float, max_bytes: int, gc_interval: float = 600.0):
+        self.export_dir = export_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.gc_interval = gc_interval
+        self._lock = threading.Lock()
+        self._last_gc = 0.0
+        self._stats = {"hits": 0, "renders": 0, "gc_runs": 0, "gc_removed": 0, "gc_freed_bytes": 0}
+        os.makedirs(export_dir, exist_ok=True)
+
+    def path(self, case_id: str, digest: str, ext: str) -> str:
+        return os.path.join(self.export_dir, f"{EXPORT_PREFIX}{case_id}_{digest}.{ext}")
+
+    def _hit(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        try:
+            os.utime(path, None)  # "usado ahora": la retención por antigüedad lo respeta
+        except OSError:
+            pass
+        with self._lock:
+            self._stats["hits"] += 1
+        return True
+
+    @staticmethod
+    def _tmp_path(path: str) -> str:
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.{time.monotonic_ns()}.tmp"
+
+    def _publish(self, tmp: str, path: str) -> None:
+        os.replace(tmp, path)
+        with self._lock:
+            self._stats["renders"] += 1
+        self.maybe_gc(keep=path)
+
+    def get_or_create(self, case_id: str, digest: str, ext: str, write: Callable[[str], None]) -> str:
+        """Ruta del artefacto; `write(ruta_temporal)` sólo se llama si aún no existe."""
+        path = self.path(case_id, digest, ext)
+        if self._hit(path):
+            return path
+        tmp = self._tmp_path(path)
+        try:
+            write(tmp)
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self._publish(tmp, path)
+        return path
+
+    async def aget_or_create(self, case_id: str, digest: str, ext: str,
+                             write: Callable[[str], Awaitable[None]]) -> str:
+        """Como get_or_create, con un `write` async (p. ej. render en el pool de procesos)."""
+        path = self.path(case_id, digest, ext)
+        if self._hit(path):
+            return path
+        tmp = self._tmp_path(path)
+        try:
+            await write(tmp)
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self._publish(tmp, path)
+        return path
+
+    # ---------- retención ----------
+    def maybe_gc(self, keep: Optional[str] = None) -> None:
+        if time.monotonic() - self._last_gc >= self.gc_interval:
+            self.gc(keep=keep)
+
+    def gc(self, keep: Optional[str] = None) -> Dict[str, Any]:
+        """Borra por antigüedad y luego por tamaño total (más viejos primero). Nunca borra `keep`."""
+        with self._lock:
+            self._last_gc = time.monotonic()
+        now = time.time()
+        files, removed, freed = [], 0, 0
+        try:
+            entries = list(os.scandir(self.export_dir))
+        except OSError:
+            return {"removed": 0, "freed_bytes": 0}
+        for e in entries:
+            if not (e.is_file() and e.name.startswith(EXPORT_PREFIX)):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            is_tmp = e.name.endswith(".tmp")
+            if not is_tmp and not e.name.endswith(EXPORT_EXTS):
+                continue
+            if e.path != keep and now - st.st_mtime > (TMP_MAX_AGE if is_tmp else self.max_age):
+                if self._remove(e.path):
+                    removed, freed = removed + 1, freed + st.st_size
+                continue
+            if not is_tmp:
+                files.append((st.st_mtime, st.st_size, e.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path != keep and self._remove(path):
+                removed, freed, total = removed + 1, freed + size, total - size
+
+        with self._lock:
+            self._stats["gc_runs"] += 1
+            self._stats["gc_removed"] += removed
+            self._stats["gc_freed_bytes"] += freed
+        return {"removed": removed, "freed_bytes": freed}
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def metrics(self) -> Dict[str, Any]:
+        n = size = 0
+        try:
+            for e in os.scandir(self.export_dir):
+                if e.is_file() and e.name.startswith(EXPORT_PREFIX) and e.name.endswith(EXPORT_EXTS):
+                    n, size = n + 1, size + e.stat().st_size
+        except OSError:
+            pass
+        with self._lock:
+            return {"files": n, "bytes": size, "max_bytes": self.max_bytes,
+                    "max_age_s": self.max_age, **self._stats}
@@ -3,13 +3,21 @@
 # - Crea chunks con CHUNK_SIZE / CHUNK_OVERLAP
 # - Normaliza metadatos: source (ruta relativa), page (si aplica)
 # - Añade chunk_id estable: <ruta_sin_ext>:p<page|na>:<hash10>
-# - Si CLEAR=1, borra el índice antes de re-crear
+# - Incremental: un manifiesto (ruta, tamaño, mtime, hash, chunk_ids) permite embeber sólo
+#   archivos nuevos/cambiados y borrar de Chroma los chunks de archivos cambiados/eliminados
+# - Streaming: parseo+troceo en un pool de procesos → lotes fijos de embeddings → escritura
+#   en Chroma por lote. La memoria pico depende del lote, no del tamaño del corpus.
+# - Si CLEAR=1, borra el índice (y el manifiesto) antes de re-crear
 
 import os
+import json
+import time
 import shutil
 import hashlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from dotenv import load_dotenv
 
@@ -18,6 +26,8 @@ from langchain.schema import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 
+from embedding_cache import with_embedding_cache
+
 # Load env
 load_dotenv()
 
@@ -28,6 +38,9 @@ PERSIST_DIR = os.getenv("PERSIST_DIR", "./chroma")
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "700"))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "120"))
 CLEAR = os.getenv("CLEAR", "0").strip() in ("1", "true", "True", "yes", "YES")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 2)))
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "64"))
+MANIFEST_PATH = Path(os.getenv("INGEST_MANIFEST", os.path.join(PERSIST_DIR, "ingest_manifest.json")))
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "intfloat/multilingual-e5-small")
 
@@ -35,60 +48,116 @@ EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "intfloat/multilingual-e5-small")
 # -----------------------------
 # Loaders
 # -----------------------------
-def load_documents() -> List[Document]:
-    """Carga PDFs, DOCX, TXT y MD desde DOCS_DIR."""
+SUPPORTED_EXTS = (".pdf", ".docx", ".txt", ".md")
+
+def scan_files() -> Dict[str, Path]:
+    """Archivos soportados bajo DOCS_DIR: {ruta relativa posix: ruta absoluta}."""
+    out: Dict[str, Path] = {}
+    for p in sorted(DOCS_DIR.rglob("*")):
+        if p.is_file() and p.suffix.lower() in SUPPORTED_EXTS:
+            out[p.resolve().relative_to(DOCS_DIR).as_posix()] = p
+    return out
+
+def _loader_for(path: Path):
     from langchain_community.document_loaders import (
-        DirectoryLoader,
         TextLoader,
         PyPDFLoader,
         Docx2txtLoader,
     )
+    ext = path.suffix.lower()
+    if ext == ".pdf":
+        return PyPDFLoader(str(path))
+    if ext == ".docx":
+        return Docx2txtLoader(str(path))
+    return TextLoader(str(path), encoding="utf-8")
 
-    def _dl(pattern, loader_cls, **loader_kwargs):
-        return DirectoryLoader(
-            str(DOCS_DIR),
-            glob=pattern,
-            loader_cls=loader_cls,
-            loader_kwargs=loader_kwargs or None,
-            use_multithreading=True,
-            silent_errors=True,
-        )
-
-    loaders = [
-        _dl("**/*.pdf", PyPDFLoader),
-        _dl("**/*.docx", Docx2txtLoader),
-        _dl("**/*.txt", TextLoader, encoding="utf-8"),
-        _dl("**/*.md", TextLoader, encoding="utf-8"),
-    ]
+def load_documents(paths: Optional[Dict[str, Path]] = None) -> List[Document]:
+    """Carga PDFs, DOCX, TXT y MD desde DOCS_DIR (o sólo los `paths` indicados)."""
+    if paths is None:
+        paths = scan_files()
 
     docs: List[Document] = []
-    for ld in loaders:
+    for rel, path in paths.items():
         try:
-            docs.extend(ld.load())
+            loaded = _loader_for(path).load()
         except Exception as e:
-            print(f"[WARN] Loader falló: {ld}: {e}")
+            print(f"[WARN] Loader falló: {rel}: {e}")
+            continue
+        # Normaliza 'source' a ruta relativa al DOCS_DIR
+        for d in loaded:
+            meta = d.metadata or {}
+            meta["source"] = rel
+            d.metadata = meta
+            docs.append(d)
 
-    # Normaliza 'source' a ruta relativa al DOCS_DIR
-    normed: List[Document] = []
-    for d in docs:
-        meta = d.metadata or {}
-        src = meta.get("source") or meta.get("file_path") or ""
-        try:
-            if src:
-                srcp = Path(src)
-                if srcp.is_absolute():
-                    src = srcp.resolve().relative_to(DOCS_DIR).as_posix()
-                else:
-                    src = Path(src).as_posix()
-        except Exception:
-            # si no se puede relativizar, deja tal cual
-            src = str(src)
-        meta["source"] = src or "desconocido"
-        d.metadata = meta
-        normed.append(d)
+    print(f"[INGEST] Documentos cargados: {len(docs)}")
+    return docs
+
+
+# -----------------------------
+# Manifiesto (ingesta incremental)
+# -----------------------------
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest() -> Dict[str, Dict]:
+    """
+    Entradas del manifiesto por archivo. Si cambió el modelo de embeddings o el troceado,
+    se invalidan los hashes para que todos los archivos cuenten como cambiados.
+    """
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    files = data.get("files", {})
+    same_setup = (
+        data.get("embedding_model") == EMBEDDING_MODEL
+        and data.get("chunk_size") == CHUNK_SIZE
+        and data.get("chunk_overlap") == CHUNK_OVERLAP
+    )
+    if not same_setup:
+        print("[INGEST] Cambió modelo/troceado desde la última ingesta → se re-embebe todo.")
+        files = {rel: {**e, "size": None, "sha256": None} for rel, e in files.items()}
+    return files
+
+def save_manifest(files: Dict[str, Dict]) -> None:
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = MANIFEST_PATH.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({
+            "embedding_model": EMBEDDING_MODEL,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "files": files,
+        }, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, MANIFEST_PATH)
 
-    print(f"[INGEST] Documentos cargados: {len(normed)}")
-    return normed
+def plan_changes(files: Dict[str, Path], manifest: Dict[str, Dict]):
+    """
+    Compara DOCS_DIR con el manifiesto. Devuelve (nuevos, cambiados, eliminados, stats)
+    donde stats = {rel: {size, mtime, sha256}} de todos los archivos actuales.
+    Tamaño+mtime iguales → sin cambios (no se re-hashea); si difieren, decide el hash.
+    """
+    new, changed, stats = {}, {}, {}
+    for rel, path in files.items():
+        st = path.stat()
+        prev = manifest.get(rel)
+        if prev and prev.get("size") == st.st_size and prev.get("mtime") == st.st_mtime_ns:
+            stats[rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": prev.get("sha256")}
+            continue
+        digest = _file_sha256(path)
+        stats[rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": digest}
+        if not prev:
+            new[rel] = path
+        elif prev.get("sha256") != digest:
+            changed[rel] = path
+    removed = [rel for rel in manifest if rel not in files]
+    return new, changed, removed, stats
 
 
 # -----------------------------
@@ -97,7 +166,7 @@ def load_documents() -> List[Document]:
 def _hash10(text: str) -> str:
     return hashlib.sha1((text or "").encode("utf-8")).hexdigest()[:10]
 
-def split_documents(docs: List[Document]) -> List[Document]:
+def _split(docs: List[Document]) -> List[Document]:
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=CHUNK_SIZE,
         chunk_overlap=CHUNK_OVERLAP,
@@ -116,23 +185,135 @@ def split_documents(docs: List[Document]) -> List[Document]:
         meta["chunk_id"] = f"{base}:{ptag}:{h}"
         meta["chunk_index"] = i  # índice útil para depurar
         d.metadata = meta
+    return chunks
 
+def split_documents(docs: List[Document]) -> List[Document]:
+    chunks = _split(docs)
     print(f"[INGEST] Chunks generados: {len(chunks)} (size={CHUNK_SIZE}, overlap={CHUNK_OVERLAP})")
     return chunks
 
 
 # -----------------------------
-# Persistencia en Chroma
+# Pipeline en streaming
 # -----------------------------
-def build_index(chunks: List[Document]) -> None:
-    if CLEAR:
-        print(f"[INGEST] CLEAR=1 → borrando índice en {PERSIST_DIR} …")
-        shutil.rmtree(PERSIST_DIR, ignore_errors=True)
+def _parse_file(rel: str, path: str) -> Tuple[str, List[Document], Optional[str]]:
+    """
+    Worker (proceso aparte): carga un archivo y lo trocea. PDF/DOCX son CPU-bound.
+    Devuelve (ruta, chunks, error): si el loader falla, error trae el motivo y chunks va vacío.
+    """
+    try:
+        loaded = _loader_for(Path(path)).load()
+    except Exception as e:
+        return rel, [], f"{type(e).__name__}: {e}"
+    for d in loaded:
+        meta = d.metadata or {}
+        meta["source"] = rel
+        d.metadata = meta
+    return rel, _split(loaded), None
+
+def iter_chunks(paths: Dict[str, Path],
+                workers: int = INGEST_WORKERS) -> Iterator[Tuple[str, List[Document], Optional[str]]]:
+    """
+    Produce (ruta, chunks, error) por archivo a medida que los workers terminan.
+    A lo sumo 2×workers archivos en vuelo: la memoria no crece con el corpus.
+    """
+    if workers <= 1:
+        for rel, p in paths.items():
+            yield _parse_file(rel, str(p))
+        return
+    items = iter(paths.items())
+    max_inflight = max(1, workers) * 2
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        inflight = {pool.submit(_parse_file, rel, str(p)) for rel, p in islice(items, max_inflight)}
+        while inflight:
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield fut.result()
+            for rel, p in islice(items, len(done)):
+                inflight.add(pool.submit(_parse_file, rel, str(p)))
+
+def batched(chunks: Iterable[Document], size: int) -> Iterator[List[Document]]:
+    it = iter(chunks)
+    while True:
+        batch = list(islice(it, max(1, size)))
+        if not batch:
+            return
+        yield batch
+
+class _Rates:
+    """Contadores de docs/s, chunks/s y embeds/s para el reporte en vivo."""
 
-    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.docs = self.chunks = self.embeds = 0
+        self.embed_secs = 0.0
 
+    def report(self) -> str:
+        el = max(time.perf_counter() - self.t0, 1e-9)
+        eps = self.embeds / self.embed_secs if self.embed_secs else 0.0
+        return (f"[INGEST] archivos {self.docs} ({self.docs / el:.2f}/s) | "
+                f"chunks {self.chunks} ({self.chunks / el:.1f}/s) | "
+                f"embeds {self.embeds} ({eps:.1f}/s)")
+
+def stream_index(paths: Dict[str, Path], vectordb: Chroma,
+                 batch_size: int = EMBED_BATCH) -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+    """
+    Parseo paralelo → chunks en generador → lotes de `batch_size` embebidos y escritos
+    en Chroma al instante. Devuelve ({ruta: [chunk_ids]} de los archivos que se pudieron
+    leer, {ruta: error} de los que no) para el manifiesto.
+    """
+    rates = _Rates()
+    ids_by_file: Dict[str, List[str]] = {}
+    failed: Dict[str, str] = {}
+
+    def _chunk_stream() -> Iterator[Document]:
+        for rel, chunks, error in iter_chunks(paths):
+            rates.docs += 1
+            if error:
+                print(f"[WARN] Loader falló: {rel}: {error}")
+                failed[rel] = error
+                continue
+            rates.chunks += len(chunks)
+            ids_by_file[rel] = [d.metadata.get("chunk_id") for d in chunks]
+            yield from chunks
+
+    for batch in batched(_chunk_stream(), batch_size):
+        # IDs duplicados (mismo texto en la misma página) romperían el upsert del lote
+        uniq = list({d.metadata.get("chunk_id"): d for d in batch}.values())
+        t = time.perf_counter()
+        vectordb.add_documents(uniq, ids=[d.metadata.get("chunk_id") for d in uniq])
+        rates.embed_secs += time.perf_counter() - t
+        rates.embeds += len(uniq)
+        print(rates.report())
+
+    print(rates.report().replace("[INGEST]", "[INGEST] total:"))
+    return ids_by_file, failed
+
+
+# -----------------------------
+# Persistencia en Chroma
+# -----------------------------
+def open_index() -> Chroma:
+    # Caché de embeddings por contenido: re-ingestas y reconstrucciones sólo embeben textos nuevos
+    embeddings = with_embedding_cache(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL), EMBEDDING_MODEL)
     # Persistencia automática con persist_directory (no llames .persist())
-    vectordb = Chroma(embedding_function=embeddings, persist_directory=PERSIST_DIR)
+    return Chroma(embedding_function=embeddings, persist_directory=PERSIST_DIR)
+
+def delete_chunks(vectordb: Chroma, ids: List[str]) -> None:
+    ids = [i for i in ids if i]
+    if not ids:
+        return
+    # Chroma limita el tamaño de lote; borra en tandas
+    for i in range(0, len(ids), 5000):
+        vectordb.delete(ids=ids[i:i + 5000])
+    print(f"[INGEST] Chunks eliminados del índice: {len(ids)}")
+
+def build_index(chunks: List[Document], vectordb: Optional[Chroma] = None) -> None:
+    if vectordb is None:
+        vectordb = open_index()
+    if not chunks:
+        print("[INGEST] Nada que embeber.")
+        return
 
     # (Opcional) evita duplicados si reingestas sin CLEAR usando IDs estables
     try:
@@ -155,6 +336,53 @@ def build_index(chunks: List[Document]) -> None:
     print(f"[INGEST] Index listo en {PERSIST_DIR}")
 
 
+def ingest_incremental() -> None:
+    """Embebe sólo archivos nuevos/cambiados y retira los chunks de cambiados/eliminados."""
+    if CLEAR:
+        print(f"[INGEST] CLEAR=1 → borrando índice en {PERSIST_DIR} …")
+        shutil.rmtree(PERSIST_DIR, ignore_errors=True)
+        MANIFEST_PATH.unlink(missing_ok=True)
+
+    files = scan_files()
+    if not files:
+        raise SystemExit("[ERROR] No se encontraron documentos en DOCS_DIR.")
+
+    manifest = load_manifest()
+    new, changed, removed, stats = plan_changes(files, manifest)
+    print(f"[INGEST] Archivos: {len(files)} | nuevos: {len(new)} | cambiados: {len(changed)} "
+          f"| eliminados: {len(removed)} | sin cambios: {len(files) - len(new) - len(changed)}")
+
+    vectordb = open_index()
+    delete_chunks(vectordb, [cid for rel in removed for cid in manifest.get(rel, {}).get("chunk_ids", [])])
+
+    to_load = {**new, **changed}
+    ids_by_file, failed = stream_index(to_load, vectordb) if to_load else ({}, {})
+
+    # Los chunks viejos de un archivo cambiado se retiran sólo cuando su reemplazo ya se indexó
+    # (los ids dependen del contenido: los que siguen iguales no se tocan). Si falló el parseo,
+    # el archivo conserva su versión anterior en el índice.
+    delete_chunks(vectordb, [
+        cid for rel in changed if rel in ids_by_file
+        for cid in set(manifest.get(rel, {}).get("chunk_ids", [])) - set(ids_by_file[rel])
+    ])
+    if failed:
+        print(f"[WARN] {len(failed)} archivo(s) no se pudieron leer; se reintentarán en la próxima ingesta")
+    print(f"[INGEST] Index listo en {PERSIST_DIR}")
+
+    # Manifiesto: conserva los sin cambios, reemplaza nuevos/cambiados, quita eliminados.
+    # Un archivo que falló conserva su entrada anterior (o ninguna si era nuevo): su
+    # tamaño/hash no coinciden con el disco y la siguiente ingesta lo vuelve a intentar.
+    out: Dict[str, Dict] = {}
+    for rel, st in stats.items():
+        if rel in failed:
+            if rel in manifest:
+                out[rel] = manifest[rel]
+            continue
+        chunk_ids = ids_by_file[rel] if rel in to_load else manifest.get(rel, {}).get("chunk_ids", [])
+        out[rel] = {**st, "chunk_ids": chunk_ids}
+    save_manifest(out)
+
+
 
 # -----------------------------
 # Main
@@ -163,9 +391,4 @@ if __name__ == "__main__":
     if not DOCS_DIR.exists():
         raise SystemExit(f"[ERROR] No existe DOCS_DIR: {DOCS_DIR}")
 
-    docs = load_documents()
-    if not docs:
-        raise SystemExit("[ERROR] No se encontraron documentos en DOCS_DIR.")
-
-    chunks = split_documents(docs)
-    build_index(chunks)
+    ingest_incremental()
@@ -0,0 +1,413 @@
+# jobs.py
+# Cola de trabajos persistente para tareas largas del wizard (cadena IA, pipeline).
+# - Cada trabajo vive en SQLite (tabla 'jobs'): estado, pasos, resultado, error.
+# - Workers asyncio en cada proceso reclaman trabajos con un UPDATE atómico, así varios
+#   workers de uvicorn pueden compartir el mismo archivo .db sin ejecutar dos veces el mismo.
+# - Latido (heartbeat) mientras corre; si el proceso muere, otro (o el mismo al reiniciar)
+#   reclama el trabajo cuando el latido caduca y lo reanuda saltando los pasos ya hechos.
+#   Tras JOB_MAX_ATTEMPTS intentos caídos el trabajo pasa a 'error' (no se reintenta sin fin).
+# - Dedupe: el mismo tipo de trabajo para el mismo caso y con las mismas opciones devuelve el
+#   activo; con opciones distintas responde 409 (no se descartan en silencio).
+# - Cancelación: marca 'cancel_requested'; el dueño la ve en su latido y cancela la tarea.
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+
+from executors import run_blocking
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "5"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "60"))   # latido más viejo → se reclama
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))        # reclamos tras caídas antes de fallar
+
+TERMINAL = ("done", "error", "cancelled")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """Lo que ve un handler: pasos ya completados (para reanudar) y avisos de progreso."""
+
+    def __init__(self, queue: "JobQueue", job: Dict[str, Any]):
+        self.queue = queue
+        self.id: str = job["id"]
+        self.case_id: Optional[str] = job["case_id"]
+        self.payload: Dict[str, Any] = job["payload"]
+        self.steps: List[Dict[str, Any]] = job["steps"]
+
+    def _find(self, name: str) -> Dict[str, Any]:
+        for st in self.steps:
+            if st["name"] == name:
+                return st
+        st = {"name": name, "status": "pending"}
+        self.steps.append(st)
+        return st
+
+    def is_done(self, name: str) -> bool:
+        return self._find(name)["status"] in ("done", "skipped")
+
+    async def _set(self, name: str, status: str, **extra: Any) -> None:
+        st = self._find(name)
+        st.update(status=status, **extra)
+        await self.queue._save_steps(self.id, self.steps, current=name if status == "running" else None)
+
+    async def begin(self, name: str) -> None:
+        st = self._find(name)
+        for k in [k for k in st if k != "name"]:
+            del st[k]  # un reintento del paso empieza sin los datos del intento anterior
+        await self._set(name, "running", started_at=time.time())
+
+    async def end(self, name: str, **info: Any) -> None:
+        """Marca el paso como hecho; `info` (p. ej. partial=True) queda en el paso."""
+        await self._set(name, "done", finished_at=time.time(), **info)
+
+    async def skip(self, name: str) -> None:
+        await self._set(name, "skipped", finished_at=time.time())
+
+
+Handler = Callable[[JobContext], Awaitable[Dict[str, Any]]]
+
+
+class JobQueue:
+    def __init__(
+        self,
+        db_path: str,
+        *,
+        workers: int = JOB_WORKERS,
+        heartbeat_seconds: float = JOB_HEARTBEAT_SECONDS,
+        stale_seconds: float = JOB_STALE_SECONDS,
+        retention_seconds: int = JOB_RETENTION_SECONDS,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+    ):
+        self.db_path = db_path
+        self.workers = max(1, workers)
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        self.retention_seconds = retention_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+        self._handlers: Dict[str, Handler] = {}
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._changed: Dict[str, Set[asyncio.Event]] = {}  # job_id -> un evento por cada watch()
+        self._stopping = False
+
+    # ---------- SQLite ----------
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            d = os.path.dirname(self.db_path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    case_id TEXT,
+                    status TEXT NOT NULL,          -- queued|running|done|error|cancelled
+                    payload_json TEXT,
+                    steps_json TEXT,
+                    current_step TEXT,
+                    result_json TEXT,
+                    error TEXT,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    heartbeat_at REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_case ON jobs(case_id, kind, status)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _row(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if not row:
+            return None
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "case_id": row["case_id"],
+            "status": row["status"],
+            "payload": json.loads(row["payload_json"] or "{}"),
+            "steps": json.loads(row["steps_json"] or "[]"),
+            "current_step": row["current_step"],
+            "result": json.loads(row["result_json"]) if row["result_json"] else None,
+            "error": row["error"],
+            "cancel_requested": bool(row["cancel_requested"]),
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def _get_sync(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._row(self._db().execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone())
+
+    def _enqueue_sync(self, kind: str, case_id: Optional[str], payload: Dict[str, Any],
+                      steps: List[str], dedupe: bool) -> Dict[str, Any]:
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if dedupe:
+                    row = conn.execute(
+                        "SELECT * FROM jobs WHERE case_id IS ? AND kind=? AND status IN ('queued','running') "
+                        "ORDER BY created_at DESC LIMIT 1", (case_id, kind)).fetchone()
+                    if row:
+                        conn.execute("COMMIT")
+                        active = self._row(row)
+                        if active["payload"] != payload:
+                            raise HTTPException(409, f"Ya hay un trabajo activo ({active['id']}) de este tipo "
+                                                     f"para el caso con otras opciones: {active['payload']}")
+                        return active
+                job_id = uuid.uuid4().hex
+                now = time.time()
+                conn.execute("""
+                    INSERT INTO jobs (id, kind, case_id, status, payload_json, steps_json, created_at, updated_at)
+                    VALUES (?,?,?,?,?,?,?,?)
+                """, (job_id, kind, case_id, "queued", json.dumps(payload, ensure_ascii=False),
+                      json.dumps([{"name": s, "status": "pending"} for s in steps]), now, now))
+                conn.execute("COMMIT")
+            except HTTPException:
+                raise  # 409 tras el COMMIT de la lectura
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return self._get_sync(job_id)
+
+    def _claim_sync(self) -> Optional[Dict[str, Any]]:
+        """Reclama el trabajo encolado más antiguo (o uno 'running' con latido caducado).
+        Un 'running' caducado que ya agotó max_attempts se da por fallido en vez de reclamarse."""
+        with self._lock:
+            conn = self._db()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("""
+                    UPDATE jobs SET status='error', current_step=NULL, owner=NULL, updated_at=?,
+                                    error='El trabajo se interrumpió ' || attempts || ' veces; no se reintenta'
+                    WHERE status='running' AND COALESCE(heartbeat_at, 0) < ? AND attempts >= ?
+                """, (now, now - self.stale_seconds, self.max_attempts))
+                row = conn.execute("""
+                    SELECT id FROM jobs
+                    WHERE status='queued' OR (status='running' AND COALESCE(heartbeat_at, 0) < ?)
+                    ORDER BY created_at LIMIT 1
+                """, (now - self.stale_seconds,)).fetchone()
+                if not row:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute("""
+                    UPDATE jobs SET status='running', owner=?, attempts=attempts+1, heartbeat_at=?, updated_at=?
+                    WHERE id=?
+                """, (self.owner, now, now, row["id"]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return self._get_sync(row["id"])
+
+    def _update_sync(self, job_id: str, **fields: Any) -> None:
+        fields["updated_at"] = time.time()
+        cols = ", ".join(f"{k}=?" for k in fields)
+        with self._lock:
+            conn = self._db()
+            conn.execute(f"UPDATE jobs SET {cols} WHERE id=?", (*fields.values(), job_id))
+            conn.commit()
+
+    def _heartbeat_sync(self, job_id: str) -> bool:
+        """Renueva el latido; devuelve True si alguien pidió cancelar."""
+        with self._lock:
+            conn = self._db()
+            conn.execute("UPDATE jobs SET heartbeat_at=? WHERE id=? AND owner=?", (time.time(), job_id, self.owner))
+            conn.commit()
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=?", (job_id,)).fetchone()
+            return bool(row and row["cancel_requested"])
+
+    def _cancel_sync(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            conn = self._db()
+            now = time.time()
+            conn.execute("UPDATE jobs SET cancel_requested=1, updated_at=? WHERE id=? AND status IN ('queued','running')",
+                         (now, job_id))
+            # Encolado (nadie lo corre todavía): se cancela directamente
+            conn.execute("UPDATE jobs SET status='cancelled', updated_at=? WHERE id=? AND status='queued'", (now, job_id))
+            conn.commit()
+        return self._get_sync(job_id)
+
+    def _purge_sync(self) -> int:
+        if not self.retention_seconds:
+            return 0
+        with self._lock:
+            conn = self._db()
+            cur = conn.execute("DELETE FROM jobs WHERE status IN ('done','error','cancelled') AND updated_at < ?",
+                               (time.time() - self.retention_seconds,))
+            conn.commit()
+            return cur.rowcount or 0
+
+    # ---------- notificaciones en proceso ----------
+    def _notify(self, job_id: str) -> None:
+        for ev in self._changed.get(job_id, ()):
+            ev.set()
+
+    async def _save_steps(self, job_id: str, steps: List[Dict[str, Any]], current: Optional[str]) -> None:
+        await run_blocking(self._update_sync, job_id, steps_json=json.dumps(steps), current_step=current)
+        self._notify(job_id)
+
+    # ---------- API ----------
+    def register(self, kind: str, handler: Handler) -> None:
+        self._handlers[kind] = handler
+
+    async def enqueue(self, kind: str, *, case_id: Optional[str] = None, payload: Optional[Dict[str, Any]] = None,
+                      steps: Optional[List[str]] = None, dedupe: bool = True) -> Dict[str, Any]:
+        """Encola (o devuelve el trabajo activo idéntico si dedupe; 409 si el activo tiene otras opciones)."""
+        if kind not in self._handlers:
+            raise HTTPException(500, f"Tipo de trabajo no registrado: {kind}")
+        job = await run_blocking(self._enqueue_sync, kind, case_id, payload or {}, steps or [], dedupe)
+        self.start()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Dict[str, Any]:
+        job = await run_blocking(self._get_sync, job_id)
+        if not job:
+            raise HTTPException(404, "Trabajo no encontrado")
+        return job
+
+    async def cancel(self, job_id: str) -> Dict[str, Any]:
+        job = await run_blocking(self._cancel_sync, job_id)
+        if not job:
+            raise HTTPException(404, "Trabajo no encontrado")
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        self._notify(job_id)
+        return job
+
+    async def watch(self, job_id: str, poll_seconds: float = 1.0):
+        """Genera instantáneas del trabajo cada vez que cambia (hasta un estado terminal)."""
+        # Evento propio: un watcher que limpia o termina no afecta a los demás del mismo trabajo
+        ev = asyncio.Event()
+        self._changed.setdefault(job_id, set()).add(ev)
+        last = None
+        try:
+            while True:
+                job = await self.get(job_id)
+                stamp = (job["status"], job["updated_at"], json.dumps(job["steps"]))
+                if stamp != last:
+                    last = stamp
+                    yield job
+                if job["status"] in TERMINAL:
+                    return
+                ev.clear()
+                try:  # aviso en proceso o, si corre en otro worker, sondeo
+                    await asyncio.wait_for(ev.wait(), timeout=poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            watchers = self._changed.get(job_id)
+            if watchers is not None:
+                watchers.discard(ev)
+                if not watchers:
+                    del self._changed[job_id]
+
+    # ---------- workers ----------
+    def start(self) -> None:
+        """Arranca los workers en el loop actual (idempotente). Reanuda trabajos pendientes."""
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._tasks = [loop.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Apagado ordenado: los trabajos en curso vuelven a 'queued' y se reanudan al reiniciar."""
+        self._stopping = True
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._stopping = False
+        # (si el proceso muere sin pasar por aquí, se reclaman al caducar el latido)
+
+    async def _worker(self, n: int) -> None:
+        if n == 0:
+            await run_blocking(self._purge_sync)
+        while True:
+            job = await run_blocking(self._claim_sync)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        handler = self._handlers.get(job["kind"])
+        if handler is None or job["cancel_requested"]:
+            status = "cancelled" if job["cancel_requested"] else "error"
+            await run_blocking(self._update_sync, job_id, status=status, current_step=None,
+                               error=None if handler else f"Tipo de trabajo no registrado: {job['kind']}")
+            self._notify(job_id)
+            return
+
+        ctx = JobContext(self, job)
+        task = asyncio.get_running_loop().create_task(handler(ctx))
+        self._running[job_id] = task
+        beat = asyncio.get_running_loop().create_task(self._heartbeat(job_id, task))
+        try:
+            result = await task
+            await run_blocking(self._update_sync, job_id, status="done", current_step=None,
+                               result_json=json.dumps(result or {}, ensure_ascii=False))
+        except (asyncio.CancelledError, JobCancelled):
+            if self._stopping:
+                # Apagado ordenado: no cuenta como intento caído
+                with self._lock:
+                    conn = self._db()
+                    conn.execute("UPDATE jobs SET status='queued', owner=NULL, heartbeat_at=NULL, "
+                                 "attempts=MAX(attempts-1, 0), updated_at=? WHERE id=?", (time.time(), job_id))
+                    conn.commit()
+                raise
+            await run_blocking(self._update_sync, job_id, status="cancelled", current_step=None)
+        except HTTPException as e:
+            await run_blocking(self._update_sync, job_id, status="error", current_step=None, error=str(e.detail))
+        except Exception as e:
+            await run_blocking(self._update_sync, job_id, status="error", current_step=None,
+                               error=f"{type(e).__name__}: {e}")
+        finally:
+            beat.cancel()
+            self._running.pop(job_id, None)
+            self._notify(job_id)
+
+    async def _heartbeat(self, job_id: str, task: asyncio.Task) -> None:
+        while not task.done():
+            await asyncio.sleep(self.heartbeat_seconds)
+            if await run_blocking(self._heartbeat_sync, job_id):
+                task.cancel()  # cancelación pedida (quizá desde otro proceso)
+                return
@@ -0,0 +1,117 @@
+# llm_cache.py
+# Caché persistente de salidas del LLM para el wizard.
+# - Clave: sha256 de (sección, modelo, temperatura, hash del prompt completo, chunk_ids recuperados).
+#   Entradas byte-idénticas → mismo texto y mismas citas, sin volver a llamar al modelo.
+# - SQLite (WAL), compartida entre workers; evicción LRU por nº de entradas y por bytes.
+# - Sólo se guardan respuestas exitosas: errores y timeouts nunca quedan cacheados.
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+def cache_key(section: str, model: str, temperature: Any, prompt: str, chunk_ids: Sequence[str] = ()) -> str:
+    prompt_hash = hashlib.sha256((prompt or "").encode("utf-8")).hexdigest()
+    raw = json.dumps([section, model, temperature, prompt_hash, sorted(set(c for c in chunk_ids if c))])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMOutputCache:
+    def __init__(self, db_path: str, *, max_entries: int = 5000, max_bytes: int = 64 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bypassed": 0}
+
+    # ---------- SQLite ----------
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            d = os.path.dirname(self.db_path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    section TEXT NOT NULL,
+                    model TEXT,
+                    ai_text TEXT NOT NULL,
+                    citations_json TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        n, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM llm_cache").fetchone()
+        while n > self.max_entries or size > self.max_bytes:
+            # de a lotes: lo menos usado primero
+            batch = max(n - self.max_entries, 10)
+            rows = conn.execute("SELECT key, bytes FROM llm_cache ORDER BY last_used LIMIT ?", (batch,)).fetchall()
+            if not rows:
+                break
+            conn.executemany("DELETE FROM llm_cache WHERE key=?", [(k,) for k, _ in rows])
+            n -= len(rows)
+            size -= sum(b for _, b in rows)
+            self._stats["evictions"] += len(rows)
+
+    # ---------- API ----------
+    def get(self, key: str) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        with self._lock:
+            conn = self._db()
+            row = conn.execute("SELECT ai_text, citations_json FROM llm_cache WHERE key=?", (key,)).fetchone()
+            if not row:
+                self._stats["misses"] += 1
+                return None
+            conn.execute("UPDATE llm_cache SET last_used=? WHERE key=?", (time.time(), key))
+            conn.commit()
+            self._stats["hits"] += 1
+            return row[0], json.loads(row[1] or "[]")
+
+    def put(self, key: str, section: str, model: str, ai_text: str,
+            citations: Optional[List[Dict[str, Any]]] = None) -> None:
+        if not (ai_text or "").strip():
+            return
+        cites = json.dumps(citations or [], ensure_ascii=False)
+        size = len(ai_text.encode("utf-8")) + len(cites.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            conn.execute("""
+                INSERT OR REPLACE INTO llm_cache (key, section, model, ai_text, citations_json, bytes, created_at, last_used)
+                VALUES (?,?,?,?,?,?,?,?)
+            """, (key, section, model, ai_text, cites, size, now, now))
+            self._evict(conn)
+            conn.commit()
+            self._stats["stores"] += 1
+
+    def note_bypass(self) -> None:
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            n, size = self._db().execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM llm_cache").fetchone()
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                "entries": n,
+                "bytes": size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hit_rate": round(self._stats["hits"] / total, 4) if total else 0.0,
+                **self._stats,
+            }
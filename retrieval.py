@@ -0,0 +1,86 @@
+# retrieval.py
+# Recuperación en UNA sola pasada: embebe la consulta una vez, trae fetch_k candidatos
+# de Chroma (con sus vectores y distancias), aplica MMR en memoria y devuelve los docs
+# con su score real en metadata["score"] (misma escala que similarity_search_with_score).
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, List, Tuple
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores.utils import maximal_marginal_relevance
+from pydantic import PrivateAttr
+
+
+class ScoredMMRRetriever(BaseRetriever):
+    """
+    Reemplazo de `vectordb.as_retriever(search_type="mmr")` que conserva los scores.
+    - k: documentos devueltos
+    - fetch_k: candidatos traídos del índice sobre los que corre MMR
+    - lambda_mult: 1.0 = sólo relevancia, 0.0 = sólo diversidad
+    """
+
+    vectordb: Any
+    k: int = 6
+    fetch_k: int = 18
+    lambda_mult: float = 0.7
+    embed_cache_size: int = 256
+
+    _emb_cache: "OrderedDict[str, List[float]]" = PrivateAttr(default_factory=OrderedDict)
+    _emb_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def embed_query(self, query: str) -> List[float]:
+        """Embedding de la consulta con memo LRU (lo reutilizan la búsqueda y la caché de respuestas).
+        Se llama desde hilos del executor: el memo va bajo lock, el modelo fuera de él."""
+        with self._emb_lock:
+            hit = self._emb_cache.get(query)
+            if hit is not None:
+                self._emb_cache.move_to_end(query)
+                return hit
+        emb = list(self.vectordb.embeddings.embed_query(query))
+        with self._emb_lock:
+            self._emb_cache[query] = emb
+            self._emb_cache.move_to_end(query)
+            while len(self._emb_cache) > self.embed_cache_size:
+                self._emb_cache.popitem(last=False)
+        return emb
+
+    def search_with_scores(self, query: str) -> List[Tuple[Document, float]]:
+        if not (query or "").strip():
+            return []
+        emb = self.embed_query(query)
+        res = self.vectordb._collection.query(
+            query_embeddings=[emb],
+            n_results=max(self.k, self.fetch_k),
+            include=["documents", "metadatas", "distances", "embeddings"],
+        )
+        texts = (res.get("documents") or [[]])[0]
+        if not texts:
+            return []
+        metas = (res.get("metadatas") or [[]])[0]
+        dists = (res.get("distances") or [[]])[0]
+        vecs = (res.get("embeddings") or [[]])[0]
+
+        picked = maximal_marginal_relevance(
+            np.array(emb, dtype=np.float32),
+            list(vecs),
+            k=min(self.k, len(texts)),
+            lambda_mult=self.lambda_mult,
+        )
+        out: List[Tuple[Document, float]] = []
+        for i in picked:
+            score = float(dists[i])
+            meta = dict(metas[i] or {})
+            meta["score"] = score
+            out.append((Document(page_content=texts[i] or "", metadata=meta), score))
+        return out
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [d for d, _ in self.search_with_scores(query)]
@@ -0,0 +1,141 @@
+# rights_scan.py
+# Detector de derechos por léxico (RIGHTS_LEXICON de tutela.py) en una sola pasada.
+# - Plegado (minúsculas, sin tildes ni diacríticos) con str.translate y una tabla precalculada,
+#   en vez de normalizar NFKD carácter a carácter en cada llamada.
+# - Todas las palabras clave en UNA expresión: un trie convertido a regex (prefijos comunes
+#   factorizados), con bordes de palabra en ambos extremos y evaluado como lookahead en cada
+#   inicio de palabra. Así también salen las coincidencias solapadas ("agua potable" y "agua",
+#   "termino de 15 dias" y "termino"), igual que buscando patrón por patrón.
+# - scan() devuelve, por derecho, el nº de coincidencias y sus offsets sobre el texto ORIGINAL;
+#   rights() es la vía rápida (sólo nombres); scan_many() recorre miles de textos con el mismo
+#   autómata (analítica).
+
+from __future__ import annotations
+
+import re
+import unicodedata
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Tuple
+
+
+class _FoldTable(dict):
+    """code point -> texto plegado; lo que no está precalculado se calcula una vez y se guarda."""
+
+    def __missing__(self, cp: int) -> str:
+        out = "".join(c for c in unicodedata.normalize("NFKD", chr(cp).lower()) if not unicodedata.combining(c))
+        self[cp] = out
+        return out
+
+
+FOLD_TABLE = _FoldTable()
+for _cp in range(0x250):  # Latin-1 + Latin Extended A/B: todo el español sin pasar por __missing__
+    FOLD_TABLE[_cp]
+
+
+def fold(text: str) -> str:
+    """lower + quita acentos/diacríticos (mismo resultado que NFKD sin marcas combinantes)."""
+    return (text or "").translate(FOLD_TABLE)
+
+
+def _fold_offsets(text: str) -> List[int]:
+    """starts[i] = posición en el texto plegado donde empieza el carácter i (más centinela final)."""
+    return [0, *accumulate(len(FOLD_TABLE[ord(c)]) for c in text)]
+
+
+def _norm_keyword(kw: str) -> str:
+    return " ".join(fold(kw).split())
+
+
+def _trie_regex(words: Iterable[str]) -> str:
+    """Regex equivalente a la alternancia de `words`, factorizada por prefijos (más largo primero)."""
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: Dict[str, Any]) -> str:
+        alts = [(r"\s+" if ch == " " else re.escape(ch)) + emit(child)
+                for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body  # ? codicioso: prueba primero la palabra más larga
+
+    return emit(trie)
+
+
+class RightsMatcher:
+    def __init__(self, lexicon: Mapping[str, Iterable[str]]):
+        self.keyword_rights: Dict[str, Tuple[str, ...]] = {}
+        for right, kws in lexicon.items():
+            for kw in kws:
+                k = _norm_keyword(kw)
+                if k and right not in self.keyword_rights.get(k, ()):
+                    self.keyword_rights[k] = (*self.keyword_rights.get(k, ()), right)
+
+        # En cada inicio de palabra el lookahead da la clave MÁS LARGA; las más cortas que empiezan
+        # ahí son prefijos por palabras suyos y se precalculan.
+        self._prefixes: Dict[str, Tuple[str, ...]] = {
+            k: tuple(p for p in self.keyword_rights if k.startswith(p + " "))
+            for k in self.keyword_rights
+        }
+        self._implied: Dict[str, frozenset] = {
+            k: frozenset(r for kk in (k, *self._prefixes[k]) for r in self.keyword_rights[kk])
+            for k in self.keyword_rights
+        }
+        self.pattern = re.compile(r"\b(?=(" + _trie_regex(self.keyword_rights) + r")\b)")
+
+    # ---------- vía rápida ----------
+    def rights(self, text: str) -> List[str]:
+        """Derechos detectados, ordenados (nombres de clave del léxico)."""
+        if not text:
+            return []
+        found: set = set()
+        for m in self.pattern.finditer(fold(text)):
+            found |= self._implied[" ".join(m.group(1).split())]
+        return sorted(found)
+
+    # ---------- con offsets ----------
+    def _hits(self, folded: str) -> Iterator[Tuple[str, int, int]]:
+        """(clave, inicio, fin) sobre el texto plegado, incluidos los prefijos solapados."""
+        for m in self.pattern.finditer(folded):
+            matched = m.group(1)
+            key = " ".join(matched.split())
+            start = m.start(1)
+            yield key, start, m.end(1)
+            if self._prefixes[key]:
+                ends = [t.end() for t in re.finditer(r"\S+", matched)]
+                for p in self._prefixes[key]:
+                    yield p, start, start + ends[p.count(" ")]
+
+    def scan(self, text: str, offsets: bool = True) -> Dict[str, Dict[str, Any]]:
+        """
+        {derecho: {"count": n, "matches": [{"keyword", "start", "end"}]}} — offsets sobre `text`
+        (no sobre el texto plegado). Con offsets=False sólo cuenta.
+        """
+        out: Dict[str, Dict[str, Any]] = {}
+        if not text:
+            return out
+        folded = fold(text)
+        starts = None
+        if offsets and not (text.isascii() and len(folded) == len(text)):
+            starts = _fold_offsets(text)
+        for key, fs, fe in self._hits(folded):
+            if offsets:
+                if starts is not None:  # el plegado quitó/añadió caracteres: se traducen los offsets
+                    fs, fe = bisect_right(starts, fs) - 1, bisect_right(starts, fe) - 1
+                hit = {"keyword": key, "start": fs, "end": fe}
+            for right in self.keyword_rights[key]:
+                slot = out.setdefault(right, {"count": 0, "matches": []} if offsets else {"count": 0})
+                slot["count"] += 1
+                if offsets:
+                    slot["matches"].append(hit)
+        return dict(sorted(out.items()))
+
+    def scan_many(self, texts: Iterable[str], offsets: bool = False) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """scan() de cada texto, perezoso (sirve para recorrer un cursor de miles de casos)."""
+        for text in texts:
+            yield self.scan(text, offsets=offsets)
@@ -0,0 +1,290 @@
+# runtime.py
+# Ciclo de vida de los modelos compartidos (embeddings, Chroma, LLM).
+# - Nada pesado se importa al cargar el módulo: langchain/torch se importan dentro de load().
+# - El servidor abre el puerto de inmediato; un warm-up en segundo plano carga los modelos,
+#   embebe una consulta de prueba, toca Chroma y verifica el endpoint del LLM.
+# - /readyz expone el estado de cada componente por separado; /healthz sólo dice "vivo".
+# - Los routers reciben proxies (LazyRetriever/LazyLLM/LazyVectorDB): las llamadas que llegan
+#   antes de terminar el warm-up esperan hasta READY_TIMEOUT y luego responden 503.
+# - Si embeddings/Chroma fallan (modelo aún descargándose, índice bloqueado) se reintentan con
+#   backoff exponencial desde /readyz y desde las llamadas que los necesitan.
+
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+import time
+import urllib.request
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+COMPONENTS = ("embeddings", "chroma", "llm")
+
+
+class ModelRuntime:
+    def __init__(
+        self,
+        *,
+        persist_dir: str,
+        embedding_model: str,
+        top_k: int,
+        llm_model: str,
+        llm_api_base: str,
+        llm_api_key: str,
+        llm_temperature: float,
+        max_tokens: int,
+        warmup_query: str = "acción de tutela derecho fundamental",
+        ready_timeout: float = 60.0,
+    ):
+        self.persist_dir = persist_dir
+        self.embedding_model = embedding_model
+        self.top_k = top_k
+        self.llm_model = llm_model
+        self.llm_api_base = llm_api_base.rstrip("/")
+        self.llm_api_key = llm_api_key
+        self.llm_temperature = llm_temperature
+        self.max_tokens = max_tokens
+        self.warmup_query = warmup_query
+        self.ready_timeout = ready_timeout
+
+        self.embeddings: Any = None
+        self.vectordb: Any = None
+        self.retriever: Any = None
+        self.llm: Any = None
+
+        # componente -> {"state": pending|loading|ready|error, "seconds", "error", ...}
+        self.status: Dict[str, Dict[str, Any]] = {c: {"state": "pending"} for c in COMPONENTS}
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._llm_probed_at = 0.0
+        self.llm_reprobe_seconds = 10.0
+        self.warmup_seconds: Optional[float] = None
+        self.retry_base_seconds = 10.0
+        self.retry_max_seconds = 300.0
+        self._retry_delay = self.retry_base_seconds
+        self._retry_at = 0.0
+
+    # ---------- carga ----------
+    def _step(self, name: str, fn: Callable[[], Dict[str, Any]]) -> bool:
+        self.status[name] = {"state": "loading"}
+        t0 = time.perf_counter()
+        try:
+            extra = fn() or {}
+        except Exception as e:
+            self.status[name] = {"state": "error", "error": f"{type(e).__name__}: {e}",
+                                 "seconds": round(time.perf_counter() - t0, 3)}
+            return False
+        self.status[name] = {"state": "ready", "seconds": round(time.perf_counter() - t0, 3), **extra}
+        return True
+
+    def _load_embeddings(self) -> Dict[str, Any]:
+        from langchain_huggingface import HuggingFaceEmbeddings
+        from embedding_cache import with_embedding_cache
+
+        # Deben coincidir con ingest.py (misma caché en disco que la ingesta)
+        emb = with_embedding_cache(HuggingFaceEmbeddings(model_name=self.embedding_model), self.embedding_model)
+        vec = emb.embed_query(self.warmup_query)  # fuerza la carga real del modelo
+        self.embeddings = emb
+        return {"model": self.embedding_model, "dim": len(vec)}
+
+    def _load_chroma(self) -> Dict[str, Any]:
+        from langchain_chroma import Chroma
+        from retrieval import ScoredMMRRetriever
+
+        vectordb = Chroma(embedding_function=self.embeddings, persist_directory=self.persist_dir)
+        # Una sola pasada (1 embedding + 1 query) y cada doc trae su score en metadata["score"].
+        retriever = ScoredMMRRetriever(
+            vectordb=vectordb,
+            k=self.top_k,
+            fetch_k=max(12, self.top_k * 3),
+            lambda_mult=0.7,
+        )
+        count = vectordb._collection.count()
+        if count:
+            retriever.search_with_scores(self.warmup_query)  # calienta el índice HNSW
+        self.vectordb, self.retriever = vectordb, retriever
+        return {"persist_dir": self.persist_dir, "chunks": count}
+
+    def _load_llm(self) -> Dict[str, Any]:
+        from langchain_openai import ChatOpenAI
+
+        # LLM (LM Studio / OpenAI-compatible)
+        self.llm = ChatOpenAI(
+            model=self.llm_model,
+            openai_api_base=self.llm_api_base,
+            openai_api_key=self.llm_api_key,
+            temperature=self.llm_temperature,
+            max_tokens=self.max_tokens,
+        )
+        return self._probe_llm()
+
+    def _probe_llm(self) -> Dict[str, Any]:
+        """Comprobación barata del endpoint OpenAI-compatible (GET /models, sin generar tokens)."""
+        self._llm_probed_at = time.monotonic()
+        req = urllib.request.Request(
+            f"{self.llm_api_base}/models",
+            headers={"Authorization": f"Bearer {self.llm_api_key}"},
+        )
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            models = [m.get("id") for m in (json.loads(resp.read() or b"{}").get("data") or [])]
+        return {"model": self.llm_model, "endpoint": self.llm_api_base, "model_listed": self.llm_model in models}
+
+    def _load_index(self) -> None:
+        """Embeddings + Chroma (lo que falte); si algo falla agenda el siguiente reintento."""
+        if self.embeddings is None and not self._step("embeddings", self._load_embeddings):
+            self.status["chroma"] = {"state": "error", "error": "embeddings no disponibles"}
+        elif self._step("chroma", self._load_chroma):
+            self._retry_delay = self.retry_base_seconds
+            return
+        self._retry_at = time.monotonic() + self._retry_delay
+        self._retry_delay = min(self._retry_delay * 2, self.retry_max_seconds)
+
+    def _retry_index(self) -> None:
+        """Reintenta embeddings/Chroma caídos si ya venció el backoff (bloqueante)."""
+        if not self._loaded.is_set() or self.retriever is not None or time.monotonic() < self._retry_at:
+            return
+        if not self._lock.acquire(blocking=False):
+            return  # otro hilo ya está reintentando
+        try:
+            if self.retriever is None and time.monotonic() >= self._retry_at:
+                self._load_index()
+        finally:
+            self._lock.release()
+
+    def load(self) -> None:
+        """Carga bloqueante de todos los componentes (idempotente)."""
+        with self._lock:
+            if self._loaded.is_set():
+                return
+            t0 = time.perf_counter()
+            self._load_index()
+            # El cliente del LLM se crea aunque el endpoint no responda: /readyz lo re-sondea.
+            self._step("llm", self._load_llm)
+            self.warmup_seconds = round(time.perf_counter() - t0, 3)
+            self._loaded.set()
+
+    def start(self) -> None:
+        """Lanza el warm-up en segundo plano (desde el lifespan de la app)."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(asyncio.to_thread(self.load))
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout=5)
+            except Exception:
+                pass
+
+    # ---------- acceso ----------
+    def _unavailable(self, name: str) -> HTTPException:
+        st = self.status.get(name, {})
+        if st.get("state") == "error":
+            return HTTPException(503, f"Componente '{name}' no disponible: {st.get('error')}")
+        return HTTPException(503, f"Modelos cargando ('{name}'); reintenta en unos segundos.")
+
+    def require(self, name: str, attr: str) -> Any:
+        """Versión bloqueante (hilos): espera el warm-up hasta ready_timeout."""
+        if self._task is None and not self._loaded.is_set():
+            self.load()  # sin lifespan (scripts, tests): carga en línea
+        self._loaded.wait(self.ready_timeout)
+        if name != "llm":
+            self._retry_index()
+        obj = getattr(self, attr)
+        if obj is None:
+            raise self._unavailable(name)
+        return obj
+
+    async def arequire(self, name: str, attr: str) -> Any:
+        obj = getattr(self, attr)
+        if obj is not None:
+            return obj
+        if self._task is None:
+            self.start()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=self.ready_timeout)
+        except asyncio.TimeoutError:
+            pass
+        if name != "llm" and getattr(self, attr) is None:
+            await asyncio.to_thread(self._retry_index)
+        obj = getattr(self, attr)
+        if obj is None:
+            raise self._unavailable(name)
+        return obj
+
+    def readiness(self) -> Dict[str, Any]:
+        """Bloqueante (puede re-sondear el LLM): llamar vía run_blocking."""
+        if (self.llm is not None and self.status["llm"].get("state") == "error"
+                and time.monotonic() - self._llm_probed_at > self.llm_reprobe_seconds):
+            self._step("llm", self._probe_llm)
+        self._retry_index()
+        # El LLM puede estar caído sin que el índice lo esté: ready exige los tres.
+        ready = all(self.status[c].get("state") == "ready" for c in COMPONENTS)
+        body = {"ready": ready, "warmup_done": self._loaded.is_set(),
+                "warmup_seconds": self.warmup_seconds, "components": self.status}
+        if self._loaded.is_set() and self.retriever is None:
+            body["index_retry_in_s"] = round(max(0.0, self._retry_at - time.monotonic()), 1)
+        return body
+
+
+# =========================
+# Proxies para los routers
+# =========================
+class LazyRetriever:
+    """Expone la API que usan advisor/tutela; el retriever real se resuelve tras el warm-up."""
+
+    def __init__(self, rt: ModelRuntime):
+        self._rt = rt
+
+    async def ainvoke(self, query: str) -> List[Any]:
+        r = await self._rt.arequire("chroma", "retriever")
+        return await r.ainvoke(query)
+
+    def invoke(self, query: str) -> List[Any]:
+        return self._rt.require("chroma", "retriever").invoke(query)
+
+    def embed_query(self, query: str) -> List[float]:
+        return self._rt.require("chroma", "retriever").embed_query(query)
+
+    def search_with_scores(self, query: str):
+        return self._rt.require("chroma", "retriever").search_with_scores(query)
+
+
+class LazyVectorDB:
+    def __init__(self, rt: ModelRuntime):
+        self._rt = rt
+
+    @property
+    def embeddings(self) -> Any:
+        return self._rt.require("embeddings", "embeddings")
+
+    def similarity_search_with_score(self, query: str, k: int = 4):
+        return self._rt.require("chroma", "vectordb").similarity_search_with_score(query, k=k)
+
+
+class LazyLLM:
+    def __init__(self, rt: ModelRuntime):
+        self._rt = rt
+
+    # Identidad del modelo sin forzar la carga (claves de caché)
+    @property
+    def model_name(self) -> str:
+        return self._rt.llm_model
+
+    @property
+    def temperature(self) -> float:
+        return self._rt.llm_temperature
+
+    async def ainvoke(self, prompt: Any) -> Any:
+        llm = await self._rt.arequire("llm", "llm")
+        return await llm.ainvoke(prompt)
+
+    async def astream(self, prompt: Any) -> AsyncIterator[Any]:
+        llm = await self._rt.arequire("llm", "llm")
+        async for chunk in llm.astream(prompt):
+            yield chunk
+
+    def invoke(self, prompt: Any) -> Any:
+        return self._rt.require("llm", "llm").invoke(prompt)
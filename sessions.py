@@ -0,0 +1,249 @@
+# sessions.py
+# Almacén de sesiones del asesor: caché en memoria acotada (LRU por nº de sesiones y bytes,
+# TTL por inactividad) con escritura inmediata (write-through) en SQLite.
+# - Sobrevive reinicios y permite varios workers de uvicorn sobre el mismo archivo .db.
+# - Cada escritura incrementa 'rev' y es condicional a la revisión leída: si otro proceso
+#   escribió entre medias, `update` relee del disco y reaplica el cambio (no se pierden turnos).
+# - Un acierto en memoria sólo consulta la revisión en disco (SELECT rev por clave primaria):
+#   si otro worker escribió, se relee; el historial en caché nunca llega viejo al prompt.
+# - El TTL se mide desde el último acceso, que se persiste de forma perezosa (como mucho una
+#   escritura por sesión cada `touch_every` s).
+
+from __future__ import annotations
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class SessionConflict(Exception):
+    """Otro proceso escribió la sesión después de la revisión que se leyó."""
+
+
+class SessionStore:
+    def __init__(
+        self,
+        db_path: str,
+        *,
+        max_sessions: int = 1000,
+        max_bytes: int = 32 * 1024 * 1024,
+        ttl_seconds: int = 6 * 3600,
+        purge_every: int = 300,
+        touch_every: int = 60,
+    ):
+        self.db_path = db_path
+        self.max_sessions = max(1, max_sessions)
+        self.max_bytes = max(1, max_bytes)
+        self.ttl_seconds = ttl_seconds
+        self.purge_every = purge_every
+        self.touch_every = touch_every
+
+        # sid -> (rev, data, bytes, last_access, last_touch_persisted)
+        self._mem: "OrderedDict[str, Tuple[int, Dict[str, Any], int, float, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_purge = 0.0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "conflicts": 0}
+
+    # ---------- SQLite ----------
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            d = os.path.dirname(self.db_path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS advisor_sessions (
+                    id TEXT PRIMARY KEY,
+                    rev INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL DEFAULT 0
+                )""")
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(advisor_sessions)")}
+            if "accessed_at" not in cols:
+                conn.execute("ALTER TABLE advisor_sessions ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE advisor_sessions SET accessed_at=updated_at")
+            conn.execute("DROP INDEX IF EXISTS idx_advisor_sessions_updated")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_advisor_sessions_accessed ON advisor_sessions(accessed_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    # ---------- Memoria (LRU) ----------
+    def _mem_drop(self, sid: str) -> None:
+        item = self._mem.pop(sid, None)
+        if item:
+            self._bytes -= item[2]
+
+    def _mem_put(self, sid: str, rev: int, data: Dict[str, Any], size: int, touched: float) -> None:
+        self._mem_drop(sid)
+        self._mem[sid] = (rev, data, size, time.time(), touched)
+        self._bytes += size
+        while self._mem and (len(self._mem) > self.max_sessions or self._bytes > self.max_bytes):
+            old_sid, _ = next(iter(self._mem.items()))
+            self._mem_drop(old_sid)
+            self._stats["evictions"] += 1  # sólo sale de memoria; sigue en disco
+
+    def _expired(self, last_access: float) -> bool:
+        return bool(self.ttl_seconds) and (time.time() - last_access) > self.ttl_seconds
+
+    def _touch(self, sid: str) -> None:
+        """Actualiza el último acceso en memoria y, como mucho cada touch_every s, en disco."""
+        rev, data, size, _, touched = self._mem[sid]
+        now = time.time()
+        if now - touched > self.touch_every:
+            conn = self._db()
+            conn.execute("UPDATE advisor_sessions SET accessed_at=? WHERE id=?", (now, sid))
+            conn.commit()
+            touched = now
+        self._mem[sid] = (rev, data, size, now, touched)
+        self._mem.move_to_end(sid)
+
+    def _load(self, sid: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        row = self._db().execute(
+            "SELECT rev, data, accessed_at FROM advisor_sessions WHERE id=?", (sid,)
+        ).fetchone()
+        if not row:
+            self._mem_drop(sid)
+            return None
+        rev, raw, accessed_at = row
+        if self._expired(accessed_at):
+            self.delete(sid)
+            self._stats["expirations"] += 1
+            return None
+        data = json.loads(raw)
+        self._mem_put(sid, rev, data, len(raw.encode("utf-8")), accessed_at)
+        self._touch(sid)
+        return rev, data
+
+    # ---------- API ----------
+    def get_entry(self, sid: str, *, fresh: bool = False) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """(rev, copia de los datos) o None. Un acierto en memoria sólo compara la revisión
+        en disco (y persiste el último acceso); `fresh=True` fuerza la relectura completa."""
+        if not sid:
+            return None
+        with self._lock:
+            cached = None if fresh else self._mem.get(sid)
+            if cached:
+                row = self._db().execute("SELECT rev FROM advisor_sessions WHERE id=?", (sid,)).fetchone()
+                if self._expired(cached[3]) or row is None or row[0] != cached[0]:
+                    # Caducada aquí (otro worker puede seguir usándola), borrada o reescrita por otro
+                    # proceso: manda el disco
+                    self._mem_drop(sid)
+                else:
+                    self._touch(sid)
+                    self._stats["hits"] += 1
+                    return cached[0], copy.deepcopy(cached[1])
+            self._stats["misses"] += 1
+            entry = self._load(sid)
+            return (entry[0], copy.deepcopy(entry[1])) if entry else None
+
+    def get(self, sid: str) -> Optional[Dict[str, Any]]:
+        entry = self.get_entry(sid)
+        return entry[1] if entry else None
+
+    def put(self, sid: str, data: Dict[str, Any], expected_rev: Optional[int] = None) -> int:
+        """Escribe la sesión y devuelve su nueva revisión. Con `expected_rev` la escritura sólo
+        se aplica si la revisión en disco sigue siendo esa; si no, lanza SessionConflict."""
+        raw = json.dumps(data, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            if expected_rev is None:
+                conn.execute("""
+                    INSERT INTO advisor_sessions (id, rev, data, updated_at, accessed_at) VALUES (?,1,?,?,?)
+                    ON CONFLICT(id) DO UPDATE SET rev=rev+1, data=excluded.data,
+                        updated_at=excluded.updated_at, accessed_at=excluded.accessed_at
+                """, (sid, raw, now, now))
+                rev = conn.execute("SELECT rev FROM advisor_sessions WHERE id=?", (sid,)).fetchone()[0]
+            else:
+                cur = conn.execute(
+                    "UPDATE advisor_sessions SET rev=rev+1, data=?, updated_at=?, accessed_at=? WHERE id=? AND rev=?",
+                    (raw, now, now, sid, expected_rev),
+                )
+                if cur.rowcount == 0:
+                    conn.commit()
+                    self._mem_drop(sid)
+                    self._stats["conflicts"] += 1
+                    raise SessionConflict(sid)
+                rev = expected_rev + 1
+            conn.commit()
+            self._mem_put(sid, rev, copy.deepcopy(data), len(raw.encode("utf-8")), now)
+            if now - self._last_purge > self.purge_every:
+                self.purge_expired()
+            return rev
+
+    def update(self, sid: str, mutate: Callable[[Dict[str, Any]], None], retries: int = 5) -> Optional[Dict[str, Any]]:
+        """Lee, aplica `mutate` sobre una copia y escribe condicionado a la revisión leída.
+        Si otro proceso escribió antes, relee del disco y reaplica `mutate` sobre lo último.
+        Devuelve los datos guardados, o None si la sesión ya no existe."""
+        fresh = False
+        for _ in range(max(1, retries)):
+            entry = self.get_entry(sid, fresh=fresh)
+            if entry is None:
+                return None
+            rev, data = entry
+            mutate(data)
+            try:
+                self.put(sid, data, expected_rev=rev)
+                return data
+            except SessionConflict:
+                fresh = True
+        raise SessionConflict(sid)
+
+    def delete(self, sid: str) -> None:
+        with self._lock:
+            self._mem_drop(sid)
+            conn = self._db()
+            conn.execute("DELETE FROM advisor_sessions WHERE id=?", (sid,))
+            conn.commit()
+
+    def purge_expired(self) -> int:
+        """Elimina (memoria y disco) las sesiones sin acceso más allá del TTL."""
+        if not self.ttl_seconds:
+            return 0
+        with self._lock:
+            self._last_purge = time.time()
+            cutoff = self._last_purge - self.ttl_seconds
+            conn = self._db()
+            # El acceso en disco puede ir hasta touch_every s por detrás del de memoria:
+            # lo vivo en memoria se persiste antes de purgar.
+            for sid, item in list(self._mem.items()):
+                if item[3] >= cutoff and item[4] < cutoff:
+                    conn.execute("UPDATE advisor_sessions SET accessed_at=? WHERE id=?", (item[3], sid))
+                    self._mem[sid] = item[:4] + (item[3],)
+            cur = conn.execute("DELETE FROM advisor_sessions WHERE accessed_at < ?", (cutoff,))
+            conn.commit()
+            for sid in [s for s, item in self._mem.items() if item[3] < cutoff]:
+                self._mem_drop(sid)
+            n = cur.rowcount or 0
+            self._stats["expirations"] += n
+            return n
+
+    def __contains__(self, sid: str) -> bool:
+        return self.get(sid) is not None
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            persisted, persisted_bytes = self._db().execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM advisor_sessions"
+            ).fetchone()
+            return {
+                "live_sessions": len(self._mem),
+                "bytes_retained": self._bytes,
+                "persisted_sessions": persisted,
+                "persisted_bytes": persisted_bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                **self._stats,
+            }
@@ -0,0 +1,98 @@
+# single_flight.py
+# Coalescencia "single-flight" de trabajos async idénticos dentro del proceso.
+# - Una clave (p. ej. caso + sección) tiene a lo sumo UN trabajo en curso; quien llega mientras
+#   corre con la misma etiqueta (mismas entradas) se une y recibe el mismo resultado o error.
+# - Etiqueta distinta (el usuario cambió el texto entre medio): espera a que termine el vuelo
+#   actual y arranca el suyo; nunca corren dos a la vez para la misma clave.
+# - El trabajo corre como tarea propia: si el cliente que lo inició se desconecta, los demás
+#   siguen esperando y el resultado se guarda igual.
+# - Estado en memoria del event loop: con varios workers cada proceso coalesce lo suyo.
+
+from __future__ import annotations
+
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class Flight:
+    __slots__ = ("key", "tag", "id", "task", "started_at", "waiters")
+
+    def __init__(self, key: Hashable, tag: Any, task: "Optional[asyncio.Task[Any]]"):
+        self.key = key
+        self.tag = tag
+        self.id = uuid.uuid4().hex[:12]
+        self.task = task
+        self.started_at = time.time()
+        self.waiters = 1
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "flight_id": self.id,
+            "started_at": self.started_at,
+            "elapsed_s": round(time.time() - self.started_at, 3),
+            "waiters": self.waiters,
+        }
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+        self._stats = {"started": 0, "joined": 0, "queued": 0, "failed": 0}
+
+    def get(self, key: Hashable) -> Optional[Flight]:
+        """Vuelo en curso para `key` (None si no hay)."""
+        return self._flights.get(key)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]], *, tag: Any = None) -> Any:
+        """Resultado de `fn()`; si ya hay un vuelo con la misma clave y etiqueta, el de ese vuelo."""
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                break
+            if flight.tag == tag:
+                flight.waiters += 1
+                self._stats["joined"] += 1
+                return await asyncio.shield(flight.task)
+            self._stats["queued"] += 1
+            await asyncio.wait({flight.task})  # su resultado no sirve: sólo se espera el turno
+
+        return await asyncio.shield(self._launch(key, tag, lambda flight: fn()).task)
+
+    def start(self, key: Hashable, fn: Callable[[Flight], Awaitable[Any]]) -> Optional[Flight]:
+        """
+        Sin await: registra y lanza `fn(flight)` si `key` está libre; None si ya hay un vuelo.
+        Consultar y registrar en el mismo paso del loop evita que dos peticiones simultáneas
+        arranquen dos trabajos. `fn` puede fijar `flight.tag` cuando conozca sus entradas;
+        hasta entonces quien llegue por do() no se une (espera su turno).
+        """
+        if key in self._flights:
+            return None
+        return self._launch(key, None, fn)
+
+    def _launch(self, key: Hashable, tag: Any, fn: Callable[[Flight], Awaitable[Any]]) -> Flight:
+        flight = Flight(key, tag, None)
+        flight.task = asyncio.get_running_loop().create_task(fn(flight))
+        self._flights[key] = flight
+        self._stats["started"] += 1
+        flight.task.add_done_callback(lambda t: self._done(flight))
+        return flight
+
+    async def wait(self, key: Hashable, timeout: Optional[float] = None) -> bool:
+        """Espera (sin unirse ni cancelar) a que termine el vuelo de `key`; False si sigue en curso."""
+        flight = self._flights.get(key)
+        if flight is None:
+            return True
+        done, _ = await asyncio.wait({flight.task}, timeout=timeout)
+        return bool(done)
+
+    def _done(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        # Recupera la excepción: si todos los que esperaban se fueron, no queda "never retrieved"
+        if not flight.task.cancelled() and flight.task.exception() is not None:
+            self._stats["failed"] += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._flights), **self._stats}
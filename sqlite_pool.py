@@ -0,0 +1,192 @@
+# sqlite_pool.py
+# Capa de conexiones SQLite para el almacén del wizard (tutela.py).
+# - Una conexión por hilo y por archivo (thread-local): los hilos de executors.BLOCKING_POOL
+#   la reutilizan entre peticiones en vez de abrir/cerrar el archivo en cada handler.
+# - WAL (lectores no bloquean al escritor), synchronous=NORMAL, caché de páginas, mmap y
+#   busy_timeout: las escrituras concurrentes esperan su turno en vez de "database is locked".
+# - Liberación garantizada: al salir de acquire() cualquier transacción abierta se deshace
+#   (error o falta de commit), igual que antes al cerrar la conexión.
+# - Unidad de trabajo: dentro de conn.unit_of_work() los commit() de los helpers se difieren
+#   y todo se escribe con un único BEGIN IMMEDIATE … COMMIT (o nada, si algo falla).
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "15000"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper()
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))              # por conexión
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+
+
+class StoreConnection(sqlite3.Connection):
+    """sqlite3.Connection con unidad de trabajo anidable."""
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._uow_depth = 0
+
+    @property
+    def in_unit_of_work(self) -> bool:
+        return self._uow_depth > 0
+
+    def commit(self) -> None:
+        if self._uow_depth:
+            return  # lo confirma el unit_of_work() más externo
+        super().commit()
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator["StoreConnection"]:
+        """
+        Transacción de escritura: BEGIN IMMEDIATE toma el lock al inicio (sin carreras de
+        lectura→escritura), un solo COMMIT al final, ROLLBACK si hay excepción. Anidada, se une
+        a la transacción externa.
+        """
+        if self._uow_depth:
+            self._uow_depth += 1
+            try:
+                yield self
+            finally:
+                self._uow_depth -= 1
+            return
+        if self.in_transaction:
+            super().commit()  # cierra lo que hubiera quedado implícito antes de empezar
+        self.execute("BEGIN IMMEDIATE")
+        self._uow_depth = 1
+        try:
+            yield self
+        except BaseException:
+            self._uow_depth = 0
+            self.rollback()
+            raise
+        self._uow_depth = 0
+        super().commit()
+
+
+def connect(db_path: str) -> StoreConnection:
+    """Conexión nueva con los PRAGMA del almacén (filas como sqlite3.Row)."""
+    d = os.path.dirname(db_path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           factory=StoreConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{max(0, SQLITE_CACHE_KB)}")
+    conn.execute(f"PRAGMA mmap_size={max(0, SQLITE_MMAP_BYTES)}")
+    conn.execute(f"PRAGMA busy_timeout={max(0, SQLITE_BUSY_TIMEOUT_MS)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    """Conexiones thread-local a un archivo; el tamaño lo acota el nº de hilos que lo usan."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all: Dict[int, StoreConnection] = {}   # ident del hilo -> conexión
+        self._stats = {"opened": 0, "acquires": 0, "rollbacks": 0, "reconnects": 0}
+
+    def _prune(self) -> None:
+        """Cierra las conexiones de hilos que ya terminaron (hilos efímeros fuera del pool)."""
+        alive = {t.ident for t in threading.enumerate()}
+        for ident in [i for i in self._all if i not in alive]:
+            try:
+                self._all.pop(ident).close()
+            except sqlite3.Error:
+                pass
+
+    def _open(self) -> StoreConnection:
+        conn = connect(self.db_path)
+        with self._lock:
+            self._prune()
+            self._all[threading.get_ident()] = conn
+            self._stats["opened"] += 1
+        self._local.conn = conn
+        self._local.depth = 0
+        return conn
+
+    def _discard(self, conn: StoreConnection) -> None:
+        with self._lock:
+            if self._all.get(threading.get_ident()) is conn:
+                del self._all[threading.get_ident()]
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._local.conn = None
+
+    def _current(self) -> StoreConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return self._open()
+        try:
+            conn.execute("SELECT 1")
+        except sqlite3.ProgrammingError:  # cerrada (close_all) o inservible: se reabre
+            self._discard(conn)
+            self._stats["reconnects"] += 1
+            return self._open()
+        return conn
+
+    @contextmanager
+    def acquire(self) -> Iterator[StoreConnection]:
+        """
+        Conexión del hilo actual. Reentrante: un acquire() anidado comparte conexión y sólo el
+        más externo limpia. Al salir no queda ninguna transacción abierta.
+        """
+        depth = getattr(self._local, "depth", 0)
+        conn = self._current() if depth == 0 else self._local.conn
+        self._local.depth = depth + 1
+        self._stats["acquires"] += 1
+        try:
+            yield conn
+        finally:
+            self._local.depth = depth
+            if depth == 0 and conn.in_transaction:
+                try:
+                    conn.rollback()
+                    self._stats["rollbacks"] += 1
+                except sqlite3.Error:
+                    self._discard(conn)
+
+    def close_all(self) -> None:
+        with self._lock:
+            conns, self._all = list(self._all.values()), {}
+        for c in conns:
+            try:
+                c.close()
+            except sqlite3.Error:
+                pass
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"db_path": self.db_path, "open": len(self._all), **self._stats}
+
+
+_POOLS: Dict[str, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """Un pool por archivo (ruta absoluta) y por proceso."""
+    key = os.path.abspath(db_path)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = ConnectionPool(db_path)
+        return pool
+
+
+def close_all() -> None:
+    """Cierra todas las conexiones (apagado de la app)."""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    for p in pools:
+        p.close_all()
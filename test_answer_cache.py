@@ -0,0 +1,99 @@
+import os
+import sqlite3
+
+import pytest
+
+from answer_cache import SemanticAnswerCache, chroma_fingerprint, context_digest
+
+CITES = [{"source": "Decreto_2591_de_1991.pdf", "page": 1}]
+
+
+@pytest.fixture
+def chroma_dir(tmp_path):
+    """chroma.sqlite3 mínimo con las tablas que mira la huella."""
+    d = tmp_path / "chroma"
+    d.mkdir()
+    conn = sqlite3.connect(d / "chroma.sqlite3")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE collections (id TEXT PRIMARY KEY, name TEXT);
+        CREATE TABLE max_seq_id (segment_id TEXT PRIMARY KEY, seq_id INTEGER);
+        CREATE TABLE embeddings_queue (seq_id INTEGER PRIMARY KEY, id TEXT);
+        INSERT INTO collections VALUES ('c1', 'langchain');
+        INSERT INTO embeddings_queue (id) VALUES ('chunk-1');
+        INSERT INTO max_seq_id VALUES ('s1', 1);
+    """)
+    conn.commit()
+    yield str(d), conn
+    conn.close()
+
+
+def _add_chunk(conn, seq):
+    conn.execute("INSERT INTO embeddings_queue (id) VALUES (?)", (f"chunk-{seq}",))
+    conn.execute("UPDATE max_seq_id SET seq_id=?", (seq,))
+    conn.commit()
+
+
+def _cache(tmp_path, persist_dir, **kw):
+    kw.setdefault("index_check_every", 0)
+    return SemanticAnswerCache(os.path.join(tmp_path, "answers.db"), persist_dir=persist_dir, **kw)
+
+
+def test_hit_needs_similar_question_and_same_chunks(tmp_path, chroma_dir):
+    cache = _cache(tmp_path, chroma_dir[0], threshold=0.95)
+    cache.store([1.0, 0.0], ["c1", "c2"], "respuesta", CITES)
+    assert cache.lookup([0.99, 0.05], ["c2", "c1"]) == ("respuesta", CITES)
+    assert cache.lookup([0.0, 1.0], ["c1", "c2"]) is None  # pregunta distinta
+    assert cache.lookup([1.0, 0.0], ["c1"]) is None  # otros chunks
+
+
+def test_history_context_is_part_of_the_key(tmp_path, chroma_dir):
+    cache = _cache(tmp_path, chroma_dir[0])
+    ctx = context_digest("user: ¿y si es urgente?")
+    cache.store([1.0, 0.0], ["c1"], "con historial", CITES, context=ctx)
+    assert cache.lookup([1.0, 0.0], ["c1"]) is None
+    assert cache.lookup([1.0, 0.0], ["c1"], context=ctx)[0] == "con historial"
+
+
+def test_entries_survive_restart(tmp_path, chroma_dir):
+    _cache(tmp_path, chroma_dir[0]).store([1.0, 0.0], ["c1"], "persistida", CITES)
+    assert _cache(tmp_path, chroma_dir[0]).lookup([1.0, 0.0], ["c1"])[0] == "persistida"
+
+
+def test_reindex_invalidates(tmp_path, chroma_dir):
+    persist_dir, conn = chroma_dir
+    cache = _cache(tmp_path, persist_dir)
+    cache.store([1.0, 0.0], ["c1"], "vieja", CITES)
+    _add_chunk(conn, 2)
+    assert cache.lookup([1.0, 0.0], ["c1"]) is None
+    assert cache.metrics()["invalidations"] == 1
+    assert _cache(tmp_path, persist_dir, index_check_every=3600).lookup([1.0, 0.0], ["c1"]) is None
+
+
+def test_wal_checkpoint_does_not_invalidate(tmp_path, chroma_dir):
+    persist_dir, conn = chroma_dir
+    before = chroma_fingerprint(persist_dir)
+    _add_chunk(conn, 2)
+    after_write = chroma_fingerprint(persist_dir)  # la escritura sigue en el -wal
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    assert after_write != before
+    assert chroma_fingerprint(persist_dir) == after_write
+
+
+def test_index_check_is_throttled(tmp_path, chroma_dir):
+    persist_dir, conn = chroma_dir
+    cache = _cache(tmp_path, persist_dir, index_check_every=3600)
+    cache.store([1.0, 0.0], ["c1"], "respuesta", CITES)
+    _add_chunk(conn, 2)
+    assert cache.lookup([1.0, 0.0], ["c1"]) is not None  # aún no se volvió a mirar el índice
+
+
+def test_lru_bound(tmp_path, chroma_dir):
+    cache = _cache(tmp_path, chroma_dir[0], max_entries=2)
+    for i in range(3):
+        cache.store([1.0, 0.0], [f"c{i}"], f"r{i}", CITES)
+    assert cache.lookup([1.0, 0.0], ["c0"]) is None
+    assert cache.metrics()["evictions"] == 1
+    reopened = _cache(tmp_path, chroma_dir[0], max_entries=2)
+    assert reopened.lookup([1.0, 0.0], ["c0"]) is None
+    assert reopened.lookup([1.0, 0.0], ["c2"])[0] == "r2"
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache, text_key  # noqa: E402
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += len(texts)
+        return [[float(len(t)), 1.0] for t in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        return [float(len(text)), -1.0]
+
+
+def test_roundtrip_and_shared_between_instances(tmp_path):
+    a = EmbeddingCache(str(tmp_path), "modelo/x", max_rows=10)
+    a.put_many([("k1", [1.0, 2.0]), ("k2", [3.0, 4.0])])
+    b = EmbeddingCache(str(tmp_path), "modelo/x", max_rows=10)  # otro proceso, mismo directorio
+    got = b.get_many(["k1", "k2", "k3"])
+    assert set(got) == {"k1", "k2"}
+    np.testing.assert_array_equal(got["k2"], [3.0, 4.0])
+
+
+def test_lru_eviction_reuses_least_used_rows(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "m", max_rows=2)
+    cache.put_many([("old", [1.0, 0.0])])
+    cache.put_many([("used", [2.0, 0.0])])
+    cache.get_many(["used"])
+    cache.put_many([("new", [3.0, 0.0])])
+    assert set(cache.get_many(["old", "used", "new"])) == {"used", "new"}
+    assert cache.metrics()["rows"] == 2 and cache.metrics()["evictions"] == 1
+
+
+def test_reader_drops_row_evicted_while_reading(tmp_path):
+    reader = EmbeddingCache(str(tmp_path), "m", max_rows=1)
+    writer = EmbeddingCache(str(tmp_path), "m", max_rows=1)
+    reader.put_many([("victim", [1.0, 1.0])])
+
+    lookup = reader._rows_for
+    raced = []
+
+    def rows_then_evict(keys):
+        found = lookup(keys)
+        if not raced:  # entre la consulta de filas y la lectura del memmap, otro proceso desaloja
+            raced.append(True)
+            writer.put_many([("intruder", [9.0, 9.0])])
+        return found
+
+    reader._rows_for = rows_then_evict
+    assert reader.get_many(["victim"]) == {}  # nunca el vector del intruso bajo la clave vieja
+    reader._rows_for = lookup
+    np.testing.assert_array_equal(reader.get_many(["intruder"])["intruder"], [9.0, 9.0])
+
+
+def test_cached_embeddings_only_embed_unseen_texts(tmp_path):
+    base = CountingEmbeddings()
+    emb = CachedEmbeddings(base, EmbeddingCache(str(tmp_path), "m"))
+    first = emb.embed_documents(["uno", "dos", "uno"])
+    assert base.calls == 2
+    assert emb.embed_documents(["dos", "uno"]) == [first[1], first[0]]
+    assert base.calls == 2
+    emb.embed_query("uno")  # las consultas tienen su propia clave
+    assert base.calls == 3
+    assert text_key("uno", "q") != text_key("uno", "d")
@@ -0,0 +1,144 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from jobs import JobQueue
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return os.path.join(tmp_path, "jobs.db")
+
+
+async def _until_terminal(queue, job_id, timeout=5.0):
+    async def last():
+        snap = None
+        async for snap in queue.watch(job_id, poll_seconds=0.05):
+            pass
+        return snap
+    return await asyncio.wait_for(last(), timeout)
+
+
+def test_runs_steps_and_stores_result(db_path):
+    async def handler(ctx):
+        for step in ("a", "b"):
+            await ctx.begin(step)
+            await ctx.end(step, partial=step == "b")
+        return {"ok": True}
+
+    async def main():
+        q = JobQueue(db_path, heartbeat_seconds=0.05)
+        q.register("chain", handler)
+        job = await q.enqueue("chain", case_id="c1", steps=["a", "b"])
+        snap = await _until_terminal(q, job["id"])
+        await q.stop()
+        return snap
+
+    snap = asyncio.run(main())
+    assert snap["status"] == "done" and snap["result"] == {"ok": True}
+    assert [(s["name"], s["status"]) for s in snap["steps"]] == [("a", "done"), ("b", "done")]
+    assert snap["steps"][1]["partial"] is True
+
+
+def test_dedupe_returns_active_job_and_409_on_other_options(db_path):
+    q = JobQueue(db_path)
+    q.register("chain", None)
+    first = q._enqueue_sync("chain", "c1", {"mode": "json"}, ["a"], True)
+    assert q._enqueue_sync("chain", "c1", {"mode": "json"}, ["a"], True)["id"] == first["id"]
+    with pytest.raises(HTTPException) as exc:
+        q._enqueue_sync("chain", "c1", {"mode": "sections"}, ["a"], True)
+    assert exc.value.status_code == 409
+    assert q._enqueue_sync("chain", "c2", {"mode": "sections"}, ["a"], True)["id"] != first["id"]
+
+
+def test_stale_job_is_reclaimed_by_another_worker(db_path):
+    dead = JobQueue(db_path, stale_seconds=0)
+    dead.register("chain", None)
+    job = dead._enqueue_sync("chain", "c1", {}, ["a"], True)
+    assert dead._claim_sync()["attempts"] == 1  # el proceso muere sin latir más
+
+    alive = JobQueue(db_path, stale_seconds=0, max_attempts=3)
+    claimed = alive._claim_sync()
+    assert claimed["id"] == job["id"] and claimed["attempts"] == 2
+
+
+def test_gives_up_after_max_attempts(db_path):
+    q = JobQueue(db_path, stale_seconds=0, max_attempts=2)
+    q.register("chain", None)
+    job = q._enqueue_sync("chain", "c1", {}, ["a"], True)
+    assert q._claim_sync()["attempts"] == 1
+    assert q._claim_sync()["attempts"] == 2
+    assert q._claim_sync() is None
+    failed = q._get_sync(job["id"])
+    assert failed["status"] == "error" and "2 veces" in failed["error"]
+
+
+def test_resumed_job_skips_done_steps(db_path):
+    ran = []
+
+    async def handler(ctx):
+        for step in ("a", "b"):
+            if ctx.is_done(step):
+                continue
+            await ctx.begin(step)
+            ran.append(step)
+            await ctx.end(step)
+        return {}
+
+    async def main():
+        crashed = JobQueue(db_path)
+        job = crashed._enqueue_sync("chain", "c1", {}, ["a", "b"], True)
+        crashed._claim_sync()
+        # murió tras el paso "a"; su último latido ya caducó
+        crashed._update_sync(job["id"], heartbeat_at=0, steps_json='[{"name": "a", "status": "done"}, '
+                                                                   '{"name": "b", "status": "pending"}]')
+        q = JobQueue(db_path, heartbeat_seconds=0.05)
+        q.register("chain", handler)
+        q.start()
+        snap = await _until_terminal(q, job["id"])
+        await q.stop()
+        return snap
+
+    assert asyncio.run(main())["status"] == "done"
+    assert ran == ["b"]
+
+
+def test_watchers_are_notified_independently(db_path):
+    async def main():
+        q = JobQueue(db_path, heartbeat_seconds=30)
+        gate = asyncio.Event()
+
+        async def handler(ctx):
+            await gate.wait()
+            return {}
+
+        q.register("chain", handler)
+        job = await q.enqueue("chain", case_id="c1", steps=[])
+
+        async def follow(stop_early):
+            seen = []
+            async for snap in q.watch(job["id"], poll_seconds=30):  # sólo avisos en proceso
+                seen.append(snap["status"])
+                if stop_early and snap["status"] == "running":
+                    break
+            return seen
+
+        async def running():
+            while (await q.get(job["id"]))["status"] != "running":
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(running(), 5)
+        early = await follow(stop_early=True)  # se va antes de que termine
+        late = asyncio.get_running_loop().create_task(follow(stop_early=False))
+        await asyncio.sleep(0.05)
+        gate.set()
+        seen = await asyncio.wait_for(late, 5)
+        await q.stop()
+        return early, seen, q._changed
+
+    early, seen, changed = asyncio.run(main())
+    assert early == ["running"]
+    assert seen[-1] == "done"
+    assert changed == {}
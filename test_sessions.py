@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from sessions import SessionConflict, SessionStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return os.path.join(tmp_path, "sessions.db")
+
+
+def test_lru_evicts_from_memory_but_keeps_disk(db_path):
+    store = SessionStore(db_path, max_sessions=2)
+    for sid in ("a", "b", "c"):
+        store.put(sid, {"messages": [sid]})
+    m = store.metrics()
+    assert m["live_sessions"] == 2 and m["evictions"] == 1 and m["persisted_sessions"] == 3
+    assert store.get("a") == {"messages": ["a"]}  # se relee del disco
+
+
+def test_byte_cap_evicts_oldest(db_path):
+    store = SessionStore(db_path, max_bytes=60)
+    store.put("a", {"messages": ["x" * 30]})
+    store.put("b", {"messages": ["y" * 30]})
+    assert store.metrics()["live_sessions"] == 1
+    assert store.metrics()["bytes_retained"] <= 60
+
+
+def test_ttl_counts_from_last_access(db_path, monkeypatch):
+    import sessions
+
+    now = [1000.0]
+    monkeypatch.setattr(sessions.time, "time", lambda: now[0])
+    store = SessionStore(db_path, ttl_seconds=100, touch_every=10)
+    store.put("a", {"n": 1})
+    now[0] += 80
+    assert store.get("a") == {"n": 1}  # el acceso renueva el TTL (y se persiste: pasó touch_every)
+    now[0] += 80
+    assert SessionStore(db_path, ttl_seconds=100).get("a") == {"n": 1}
+    now[0] += 101
+    assert store.get("a") is None
+    assert store.metrics()["persisted_sessions"] == 0
+
+
+def test_get_returns_a_copy(db_path):
+    store = SessionStore(db_path)
+    store.put("a", {"messages": []})
+    store.get("a")["messages"].append("mutado")
+    assert store.get("a") == {"messages": []}
+
+
+def test_put_with_stale_rev_conflicts(db_path):
+    store = SessionStore(db_path)
+    rev = store.put("a", {"n": 1})
+    assert store.put("a", {"n": 2}, expected_rev=rev) == rev + 1
+    with pytest.raises(SessionConflict):
+        store.put("a", {"n": 3}, expected_rev=rev)
+    assert store.get("a") == {"n": 2}
+    assert store.metrics()["conflicts"] == 1
+
+
+def test_memory_hit_sees_other_workers_writes(db_path):
+    w1, w2 = SessionStore(db_path), SessionStore(db_path)
+    w1.put("a", {"messages": [1]})
+    assert w2.get("a") == {"messages": [1]}  # queda en memoria de w2
+    w1.update("a", lambda d: d["messages"].append(2))
+    assert w2.get_entry("a") == (2, {"messages": [1, 2]})
+    w1.delete("a")
+    assert w2.get("a") is None
+
+
+def test_update_reapplies_on_concurrent_write(db_path):
+    w1, w2 = SessionStore(db_path), SessionStore(db_path)
+    w1.put("a", {"messages": []})
+    w2.get("a")
+
+    def append_racing(d):
+        if not d["messages"]:  # primer intento: otro worker escribe entre la lectura y la escritura
+            w1.update("a", lambda other: other["messages"].append("w1"))
+        d["messages"].append("w2")
+
+    w2.update("a", append_racing)
+    assert w1.get("a") == {"messages": ["w1", "w2"]}
+
+
+def test_update_missing_session_returns_none(db_path):
+    assert SessionStore(db_path).update("nada", lambda d: None) is None
@@ -0,0 +1,202 @@
+import asyncio
+import sqlite3
+
+import httpx
+
+import tutela
+
+HECHOS = "El 3 de marzo la EPS negó la cirugía ordenada por el médico tratante."
+
+
+def _freshness(app, case_id):
+    conn = sqlite3.connect(app.state.db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return tutela._section_freshness(conn, case_id)
+    finally:
+        conn.close()
+
+
+def _save(client, case_id, name, text):
+    r = client.post(f"/wizard/case/{case_id}/section/{name}", json={"user_text": text})
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+def _generate_chain(client, case_id):
+    _save(client, case_id, "hechos", HECHOS)
+    for name in ("derechos_vulnerados", "fundamentos_juridicos", "fundamentos_de_derecho"):
+        assert client.get(f"/wizard/case/{case_id}/ensure/{name}").status_code == 200
+
+
+# ---------------------- grafo de dependencias (input_hash) ----------------------
+
+def test_generated_sections_are_fresh(client, wizard_app, case_id):
+    _generate_chain(client, case_id)
+    fresh, stale = _freshness(wizard_app, case_id)
+    assert {"hechos", "derechos_vulnerados", "fundamentos_juridicos", "fundamentos_de_derecho"} <= set(fresh)
+    assert stale == []
+
+
+def test_whitespace_edit_keeps_everything_fresh(client, wizard_app, case_id, llm):
+    _generate_chain(client, case_id)
+    calls = llm.calls
+    out = _save(client, case_id, "hechos", "  " + HECHOS.replace(" ", "\n", 1) + "\n")
+    assert out["cascade"] == []
+    assert llm.calls == calls  # la mejora previa se conserva sin LLM
+    assert _freshness(wizard_app, case_id)[1] == []
+
+
+def test_real_edit_invalidates_dependents_transitively(client, wizard_app, case_id):
+    _generate_chain(client, case_id)
+    out = _save(client, case_id, "hechos", HECHOS + " Llevo dos meses esperando.")
+    assert {"derechos_vulnerados", "fundamentos_juridicos", "fundamentos_de_derecho"} <= set(out["cascade"])
+    bundle = client.get(f"/wizard/case/{case_id}").json()
+    sections = {s["name"]: s for s in bundle["sections"]}
+    assert not (sections["fundamentos_de_derecho"]["ai_text"] or "").strip()
+
+
+def test_unrelated_edit_invalidates_nothing(client, wizard_app, case_id):
+    _generate_chain(client, case_id)
+    out = _save(client, case_id, "notificaciones", "Calle 1 # 2-3, Bogotá")
+    assert out["cascade"] == []
+    assert "fundamentos_de_derecho" in _freshness(wizard_app, case_id)[0]
+
+
+def test_missing_dependency_is_409(client, case_id):
+    r = client.get(f"/wizard/case/{case_id}/ensure/fundamentos_juridicos")
+    assert r.status_code == 409
+    assert "HECHOS" in r.json()["detail"]
+
+
+# ---------------------- lecturas condicionales (ETag/304) ----------------------
+
+def test_case_read_revalidates_with_etag(client, case_id):
+    r = client.get(f"/wizard/case/{case_id}")
+    etag = r.headers["etag"]
+    assert r.status_code == 200 and r.headers["cache-control"] == "no-cache"
+
+    r = client.get(f"/wizard/case/{case_id}", headers={"If-None-Match": etag})
+    assert r.status_code == 304 and r.content == b"" and r.headers["etag"] == etag
+    assert client.get(f"/wizard/case/{case_id}", headers={"If-None-Match": f'"x", W/{etag}'}).status_code == 304
+
+
+def test_any_write_changes_the_etag(client, case_id):
+    etag = client.get(f"/wizard/case/{case_id}").headers["etag"]
+    client.post(f"/wizard/case/{case_id}/party",
+                json={"role": "accionante", "nombres": "Ana", "apellidos": "Pérez"})
+    r = client.get(f"/wizard/case/{case_id}", headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["etag"] != etag
+    assert any(p["nombres"] == "Ana" for p in r.json()["parties"])
+
+
+def test_structured_compose_shares_the_case_etag(client, case_id):
+    etag = client.get(f"/wizard/case/{case_id}").headers["etag"]
+    r = client.get(f"/wizard/case/{case_id}/compose-structured", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+
+
+def test_conditional_read_of_unknown_case_is_404(client):
+    assert client.get("/wizard/case/nope", headers={"If-None-Match": "*"}).status_code == 404
+
+
+# ---------------------- sincronización incremental (/changes?since=) ----------------------
+
+def test_changes_since_returns_only_newer_rows(client, case_id):
+    base = client.get(f"/wizard/case/{case_id}/changes").json()
+    assert base["reset"] is False and base["since"] == 0
+
+    _save(client, case_id, "notificaciones", "Calle 1 # 2-3")
+    delta = client.get(f"/wizard/case/{case_id}/changes", params={"since": base["revision"]}).json()
+    assert delta["revision"] > base["revision"]
+    assert [s["name"] for s in delta["sections"]] == ["notificaciones"]
+    assert delta["parties"] == [] and delta["rights_detected"] == []
+
+    empty = client.get(f"/wizard/case/{case_id}/changes", params={"since": delta["revision"]}).json()
+    assert empty["case"] is None and empty["sections"] == [] and empty["revision"] == delta["revision"]
+
+
+def test_changes_from_the_future_resets(client, case_id):
+    _save(client, case_id, "notificaciones", "Calle 1 # 2-3")
+    out = client.get(f"/wizard/case/{case_id}/changes", params={"since": 10_000}).json()
+    assert out["reset"] is True and out["since"] == 0
+    assert "notificaciones" in [s["name"] for s in out["sections"]]
+
+
+def test_batch_writes_once_and_returns_the_delta(client, case_id):
+    rev = client.get(f"/wizard/case/{case_id}/changes").json()["revision"]
+    out = client.post(f"/wizard/case/{case_id}/batch", json={
+        "parties": [{"role": "accionado", "nombres": "EPS Salud Total"}],
+        "sections": [{"name": "notificaciones", "user_text": "Calle 1 # 2-3"},
+                     {"name": "firmas", "user_text": "Ana Pérez"}],
+        "since": rev,
+    }).json()
+    changes = out["changes"]
+    # el accionado nuevo también reescribe la INTRO: viaja en el mismo delta
+    assert {s["name"] for s in changes["sections"]} == {"notificaciones", "firmas", "intro"}
+    assert [p["nombres"] for p in changes["parties"]] == ["EPS Salud Total"]
+    assert changes["revision"] == client.get(f"/wizard/case/{case_id}/changes").json()["revision"]
+
+
+def test_changes_of_unknown_case_is_404(client):
+    assert client.get("/wizard/case/nope/changes").status_code == 404
+
+
+# ---------------------- mejoras coalescidas (single-flight, 202) ----------------------
+
+def _concurrently(app, *requests):
+    """Lanza las peticiones (método, ruta) a la vez contra la app y devuelve las respuestas."""
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            return await asyncio.gather(*[c.request(method, url) for method, url in requests])
+
+    return asyncio.run(main())
+
+
+def test_simultaneous_improves_share_one_generation(client, wizard_app, case_id, llm):
+    _save(client, case_id, "hechos", HECHOS)
+    llm.delay = 0.2
+    started = tutela.IMPROVE_FLIGHTS.metrics()["started"]
+    url = f"/wizard/case/{case_id}/section/hechos/improve"
+    responses = _concurrently(wizard_app, *[("POST", url)] * 3)
+
+    assert sorted(r.status_code for r in responses) == [200, 202, 202]
+    assert tutela.IMPROVE_FLIGHTS.metrics()["started"] == started + 1
+    busy = next(r for r in responses if r.status_code == 202).json()
+    assert busy["status"] == "in_progress"
+    assert busy["status_url"] == f"/wizard/case/{case_id}/section/hechos/flight"
+
+    done = client.get(busy["status_url"], params={"wait": 5}).json()
+    winner = next(r for r in responses if r.status_code == 200).json()
+    assert done["status"] == "idle" and done["ai_text"] == winner["ai_text"]
+
+
+def test_join_waits_for_the_running_generation(wizard_app, client, case_id, llm):
+    _save(client, case_id, "hechos", HECHOS)
+    llm.delay = 0.2
+    url = f"/wizard/case/{case_id}/section/hechos/improve"
+    first, joined = _concurrently(wizard_app, ("POST", url), ("POST", url + "?join=true"))
+    assert first.status_code == 200 and joined.status_code == 200
+    assert joined.json()["ai_text"]
+
+
+def test_simultaneous_ensures_get_202(client, wizard_app, case_id, llm):
+    _save(client, case_id, "hechos", HECHOS)
+    llm.delay = 0.2
+    url = f"/wizard/case/{case_id}/ensure/derechos_vulnerados"
+    responses = _concurrently(wizard_app, ("GET", url), ("GET", url))
+    assert sorted(r.status_code for r in responses) == [200, 202]
+
+
+def test_validation_errors_surface_from_the_flight(client, case_id):
+    assert client.post(f"/wizard/case/{case_id}/section/desconocida/improve").status_code == 404
+    assert client.post(f"/wizard/case/{case_id}/section/intro/improve").status_code == 400
+    assert client.post(f"/wizard/case/{case_id}/section/ref/improve").status_code == 409
+    assert tutela.IMPROVE_FLIGHTS.get(tutela._improve_key(client.app.state.db_path, case_id, "ref")) is None
+
+
+def test_idle_flight_returns_the_stored_text(client, case_id):
+    _save(client, case_id, "hechos", HECHOS)
+    out = client.get(f"/wizard/case/{case_id}/section/hechos/flight").json()
+    assert out["status"] == "idle" and out["ai_text"]
@@ -13,15 +13,29 @@
 import os
 import json
 import uuid
+import hashlib
 import sqlite3
 import re
+import asyncio
+import time
 from datetime import datetime
-from typing import Dict, Any, Optional, List, Tuple
+from typing import Callable, Dict, Any, Optional, List, Set, Tuple, Union
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-import unicodedata
-from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+from case_store import CaseSnapshot, case_changes, case_revision, list_cases as case_list, load_case, require_case
+from executors import PROCESS_WORKERS, run_blocking, run_in_process
+from docx_render import render_docx, template_signature
+from export_store import ExportStore, content_hash
+from jobs import JobContext, JobQueue
+from llm_cache import LLMOutputCache, cache_key
+from rights_scan import RightsMatcher
+from single_flight import SingleFlight
+from sqlite_pool import get_pool
+from zip_stream import ZipStream
 
 # ------------------------------------------------------------
 # Config & Constantes
@@ -30,6 +44,42 @@ from docx.enum.text import WD_ALIGN_PARAGRAPH
 DATA_DIR_DEFAULT = "./data"
 EXPORT_DIR_DEFAULT = "./exports"
 
+CASES_PAGE_MAX = 500  # tope de ?limit= en /cases
+
+# Exportaciones (EXPORT_DIR): retención por antigüedad y por tamaño total del directorio
+EXPORT_MAX_AGE_DAYS = float(os.getenv("EXPORT_MAX_AGE_DAYS", "30"))
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", str(512 * 1024 * 1024)))
+EXPORT_GC_INTERVAL = float(os.getenv("EXPORT_GC_INTERVAL", "600"))  # segundos entre barridos
+BULK_EXPORT_MAX = int(os.getenv("BULK_EXPORT_MAX", "2000"))  # casos por /export/bulk
+DOCX_LAYOUT_VERSION = 2  # súbelo al cambiar el formato del .docx: invalida los ya generados
+# Plantilla Word con membrete: DOCX_TEMPLATE por defecto ("" = estilo integrado) y, elegibles por
+# ?template=<nombre>, los .docx de DOCX_TEMPLATES_DIR
+DOCX_TEMPLATE = os.getenv("DOCX_TEMPLATE", "").strip()
+DOCX_TEMPLATES_DIR = os.getenv("DOCX_TEMPLATES_DIR", "./templates")
+
+# Concurrencia hacia el LLM: igualar a los slots paralelos del servidor (LM Studio / vLLM)
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+FJ_SUBCALL_TIMEOUT = float(os.getenv("FJ_SUBCALL_TIMEOUT", "120"))  # segundos por sub-llamada
+# Marca de las partes que no se pudieron generar: un texto que la lleva está incompleto y no se
+# sella con input_hash (queda obsoleto y run-pipeline lo reintenta)
+PENDING_MARK = "[Pendiente: no se pudo generar"
+
+# Modo de la cadena: "multi" (7 llamadas, una por parte) o "single" (un solo JSON con las 4 secciones;
+# los campos ausentes o malformados se regeneran por la vía multi). ?mode= lo cambia por petición.
+CHAIN_MODE = os.getenv("CHAIN_MODE", "multi").strip().lower()
+CHAIN_JSON_TIMEOUT = float(os.getenv("CHAIN_JSON_TIMEOUT", "300"))  # segundos para la llamada única
+
+# Caché de salidas del LLM (sección + modelo + temperatura + prompt + chunk_ids). ?no_cache=1 la salta.
+LLM_CACHE_ENABLE = os.getenv("LLM_CACHE", "1").strip().lower() in ("1", "true", "yes")
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", os.path.join(DATA_DIR_DEFAULT, "llm_cache.db"))
+LLM_CACHE_MAX = int(os.getenv("LLM_CACHE_MAX", "5000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+LLM_CACHE: Optional[LLMOutputCache] = (
+    LLMOutputCache(LLM_CACHE_DB, max_entries=LLM_CACHE_MAX, max_bytes=LLM_CACHE_MAX_BYTES)
+    if LLM_CACHE_ENABLE else None
+)
+
 # Encabezado fijo
 HEADER_FIXED = (
     "SEÑOR\n"
@@ -109,6 +159,26 @@ SECTIONS_CONFIG: Dict[str, Dict[str, Any]] = {
     "firmas": {"needs_llm": False, "send_order": None},
 }
 
+# Grafo de dependencias de las secciones generadas por IA (en orden topológico).
+# Cada sección guarda en 'input_hash' el hash de sus entradas efectivas al generarse; si al
+# guardar otra sección ese hash ya no coincide (o una dependencia quedó obsoleta), se invalida.
+# - "<sección>"       → mejor texto de la sección (final > ai > user)
+# - "<sección>.user"  → texto del usuario de la sección
+# - "@derechos_detectados" / "@partes" → entradas derivadas (diccionario de derechos, nombres)
+SECTION_DEPS: Dict[str, List[str]] = {
+    "hechos": ["hechos.user"],
+    "pretensiones": ["pretensiones.user"],
+    "pruebas_y_anexos": ["pruebas_y_anexos.user"],
+    "derechos_vulnerados": ["hechos", "@derechos_detectados"],
+    "fundamentos_juridicos": ["hechos", "derechos_vulnerados", "pruebas_y_anexos", "@derechos_detectados"],
+    "fundamentos_de_derecho": ["fundamentos_juridicos", "hechos"],
+    "ref": ["derechos_vulnerados", "fundamentos_juridicos", "fundamentos_de_derecho", "@partes"],
+}
+# Entradas que pueden faltar sin bloquear la generación (gating 409)
+OPTIONAL_DEPS = {"pruebas_y_anexos"}
+# Secciones que escribe el usuario y la IA mejora al guardar (no se borran al quedar obsoletas)
+USER_IMPROVED = ("hechos", "pretensiones", "pruebas_y_anexos")
+
 RIGHTS_LEXICON = {
     # Salud y conexos
     "salud": [
@@ -219,17 +289,31 @@ RIGHTS_LEXICON = {
 # Utilidades de BD (SQLite)
 # ------------------------------------------------------------
 
-def _connect(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+def _in_conn(db_path: str, fn, *args, **kwargs):
+    """Ejecuta fn(conn, ...) con la conexión del hilo (sqlite_pool: WAL, busy_timeout, release garantizado)."""
+    with get_pool(db_path).acquire() as conn:
+        return fn(conn, *args, **kwargs)
+
+async def _db(db_path: str, fn, *args, **kwargs):
+    """Versión async de _in_conn: corre en el pool bloqueante dedicado (executors.py)."""
+    return await run_blocking(_in_conn, db_path, fn, *args, **kwargs)
+
+def _in_uow(conn, fn, *args, **kwargs):
+    """fn(conn, ...) como unidad de trabajo: sus commit() internos se difieren a un único COMMIT."""
+    with conn.unit_of_work():
+        return fn(conn, *args, **kwargs)
+
+async def _tx(db_path: str, fn, *args, **kwargs):
+    """Como _db, pero todo lo que escriba fn (y lo que llame) va en una sola transacción."""
+    return await run_blocking(_in_conn, db_path, _in_uow, fn, *args, **kwargs)
 
 def _now() -> str:
     return datetime.now().isoformat(timespec="seconds")
 
 def _init_db(db_path: str):
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
-    conn = _connect(db_path)
+    _in_conn(db_path, _create_schema)
+
+def _create_schema(conn: sqlite3.Connection):
     cur = conn.cursor()
     cur.execute("""
         CREATE TABLE IF NOT EXISTS cases (
@@ -292,7 +376,96 @@ def _init_db(db_path: str):
             FOREIGN KEY(case_id) REFERENCES cases(id)
         )""")
     conn.commit()
-    conn.close()
+    _migrate(conn)
+
+_BUMP_CASE = """UPDATE cases SET revision = revision + 1,
+                                 updated_at = strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')
+                WHERE id = {ref}.case_id;"""
+
+def _bump_trigger(table: str, event: str) -> str:
+    """Trigger que sube la revisión del caso dueño de la fila escrita (migración 2)."""
+    ref = "OLD" if event == "DELETE" else "NEW"
+    return f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_bump AFTER {event} ON {table}
+                BEGIN
+                    {_BUMP_CASE.format(ref=ref)}
+                END"""
+
+def _stamp_trigger(table: str, event: str) -> str:
+    """Como _bump_trigger, y además sella la fila con la nueva revisión del caso (migración 3).
+    El WHEN evita que el propio sellado vuelva a disparar el trigger de UPDATE."""
+    when = " WHEN NEW.revision IS OLD.revision" if event == "UPDATE" else ""
+    return f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_bump AFTER {event} ON {table}{when}
+                BEGIN
+                    {_BUMP_CASE.format(ref="NEW")}
+                    UPDATE {table} SET revision = (SELECT revision FROM cases WHERE id = NEW.case_id)
+                    WHERE rowid = NEW.rowid;
+                END"""
+
+def _add_column(table: str, column: str, decl: str):
+    """Paso de migración que añade una columna si falta: algunas bases ya la tienen porque
+    se añadía con un ALTER suelto antes de existir las migraciones numeradas."""
+    def step(conn: sqlite3.Connection) -> None:
+        cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return step
+
+SYNCED_TABLES = ("sections", "parties", "rights_detected")  # las que viajan en /changes
+
+# Migraciones numeradas: la i-ésima lleva la base a user_version = i + 1. Sólo se añaden al final.
+# Cada paso es una sentencia SQL o una función (conn) -> None.
+SCHEMA_MIGRATIONS: List[List[Union[str, Callable[[sqlite3.Connection], None]]]] = [
+    # 1) Índices para el listado paginado y las lecturas por caso
+    [
+        "CREATE INDEX IF NOT EXISTS idx_cases_updated ON cases(updated_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_cases_status_updated ON cases(status, updated_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_parties_case_role ON parties(case_id, role, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_versions_case_section ON versions(case_id, section_name)",
+        "ANALYZE",
+    ],
+    # 2) Revisión del caso: toda escritura en sus tablas la incrementa y mueve cases.updated_at
+    #    (triggers: ningún camino de escritura puede olvidarla). Es el ETag de las lecturas.
+    [
+        "ALTER TABLE cases ADD COLUMN revision INTEGER NOT NULL DEFAULT 0",
+        *[
+            _bump_trigger(table, event)
+            for table in ("sections", "parties", "rights_detected", "versions")
+            for event in ("INSERT", "UPDATE", "DELETE")
+        ],
+        """CREATE TRIGGER IF NOT EXISTS trg_cases_update_bump AFTER UPDATE OF title, status ON cases
+           BEGIN
+               UPDATE cases SET revision = revision + 1,
+                                updated_at = strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')
+               WHERE id = NEW.id;
+           END""",
+    ],
+    # 3) Revisión por fila (la del caso tras escribirla): /changes?since=N devuelve sólo lo nuevo
+    [
+        *[f"ALTER TABLE {t} ADD COLUMN revision INTEGER NOT NULL DEFAULT 0" for t in SYNCED_TABLES],
+        *[f"DROP TRIGGER IF EXISTS trg_{t}_{e}_bump" for t in SYNCED_TABLES for e in ("insert", "update")],
+        *[f"UPDATE {t} SET revision = (SELECT revision FROM cases WHERE id = {t}.case_id)" for t in SYNCED_TABLES],
+        *[_stamp_trigger(t, e) for t in SYNCED_TABLES for e in ("INSERT", "UPDATE")],
+        *[f"CREATE INDEX IF NOT EXISTS idx_{t}_case_revision ON {t}(case_id, revision)" for t in SYNCED_TABLES],
+    ],
+    # 4) Hash de las entradas con que se generó cada sección (grafo SECTION_DEPS)
+    [
+        _add_column("sections", "input_hash", "TEXT"),
+    ],
+]
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """Aplica, cada una en su transacción, las migraciones pendientes según PRAGMA user_version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, stmts in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        with conn.unit_of_work():
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= i:
+                continue  # otro proceso ya la aplicó
+            for step in stmts:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version={i}")
 
 def _ensure_sections_for_case(conn: sqlite3.Connection, case_id: str):
     """Crea filas en 'sections' para cada sección del config si no existen."""
@@ -316,31 +489,6 @@ def _ensure_sections_for_case(conn: sqlite3.Connection, case_id: str):
         ))
     conn.commit()
 
-def _get_case_bundle(conn: sqlite3.Connection, case_id: str) -> Dict[str, Any]:
-    cur = conn.cursor()
-    c = cur.execute("SELECT * FROM cases WHERE id=?", (case_id,)).fetchone()
-    if not c:
-        raise HTTPException(status_code=404, detail="Caso no encontrado")
-
-    parties = [ dict(row) for row in cur.execute(
-        "SELECT * FROM parties WHERE case_id=? ORDER BY role, created_at", (case_id,)
-    ).fetchall() ]
-
-    sections = [ dict(row) for row in cur.execute(
-        "SELECT * FROM sections WHERE case_id=? ORDER BY id", (case_id,)
-    ).fetchall() ]
-
-    rights = [ dict(row) for row in cur.execute(
-        "SELECT * FROM rights_detected WHERE case_id=? ORDER BY right_name", (case_id,)
-    ).fetchall() ]
-
-    return {
-        "case": dict(c),
-        "parties": parties,
-        "sections": sections,
-        "rights_detected": rights,
-    }
-
 def _upsert_party(conn: sqlite3.Connection, case_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
     """Inserta o actualiza una 'party' por id (si viene) o crea nueva."""
     cur = conn.cursor()
@@ -358,7 +506,6 @@ def _upsert_party(conn: sqlite3.Connection, case_id: str, data: Dict[str, Any])
             WHERE id=:id AND case_id=:case_id
         """, {**{f: data.get(f, row[f]) for f in fields},
               "updated_at": now, "id": pid, "case_id": case_id})
-        conn.commit()
         out = dict(cur.execute("SELECT * FROM parties WHERE id=?", (pid,)).fetchone())
     else:
         # crear
@@ -379,13 +526,10 @@ def _upsert_party(conn: sqlite3.Connection, case_id: str, data: Dict[str, Any])
             data.get("direccion","").strip(),
             now, now
         ))
-        conn.commit()
         out = dict(cur.execute("SELECT * FROM parties WHERE id=?", (new_id,)).fetchone())
 
-    # refrescar INTRO con personas reales y autogenerar Notificaciones/Firmas
-    _refresh_intro_after_party(conn, case_id)
-    _refresh_notifications(conn, case_id)
-    _refresh_firmas(conn, case_id)
+    # refrescar INTRO con personas reales y autogenerar Notificaciones/Firmas (mismo commit)
+    _refresh_party_sections(conn, case_id)
     return out
 
 def _save_section_user_text(conn: sqlite3.Connection, case_id: str, name: str, text: str) -> Dict[str, Any]:
@@ -415,7 +559,15 @@ def _save_section_user_text(conn: sqlite3.Connection, case_id: str, name: str, t
     """, (case_id, name)).fetchone())
 
 def _save_section_ai(conn: sqlite3.Connection, case_id: str, name: str,
-                     ai_text: str, citations: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+                     ai_text: str, citations: Optional[List[Dict[str, Any]]] = None,
+                     input_hash: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Guarda el texto IA. `input_hash` es el hash de las entradas con las que se GENERÓ el texto
+    (calculado antes de llamar al LLM): si alguien editó una entrada mientras tanto, la sección
+    queda obsoleta en vez de pasar por fresca. None (o texto parcial) → sin sello (se regenerará).
+    """
+    if _is_partial(ai_text):
+        input_hash = None
     # También filtramos pretensiones si por error se invoca IA allí
     if name == "pretensiones" and _contains_economic_claim(ai_text or ""):
         raise HTTPException(
@@ -430,10 +582,10 @@ def _save_section_ai(conn: sqlite3.Connection, case_id: str, name: str,
 
     citations_json = json.dumps(citations or [], ensure_ascii=False)
     res = cur.execute("""
-        UPDATE sections SET ai_text=?, status=?, citations_json=?, updated_at=?
+        UPDATE sections SET ai_text=?, status=?, citations_json=?, input_hash=?, updated_at=?
         WHERE case_id=? AND name=?
     """, (ai_text, "ai_suggested" if (ai_text or "").strip() else "draft",
-          citations_json, _now(), case_id, name))
+          citations_json, input_hash if name in SECTION_DEPS else None, _now(), case_id, name))
     if res.rowcount == 0:
         raise HTTPException(status_code=404, detail="Sección no existe para este caso")
     conn.commit()
@@ -477,49 +629,28 @@ def _invalidate_sections(conn: sqlite3.Connection, case_id: str, names: List[str
     q_marks = ",".join(["?"] * len(names))
     cur.execute(f"""
         UPDATE sections
-        SET ai_text='', final_text='', status='draft', updated_at=?
+        SET ai_text='', final_text='', status='draft', input_hash=NULL, updated_at=?
         WHERE case_id=? AND name IN ({q_marks})
     """, [now, case_id, *names])
     conn.commit()
 
-def _fold(s: str) -> str:
-    # lower + quita acentos/diacríticos
-    s = (s or "").lower()
-    return "".join(c for c in unicodedata.normalize("NFKD", s) if not unicodedata.combining(c))
-
-# Precompilamos patrones una sola vez para rendimiento y precisión
-RIGHT_PATTERNS: Dict[str, List[re.Pattern]] = {}
-for right, kws in RIGHTS_LEXICON.items():
-    pats = []
-    for kw in kws:
-        k = _fold(kw).strip()
-        if not k:
-            continue
-        # escapamos y permitimos espacios flexibles
-        k_escaped = re.escape(k)
-        k_escaped = re.sub(r"\\\s+", r"\\s+", k_escaped)  # por si en el futuro hay \s en keywords
-        k_escaped = re.sub(r"\s+", r"\\s+", k_escaped)    # "derecho de peticion" -> "derecho\s+de\s+peticion"
-        # si es token alfanumérico (sin espacios/puntuación), aplicamos bordes de palabra
-        if re.fullmatch(r"[a-z0-9]+", k):
-            pat = re.compile(rf"\b{k_escaped}\b")
-        else:
-            pat = re.compile(k_escaped)
-        pats.append(pat)
-    RIGHT_PATTERNS[right] = pats
+def _mark_ai_suggested(conn: sqlite3.Connection, case_id: str, name: str) -> None:
+    """Re-guardado sin cambios efectivos: la sugerencia IA vigente vuelve a ser la activa."""
+    conn.execute("""
+        UPDATE sections SET status='ai_suggested', updated_at=?
+        WHERE case_id=? AND name=? AND COALESCE(ai_text, '') != ''
+    """, (_now(), case_id, name))
+    conn.commit()
+
+# Un solo autómata para todo el léxico (rights_scan.py), construido al importar
+RIGHTS_MATCHER = RightsMatcher(RIGHTS_LEXICON)
 
 def _detect_rights(text: str) -> List[str]:
     """
     Devuelve la lista ORDENADA de derechos detectados usando exactamente el nombre
     de la clave de RIGHTS_LEXICON (p. ej., 'salud', 'vida digna').
     """
-    if not text:
-        return []
-    t = _fold(text)
-    found = set()
-    for right, patterns in RIGHT_PATTERNS.items():
-        if any(p.search(t) for p in patterns):
-            found.add(right)
-    return sorted(found)
+    return RIGHTS_MATCHER.rights(text)
 
 def _set_right(conn: sqlite3.Connection, case_id: str, right_name: str,
                argument_ai: str = "", sources: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
@@ -573,15 +704,15 @@ def _replace_contra_segment(txt: str, accionados_inline: str) -> str:
 
     return RE_CONTRA_BLOCK.sub(_sub, txt)
 
-def _compose_people_inline(conn, case_id: str, role: str) -> str:
-    cur = conn.cursor()
-    rows = cur.execute(
-        "SELECT nombres, apellidos, tipo_id, numero_id FROM parties "
-        "WHERE case_id=? AND role=? ORDER BY created_at", (case_id, role)
-    ).fetchall()
+def _load_parties(conn, case_id: str) -> List[sqlite3.Row]:
+    """Todas las partes del caso en una consulta (los helpers filtran por rol en memoria)."""
+    return conn.execute("SELECT * FROM parties WHERE case_id=? ORDER BY created_at", (case_id,)).fetchall()
 
+def _people_inline(parties: List[sqlite3.Row], role: str) -> str:
     out = []
-    for r in rows:
+    for r in parties:
+        if r["role"] != role:
+            continue
         nombre = " ".join([(r["nombres"] or "").strip(), (r["apellidos"] or "").strip()]).strip()
         ident  = " ".join([(r["tipo_id"] or "").strip(), (r["numero_id"] or "").strip()]).strip()
         if nombre and ident:
@@ -590,21 +721,19 @@ def _compose_people_inline(conn, case_id: str, role: str) -> str:
             out.append(nombre)
     return ", ".join(out)
 
-def _refresh_intro_after_party(conn, case_id: str) -> None:
+def _compose_people_inline(conn, case_id: str, role: str) -> str:
+    return _people_inline(_load_parties(conn, case_id), role)
+
+def _intro_text(row: Optional[sqlite3.Row], parties: List[sqlite3.Row]) -> Optional[str]:
     """
-    Regenera o actualiza la INTRO con los accionantes/accionados reales.
+    INTRO con los accionantes/accionados reales (None si no cambia).
     - Si la intro está vacía → crea un texto base con las partes.
     - Si existe → sustituye placeholders y el bloque 'contra <...> , con el objeto'.
     """
-    cur = conn.cursor()
-    row = cur.execute(
-        "SELECT user_text, ai_text, final_text FROM sections WHERE case_id=? AND name='intro'",
-        (case_id,)
-    ).fetchone()
     current = _normalize_spaces((row and (row["user_text"] or row["final_text"] or row["ai_text"])) or "")
 
-    acc_str = _compose_people_inline(conn, case_id, "accionante")
-    ads_str = _compose_people_inline(conn, case_id, "accionado")
+    acc_str = _people_inline(parties, "accionante")
+    ads_str = _people_inline(parties, "accionado")
 
     if not current:
         accionado_display  = ads_str or "los accionados"
@@ -615,8 +744,7 @@ def _refresh_intro_after_party(conn, case_id: str) -> None:
             f"ACCIÓN DE TUTELA contra {accionado_display}, con el objeto de que se protejan los derechos "
             f"constitucionales fundamentales que a continuación enuncio y los cuales se fundamentan en los siguientes hechos."
         )
-        _save_section_user_text(conn, case_id, "intro", intro_text)
-        return
+        return intro_text
 
     new_txt = current
     if ads_str:
@@ -628,18 +756,21 @@ def _refresh_intro_after_party(conn, case_id: str) -> None:
         new_txt = _replace_contra_segment(new_txt, ads_str)
 
     new_txt = _normalize_spaces(new_txt)
-    if new_txt != current:
-        _save_section_user_text(conn, case_id, "intro", new_txt)
+    return new_txt if new_txt != current else None
+
+def _refresh_intro_after_party(conn, case_id: str) -> None:
+    row = conn.execute(
+        "SELECT user_text, ai_text, final_text FROM sections WHERE case_id=? AND name='intro'", (case_id,)
+    ).fetchone()
+    txt = _intro_text(row, _load_parties(conn, case_id))
+    if txt is not None:
+        _save_section_user_text(conn, case_id, "intro", txt)
 
-def _compose_notifications_text(conn, case_id: str) -> str:
+def _notifications_text(parties: List[sqlite3.Row]) -> str:
     """Genera el texto de Notificaciones para accionantes y accionados desde parties."""
-    cur = conn.cursor()
 
     def fmt_block(role_label: str, role_key: str) -> str:
-        people = cur.execute(
-            "SELECT * FROM parties WHERE case_id=? AND role=? ORDER BY created_at",
-            (case_id, role_key)
-        ).fetchall()
+        people = [p for p in parties if p["role"] == role_key]
         if not people:
             return f"{role_label}:\n(sin datos aún)"
         lines = []
@@ -660,13 +791,9 @@ def _compose_notifications_text(conn, case_id: str) -> str:
     ads = fmt_block("Accionado(s)", "accionado")
     return acc + "\n\n" + ads
 
-def _compose_firmas_text(conn, case_id: str) -> str:
+def _firmas_text(parties: List[sqlite3.Row]) -> str:
     """Genera el bloque de firmas con nombres + identificación de todos los accionantes."""
-    cur = conn.cursor()
-    rows = cur.execute(
-        "SELECT * FROM parties WHERE case_id=? AND role='accionante' ORDER BY created_at",
-        (case_id,)
-    ).fetchall()
+    rows = [p for p in parties if p["role"] == "accionante"]
     if not rows:
         return "(agrega al menos un accionante para firmar)"
     lines = []
@@ -676,21 +803,94 @@ def _compose_firmas_text(conn, case_id: str) -> str:
         lines.append(f"{nombre} — {ident}")
     return "\n".join(lines)
 
-def _refresh_notifications(conn, case_id: str) -> None:
-    txt = _compose_notifications_text(conn, case_id)
-    _save_section_user_text(conn, case_id, "notificaciones", txt)
-
-def _refresh_firmas(conn, case_id: str) -> None:
-    txt = _compose_firmas_text(conn, case_id)
-    _save_section_user_text(conn, case_id, "firmas", txt)
+def _refresh_party_sections(conn, case_id: str) -> None:
+    """
+    Intro, Notificaciones y Firmas tras cambiar una parte: partes y secciones se leen una vez,
+    los textos se componen en memoria y sólo se escriben los que cambiaron (un único UPDATE
+    por lote, dentro de la transacción del llamador).
+    """
+    parties = _load_parties(conn, case_id)
+    rows = {r["name"]: r for r in conn.execute(
+        "SELECT name, user_text, ai_text, final_text FROM sections "
+        "WHERE case_id=? AND name IN ('intro','notificaciones','firmas')", (case_id,)).fetchall()}
+    texts = {
+        "intro": _intro_text(rows.get("intro"), parties),
+        "notificaciones": _notifications_text(parties),
+        "firmas": _firmas_text(parties),
+    }
+    now = _now()
+    changed = [
+        (txt, "draft" if txt.strip() else "empty", now, case_id, name)
+        for name, txt in texts.items()
+        if txt is not None and name in rows and (rows[name]["user_text"] or "") != txt
+    ]
+    if changed:
+        conn.executemany("UPDATE sections SET user_text=?, status=?, updated_at=? WHERE case_id=? AND name=?",
+                         changed)
+    conn.commit()
 
 # ------------------------------------------------------------
 # LLM / RAG helpers
 # ------------------------------------------------------------
 
-def _docs_for_prompt(retriever, query: str, k: int = 5) -> Tuple[List[str], List[Dict[str, Any]]]:
+_LLM_SLOTS: Optional[asyncio.Semaphore] = None
+
+def _llm_slots() -> asyncio.Semaphore:
+    """Semáforo compartido por todas las llamadas del wizard (tope = LLM_CONCURRENCY)."""
+    global _LLM_SLOTS
+    if _LLM_SLOTS is None:
+        _LLM_SLOTS = asyncio.Semaphore(max(1, LLM_CONCURRENCY))
+    return _LLM_SLOTS
+
+async def _allm(llm, prompt: str, timeout: Optional[float] = None) -> str:
+    """
+    Llama al LLM sin bloquear el event loop (.ainvoke; si no existe, .invoke en un hilo).
+    `timeout` cuenta desde que se obtiene un slot (la espera en cola no consume el plazo).
+    """
+    async with _llm_slots():
+        if hasattr(llm, "ainvoke"):
+            call = llm.ainvoke(prompt)
+        else:
+            call = asyncio.to_thread(llm.invoke, prompt)
+        resp = await asyncio.wait_for(call, timeout=timeout)
+    return (getattr(resp, "content", None) or str(resp) or "").strip()
+
+def _llm_identity(llm) -> Tuple[str, Any]:
+    """(modelo, temperatura) del cliente LLM, para la clave de caché."""
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+    return str(model), getattr(llm, "temperature", None)
+
+async def _allm_cached(
+    llm,
+    prompt: str,
+    section: str,
+    citations: Optional[List[Dict[str, Any]]] = None,
+    no_cache: bool = False,
+    timeout: Optional[float] = None,
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    _allm con caché persistente: mismo (sección, modelo, temperatura, prompt, chunk_ids) →
+    (texto, citas) guardados, sin llamar al modelo. Con no_cache se regenera y se sobrescribe.
+    """
+    citations = citations or []
+    if LLM_CACHE is None:
+        return await _allm(llm, prompt, timeout=timeout), citations
+    model, temperature = _llm_identity(llm)
+    chunk_ids = [c.get("chunk_id") or (c.get("meta") or {}).get("chunk_id") for c in citations]
+    key = cache_key(section, model, temperature, prompt, chunk_ids)
+    if no_cache:
+        LLM_CACHE.note_bypass()
+    else:
+        hit = await run_blocking(LLM_CACHE.get, key)
+        if hit is not None:
+            return hit
+    text = await _allm(llm, prompt, timeout=timeout)
+    await run_blocking(LLM_CACHE.put, key, section, model, text, citations)
+    return text, citations
+
+async def _docs_for_prompt(retriever, query: str, k: int = 5) -> Tuple[List[str], List[Dict[str, Any]]]:
     """
-    Obtiene documentos del retriever usando la API moderna (.invoke) y, si no existe,
+    Obtiene documentos del retriever usando la API moderna (.ainvoke/.invoke) y, si no existe,
     hace fallback a .get_relevant_documents. Devuelve (chunks_para_prompt, citas_struct).
     """
     if not retriever:
@@ -711,15 +911,13 @@ def _docs_for_prompt(retriever, query: str, k: int = 5) -> Tuple[List[str], List
 
     docs = []
     try:
-        docs = _normalize_docs(retriever.invoke(query))
-    except AttributeError:
-        try:
-            docs = _normalize_docs(retriever.get_relevant_documents(query))
-        except Exception:
-            docs = []
+        if hasattr(retriever, "ainvoke"):
+            docs = _normalize_docs(await retriever.ainvoke(query))
+        else:
+            docs = _normalize_docs(await asyncio.to_thread(retriever.invoke, query))
     except Exception:
         try:
-            docs = _normalize_docs(retriever.get_relevant_documents(query))
+            docs = _normalize_docs(await asyncio.to_thread(retriever.get_relevant_documents, query))
         except Exception:
             docs = []
 
@@ -739,11 +937,13 @@ def _docs_for_prompt(retriever, query: str, k: int = 5) -> Tuple[List[str], List
             cites.append({"title": title, "snippet": snippet, "meta": meta})
     return chunks, cites
 
-def _generate_fundamentos_juridicos(llm, ctx: Dict[str, Any]) -> str:
+async def _generate_fundamentos_juridicos(llm, ctx: Dict[str, Any], no_cache: bool = False) -> str:
     """
-    Genera FUNDAMENTOS JURÍDICOS en 4 sub-llamadas:
+    Genera FUNDAMENTOS JURÍDICOS en 4 sub-llamadas concurrentes (ningún prompt depende de otro):
     1) Procedencia, 2) Problema jurídico, 3) Reglas (jurisprudenciales/legales), 4) Caso concreto.
-    Devuelve un único texto ya ordenado (1..4).
+    Devuelve un único texto ya ordenado (1..4). Cada sub-llamada tiene su timeout; las que fallan
+    quedan marcadas con PENDING_MARK en el texto (parcial: no se sella como fresco) y, si fallan
+    todas, se responde 502/504.
     """
     if not llm:  # Fallback simple si no hay LLM
         return (
@@ -782,13 +982,28 @@ def _generate_fundamentos_juridicos(llm, ctx: Dict[str, Any]) -> str:
         ),
     }
 
-    out = {}
-    for key, pr in prompts.items():
-        try:
-            r = llm.invoke(pr)
-            out[key] = (getattr(r, "content", None) or str(r) or "").strip()
-        except Exception:
-            out[key] = ""
+    # Cada sub-llamada se cachea por separado: una parte fallida no invalida las demás
+    results = await asyncio.gather(
+        *(_allm_cached(llm, pr, f"fundamentos_juridicos/{key}", no_cache=no_cache, timeout=FJ_SUBCALL_TIMEOUT)
+          for key, pr in prompts.items()),
+        return_exceptions=True,
+    )
+
+    out: Dict[str, str] = {}
+    failed: Dict[str, str] = {}
+    for key, res in zip(prompts, results):
+        if isinstance(res, BaseException):
+            reason = "tiempo agotado" if isinstance(res, asyncio.TimeoutError) else f"error del modelo ({type(res).__name__})"
+            failed[key] = reason
+            out[key] = f"{PENDING_MARK} ({reason}). Vuelve a mejorar esta sección.]"
+        else:
+            out[key] = res[0]
+    if len(failed) == len(prompts):
+        timeouts = all(r == "tiempo agotado" for r in failed.values())
+        raise HTTPException(
+            status_code=504 if timeouts else 502,
+            detail=f"No se pudo generar ninguna parte de FUNDAMENTOS JURÍDICOS: {failed}",
+        )
 
     texto = (
         "1) Procedencia:\n" + (out["procedencia"] or "") + "\n\n"
@@ -798,17 +1013,22 @@ def _generate_fundamentos_juridicos(llm, ctx: Dict[str, Any]) -> str:
     ).strip()
     return texto
 
+def _is_partial(text: Optional[str]) -> bool:
+    """True si el texto lleva partes pendientes (sub-llamadas fallidas)."""
+    return PENDING_MARK in (text or "")
+
 def _get_best_text(row: Optional[sqlite3.Row]) -> str:
     if not row:
         return ""
     return (row["final_text"] or row["ai_text"] or row["user_text"] or "").strip()
 
-def _llm_improve_for_section(
+async def _llm_improve_for_section(
     name: str,
     user_text: str,
     ctx: Dict[str, Any],
     llm=None,
-    retriever=None
+    retriever=None,
+    no_cache: bool = False,
 ) -> Tuple[str, List[Dict[str, Any]]]:
     """
     Devuelve (ai_text, citations_list). Prohibido metadiscurso; entrega el contenido final.
@@ -826,7 +1046,7 @@ def _llm_improve_for_section(
                 base = ("Derechos detectados: " + ", ".join(det) + "\n\n" if det else "") + \
                        (ctx.get("hechos","") or "")
             elif name == "fundamentos_juridicos":
-                return _generate_fundamentos_juridicos(None, ctx), []
+                return await _generate_fundamentos_juridicos(None, ctx), []
             elif name == "fundamentos_de_derecho":
                 return "1) C.P., art. 86\n2) D. 2591 de 1991, arts. 5, 6 y 42", []
             elif name == "ref":
@@ -849,11 +1069,11 @@ def _llm_improve_for_section(
     rag_chunks, citations = [], []
     if name == "fundamentos_de_derecho" and retriever:
         query = ctx.get("fundamentos_juridicos") or ctx.get("hechos") or ""
-        rag_chunks, citations = _docs_for_prompt(retriever, query, k=8)
+        rag_chunks, citations = await _docs_for_prompt(retriever, query, k=8)
 
     # ---- Enrutamiento por sección ----
     if name == "fundamentos_juridicos":
-        return _generate_fundamentos_juridicos(llm, ctx), []
+        return await _generate_fundamentos_juridicos(llm, ctx, no_cache=no_cache), []
 
     prompt_parts = ["Eres un redactor jurídico colombiano especializado en acciones de tutela."]
 
@@ -891,9 +1111,7 @@ def _llm_improve_for_section(
         prompt_parts.append(f"Texto del usuario (si aplica):\n\"\"\"\n{user_text.strip()}\n\"\"\"")
 
     try:
-        resp = llm.invoke("\n\n".join(prompt_parts))
-        content = getattr(resp, "content", None) or str(resp)
-        return content.strip(), citations
+        return await _allm_cached(llm, "\n\n".join(prompt_parts), name, citations, no_cache=no_cache)
     except Exception:
         return (user_text or ctx.get("hechos","") or "").strip(), []
 
@@ -906,21 +1124,114 @@ PROMPT_SUGIERE_PRETENSIONES = (
 )
 
 PROMPT_CADENA_JSON = (
+    "Eres un redactor jurídico colombiano especializado en acciones de tutela.\n"
     "A partir de los HECHOS (depurados) y las PRETENSIONES (mejoradas), genera para una acción de tutela:\n"
-    "1) DERECHOS VULNERADOS (texto)\n"
-    "2) FUNDAMENTOS JURÍDICOS (texto)\n"
-    "3) FUNDAMENTOS DE DERECHO (lista numerada de normas/sentencias reales; no expliques)\n"
-    "4) REF (línea de referencia)\n\n"
-    "Devuelve exclusivamente este JSON MINIMAL (sin backticks ni explicación):\n"
-    "{\n"
+    "1) DERECHOS VULNERADOS (texto; nómbralos y explica brevemente el porqué, conectado con los hechos)\n"
+    "2) FUNDAMENTOS JURÍDICOS (texto con 1) Procedencia, 2) Problema jurídico, 3) Reglas jurisprudenciales "
+    "y legales, 4) Caso concreto; referencia (H#) o (P#) cuando proceda)\n"
+    "3) FUNDAMENTOS DE DERECHO (lista numerada de normas/sentencias reales tomadas SOLO de la BASE; no expliques)\n"
+    "4) REF (línea de referencia con accionantes, accionados y derechos; usa los nombres tal cual)\n\n"
+    "Devuelve exclusivamente este JSON MINIMAL (sin backticks ni explicación); saltos de línea como \\n:\n"
+    "{{\n"
     ' "derechos_vulnerados": "...",\n'
     ' "fundamentos_juridicos": "...",\n'
     ' "fundamentos_de_derecho": "...",\n'
     ' "ref": "..."\n'
-    "}\n\n"
-    "HECHOS:\n{hechos}\n\nPRETENSIONES:\n{pret}\n"
+    "}}\n\n"
+    "HECHOS:\n{hechos}\n\nPRETENSIONES:\n{pret}\n\nPRUEBAS:\n{pruebas}\n\n"
+    "Derechos detectados (diccionario): {detectados}\n"
+    "Accionantes: {accionantes}\nAccionados: {accionados}\n\n"
+    "BASE para FUNDAMENTOS DE DERECHO (no inventes):\n{base}\n"
 )
 
+# -------- Cadena en una sola llamada: extracción / reparación del JSON --------
+CHAIN_JSON_FIELDS = ("derechos_vulnerados", "fundamentos_juridicos", "fundamentos_de_derecho", "ref")
+
+_SMART_QUOTE_DELIM = [
+    (re.compile(r'([{\[,:]\s*)[“”]'), r'\1"'),   # comilla tipográfica que abre una cadena
+    (re.compile(r'[“”](\s*[:,}\]])'), r'"\1'),   # comilla tipográfica que cierra una cadena
+]
+
+def _escape_raw_controls(s: str) -> str:
+    """Escapa saltos de línea/tabs literales dentro de cadenas JSON (error típico de modelos pequeños)."""
+    out, in_str, esc = [], False, False
+    for ch in s:
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+            elif ch == "\n":
+                ch = "\\n"
+            elif ch == "\r":
+                ch = ""
+            elif ch == "\t":
+                ch = "\\t"
+        elif ch == '"':
+            in_str = True
+        out.append(ch)
+    return "".join(out)
+
+def _repair_json(s: str) -> str:
+    for rx, sub in _SMART_QUOTE_DELIM:
+        s = rx.sub(sub, s)
+    s = re.sub(r",\s*([}\]])", r"\1", s)  # comas finales
+    return _escape_raw_controls(s)
+
+def _as_text(value: Any) -> str:
+    """Normaliza un campo del JSON a texto: listas → líneas, objetos → 'clave: valor'."""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        return "\n".join(t for t in (_as_text(v) for v in value) if t)
+    if isinstance(value, dict):
+        return "\n\n".join(f"{k}:\n{_as_text(v)}" for k, v in value.items() if _as_text(v))
+    return str(value).strip()
+
+def _regex_fields(s: str) -> Dict[str, str]:
+    """Último recurso: cada campo termina donde empieza la siguiente clave conocida o el cierre '}'."""
+    keys = "|".join(CHAIN_JSON_FIELDS)
+    out: Dict[str, str] = {}
+    for key in CHAIN_JSON_FIELDS:
+        m = re.search(rf'"{key}"\s*:\s*"(.*?)"\s*(?=,\s*"(?:{keys})"\s*:|}}\s*$)', s, flags=re.S)
+        if m:
+            out[key] = m.group(1).replace("\\n", "\n").replace('\\"', '"').strip()
+    return out
+
+def _parse_chain_json(text: str) -> Dict[str, str]:
+    """
+    Extrae {campo: texto} de la respuesta de PROMPT_CADENA_JSON. Tolera backticks, texto alrededor,
+    comillas tipográficas, comas finales y saltos de línea sin escapar. Sólo devuelve campos válidos
+    (no vacíos ni placeholders); los demás los regenera la cadena multi-llamada.
+    """
+    s = (text or "").strip()
+    s = re.sub(r"^```(?:json)?\s*|\s*```$", "", s, flags=re.I)
+    i, j = s.find("{"), s.rfind("}")
+    if i < 0:
+        return {}
+    s = s[i:j + 1] if j > i else s[i:] + "}"
+
+    data: Any = None
+    for candidate in (s, _repair_json(s)):
+        try:
+            data = json.loads(candidate)
+            break
+        except ValueError:
+            continue
+    if not isinstance(data, dict):
+        data = _regex_fields(_repair_json(s))
+
+    out: Dict[str, str] = {}
+    for key in CHAIN_JSON_FIELDS:
+        val = _as_text(data.get(key))
+        if val and val.strip(". …") and not val.startswith("{"):
+            out[key] = val
+    return out
+
 # ------------------------------------------------------------
 # Export a Word (.docx) y composición de texto
 # ------------------------------------------------------------
@@ -937,20 +1248,11 @@ def _join_people(rows: List[sqlite3.Row]) -> str:
         out.append(label)
     return "; ".join([x for x in out if x])
 
-def _compose_full_text(conn: sqlite3.Connection, case_id: str) -> str:
+def _compose_full_text(snap: CaseSnapshot) -> str:
     """Devuelve el documento completo en texto plano, para previsualizar en UI."""
-    cur = conn.cursor()
-
-    sections = {row["name"]: row for row in cur.execute(
-        "SELECT * FROM sections WHERE case_id=?", (case_id,)
-    ).fetchall()}
-
-    accionantes = [row for row in cur.execute(
-        "SELECT * FROM parties WHERE case_id=? AND role='accionante'", (case_id,)
-    ).fetchall()]
-    accionados = [row for row in cur.execute(
-        "SELECT * FROM parties WHERE case_id=? AND role='accionado'", (case_id,)
-    ).fetchall()]
+    sections = snap.sections
+    accionantes = snap.people("accionante")
+    accionados = snap.people("accionado")
 
     ref     = _pick_final(sections.get("ref")) if sections.get("ref") else ""
     intro   = _pick_final(sections.get("intro")) if sections.get("intro") else ""
@@ -1022,208 +1324,120 @@ def _compose_full_text(conn: sqlite3.Connection, case_id: str) -> str:
         parts.append("\n## Notificaciones")
         parts.append(notifs.strip())
 
-    firmas_txt = firmas.strip() or _compose_firmas_text(conn, case_id)
+    firmas_txt = firmas.strip() or _firmas_text(snap.parties)
     if firmas_txt:
         parts.append("\n## Firmas")
         parts.append(firmas_txt)
 
     return "\n".join(parts).strip()
 
-def _export_docx(conn: sqlite3.Connection, case_id: str, export_dir: str) -> Dict[str, str]:
+_PERSON_FIELDS = ("nombres", "apellidos", "tipo_id", "numero_id")
+
+def _template_or_400(name: Optional[str]) -> Optional[str]:
+    """?template=<nombre> → DOCX_TEMPLATES_DIR/<nombre>.docx; sin nombre, DOCX_TEMPLATE (o ninguna)."""
+    if not name:
+        if DOCX_TEMPLATE and not os.path.isfile(DOCX_TEMPLATE):
+            raise HTTPException(status_code=500, detail=f"DOCX_TEMPLATE no existe: {DOCX_TEMPLATE}")
+        return DOCX_TEMPLATE or None
+    if not re.fullmatch(r"[\w\-]+", name):
+        raise HTTPException(status_code=400, detail="Nombre de plantilla inválido")
+    path = os.path.join(DOCX_TEMPLATES_DIR, f"{name}.docx")
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Plantilla no encontrada: {name}")
+    return path
+
+def _list_templates() -> List[str]:
     try:
-        from docx import Document
-        from docx.shared import Pt
-        from docx.enum.text import WD_ALIGN_PARAGRAPH
-    except Exception as e:
-        raise RuntimeError("Instala 'python-docx' para exportar a Word: pip install python-docx") from e
-
-    # -------- Helpers de estilo --------
-    FONT_NAME = "Times New Roman"
-    FONT_SIZE = 12
-
-    def _set_normal_style(doc):
-        st = doc.styles["Normal"]
-        st.font.name = FONT_NAME
-        st.font.size = Pt(FONT_SIZE)
-
-    def _p(doc, text, *, bold=False, upper=False, align=None):
-        if upper:
-            text = (text or "").upper()
-        par = doc.add_paragraph()
-        if align is not None:
-            par.alignment = align
-        run = par.add_run(text or "")
-        run.bold = bool(bold)
-        run.font.name = FONT_NAME
-        run.font.size = Pt(FONT_SIZE)
-        return par
-
-    def _title(doc, text):
-        # Título en MAYÚSCULAS, centrado y en NEGRITA (sin estilos de Heading para unificar fuente)
-        return _p(doc, text, bold=True, upper=True, align=WD_ALIGN_PARAGRAPH.CENTER)
-
-    def _body(doc, text):
-        par = _p(doc, text or "", bold=False, upper=False, align=WD_ALIGN_PARAGRAPH.JUSTIFY)
-        return par
-
-    def _join_people(rows: List[sqlite3.Row]) -> str:
-        out = []
-        for r in rows:
-            nombre = " ".join([(r["nombres"] or "").strip(), (r["apellidos"] or "").strip()]).strip()
-            ident  = " ".join([(r["tipo_id"] or "").strip(), (r["numero_id"] or "").strip()]).strip()
-            label = nombre if not ident else f"{nombre} — {ident}"
-            if label:
-                out.append(label)
-        return "; ".join(out)
-
-    cur = conn.cursor()
-    case = cur.execute("SELECT * FROM cases WHERE id=?", (case_id,)).fetchone()
-    if not case:
-        raise HTTPException(status_code=404, detail="Caso no encontrado")
-
-    sections = {row["name"]: row for row in cur.execute(
-        "SELECT * FROM sections WHERE case_id=?", (case_id,)
-    ).fetchall()}
-
-    accionantes = [row for row in cur.execute(
-        "SELECT * FROM parties WHERE case_id=? AND role='accionante'", (case_id,)
-    ).fetchall()]
-    accionados = [row for row in cur.execute(
-        "SELECT * FROM parties WHERE case_id=? AND role='accionado'", (case_id,)
-    ).fetchall()]
-
-    # Selección de textos
-    def pick(name):
-        r = sections.get(name)
-        return (r["final_text"] or r["ai_text"] or r["user_text"] or "").strip() if r else ""
-
-    ref        = pick("ref")
-    intro      = pick("intro")
-    hechos     = pick("hechos")
-    der_vuln   = pick("derechos_vulnerados")
-    fund_j     = pick("fundamentos_juridicos")
-    fund_d     = pick("fundamentos_de_derecho")
-    pret       = pick("pretensiones")
-    notifs     = pick("notificaciones")
-    juramento  = pick("cumplimiento_art_37") or "JURAMENTO: Manifiesto bajo la gravedad del juramento que no se ha presentado ninguna otra acción de tutela por los mismos hechos y derechos."
-    pya        = pick("pruebas_y_anexos") or "\n".join([pick("pruebas"), pick("anexos")]).strip()
-
-    # ---- Crear doc
-    os.makedirs(export_dir, exist_ok=True)
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    basename  = f"tutela_{case_id}_{ts}"
-    docx_path = os.path.join(export_dir, f"{basename}.docx")
-    json_path = os.path.join(export_dir, f"{basename}.json")
-
-    doc = Document()
-    _set_normal_style(doc)
-
-    # ===== Encabezado (SIN la línea extra), MAYÚSCULA + NEGRITA =====
-    for line in HEADER_FIXED.split("\n"):
-        _p(doc, line, bold=True, upper=True)
-
-    # REF
-    if ref:
-        _p(doc, "", bold=False)  # espacio
-        par = doc.add_paragraph()
-        run1 = par.add_run("REF: ")
-        run1.bold = True; run1.font.name = FONT_NAME; run1.font.size = Pt(FONT_SIZE)
-        run2 = par.add_run(ref)
-        run2.font.name = FONT_NAME; run2.font.size = Pt(FONT_SIZE)
-
-    # Partes (nombres e identificaciones en MAYÚSCULA + NEGRITA)
-    _p(doc, "", bold=False)  # espacio
-    par = doc.add_paragraph()
-    r1 = par.add_run("ACCIONANTE(S): ")
-    r1.bold = True; r1.font.name = FONT_NAME; r1.font.size = Pt(FONT_SIZE)
-    r2 = par.add_run(_join_people(accionantes).upper())
-    r2.bold = True; r2.font.name = FONT_NAME; r2.font.size = Pt(FONT_SIZE)
-
-    par = doc.add_paragraph()
-    r1 = par.add_run("ACCIONADO(S): ")
-    r1.bold = True; r1.font.name = FONT_NAME; r1.font.size = Pt(FONT_SIZE)
-    r2 = par.add_run(_join_people(accionados).upper())
-    r2.bold = True; r2.font.name = FONT_NAME; r2.font.size = Pt(FONT_SIZE)
-
-    # ===== Secciones =====
-    if intro:
-        _title(doc, "Introducción")
-        _body(doc, intro)
+        return sorted(f[:-5] for f in os.listdir(DOCX_TEMPLATES_DIR) if f.endswith(".docx") and not f.startswith("~$"))
+    except OSError:
+        return []
 
-    if hechos:
-        _title(doc, "Hechos")
-        _body(doc, hechos)
+def _docx_inputs(snap: CaseSnapshot, template: Optional[str] = None) -> Dict[str, Any]:
+    """Todo lo que determina el .docx (y nada más): su hash da el nombre del archivo."""
+    pick = snap.best
+    return {
+        "layout": DOCX_LAYOUT_VERSION,
+        "template": template or "",
+        "template_sig": template_signature(template),
+        "header": HEADER_FIXED,
+        "accionantes": [{f: p[f] or "" for f in _PERSON_FIELDS} for p in snap.people("accionante")],
+        "accionados": [{f: p[f] or "" for f in _PERSON_FIELDS} for p in snap.people("accionado")],
+        "ref": pick("ref"),
+        "intro": pick("intro"),
+        "hechos": pick("hechos"),
+        "der_vuln": pick("derechos_vulnerados"),
+        "fund_j": pick("fundamentos_juridicos"),
+        "fund_d": pick("fundamentos_de_derecho"),
+        "pret": pick("pretensiones"),
+        "notifs": pick("notificaciones"),
+        "juramento": pick("cumplimiento_art_37") or "JURAMENTO: Manifiesto bajo la gravedad del juramento que no se ha presentado ninguna otra acción de tutela por los mismos hechos y derechos.",
+        "pya": pick("pruebas_y_anexos") or "\n".join([pick("pruebas"), pick("anexos")]).strip(),
+    }
 
-    if der_vuln:
-        _title(doc, "Derechos vulnerados")
-        _body(doc, der_vuln)
+def _export_docx_file(snap: CaseSnapshot, store: ExportStore, template: Optional[str] = None) -> str:
+    """.docx del caso; si ya existe uno con el mismo contenido se reutiliza (sin python-docx)."""
+    inputs = _docx_inputs(snap, template)
+    return store.get_or_create(snap.case_id, content_hash(inputs), "docx",
+                               lambda path: render_docx(inputs, path))
 
-    if fund_j:
-        _title(doc, "Fundamentos jurídicos")
-        _body(doc, fund_j)
+def _export_json_file(snap: CaseSnapshot, store: ExportStore) -> str:
+    """Bundle del caso en JSON (no toca python-docx)."""
+    data = json.dumps(snap.as_bundle(), ensure_ascii=False, indent=2)
 
-    # Pruebas y Anexos
-    _title(doc, "Pruebas y Anexos")
-    _body(doc, "Con el fin de establecer la vulneración de los derechos, solicito señor Juez se sirva tener en cuenta las siguientes pruebas y anexos:")
-    if pya.strip():
-        for i, line in enumerate([l for l in pya.splitlines() if l.strip()], start=1):
-            _body(doc, f"{i}. {line.strip()}")
+    def write(path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(data)
 
-    # Pretensiones
-    if pret.strip():
-        _title(doc, "Pretensiones")
-        for i, line in enumerate([l for l in pret.splitlines() if l.strip()], start=1):
-            _body(doc, f"{i}. {line.strip()}")
+    return store.get_or_create(snap.case_id, content_hash(data), "json", write)
 
-    # Fundamentos de derecho
-    if fund_d:
-        _title(doc, "Fundamentos de derecho")
-        for i, line in enumerate([l for l in fund_d.splitlines() if l.strip()], start=1):
-            _body(doc, f"{i}. {line.strip()}")
-
-    # Juramento
-    if juramento:
-        _title(doc, "Cumplimiento art. 37 del Decreto 2591/1991 — Juramento")
-        _body(doc, juramento)
-
-    # Notificaciones
-    if notifs:
-        _title(doc, "Notificaciones")
-        _body(doc, notifs)
-
-    # ===== FIRMAS personalizadas =====
-    _p(doc, "", bold=False)
-    _p(doc, "FIRMAS:", bold=True, upper=True)
-    _p(doc, "", bold=False); _p(doc, "", bold=False); _p(doc, "", bold=False)  # 3 saltos
-
-    # Bloques por cada accionante: línea para firma + NOMBRE + TIPO_ID NÚMERO (todo MAYÚSCULA + NEGRITA)
-    if not accionantes:
-        # Si no hay accionantes, deja un bloque vacío para firmar
-        _p(doc, "______________________________", align=WD_ALIGN_PARAGRAPH.CENTER)
-        _p(doc, "(NOMBRE DEL ACCIONANTE)", bold=True, upper=True, align=WD_ALIGN_PARAGRAPH.CENTER)
-        _p(doc, "(TIPO DE ID Y NÚMERO)", bold=True, upper=True, align=WD_ALIGN_PARAGRAPH.CENTER)
-    else:
-        for a in accionantes:
-            nombre = " ".join([(a["nombres"] or "").strip(), (a["apellidos"] or "").strip()]).strip() or "(SIN NOMBRE)"
-            ident  = " ".join([(a["tipo_id"] or "").strip(), (a["numero_id"] or "").strip()]).strip() or "ID — (PENDIENTE)"
-            _p(doc, "______________________________", align=WD_ALIGN_PARAGRAPH.CENTER)
-            _p(doc, nombre, bold=True, upper=True, align=WD_ALIGN_PARAGRAPH.CENTER)
-            _p(doc, ident, bold=True, upper=True, align=WD_ALIGN_PARAGRAPH.CENTER)
-            _p(doc, "", bold=False)  # espacio entre firmantes
-
-    # Guardar DOCX
-    doc.save(docx_path)
-
-    # Export JSON del bundle
-    bundle = _get_case_bundle(conn, case_id)
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(bundle, f, ensure_ascii=False, indent=2)
+def _export_url(path: str) -> str:
+    return f"/exports/{os.path.basename(path)}"
 
+def _export_docx(conn: sqlite3.Connection, case_id: str, store: ExportStore,
+                 template: Optional[str] = None) -> Dict[str, str]:
+    snap = load_case(conn, case_id)  # una lectura: DOCX y JSON salen de la misma instantánea
     return {
-        "docx_url": f"/exports/{os.path.basename(docx_path)}",
-        "json_url": f"/exports/{os.path.basename(json_path)}",
+        "docx_url": _export_url(_export_docx_file(snap, store, template)),
+        "json_url": _export_url(_export_json_file(snap, store)),
     }
 
+def _export_json(conn: sqlite3.Connection, case_id: str, store: ExportStore) -> str:
+    return _export_url(_export_json_file(load_case(conn, case_id), store))
+
+def _export_docx_only(conn: sqlite3.Connection, case_id: str, store: ExportStore,
+                      template: Optional[str] = None) -> str:
+    return _export_url(_export_docx_file(load_case(conn, case_id), store, template))
+
+# ------------------------------------------------------------
+# Lecturas condicionales (ETag = revisión del caso)
+# ------------------------------------------------------------
+
+def _case_etag(rev: int) -> str:
+    return f'"r{rev}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def _read_if_modified(conn: sqlite3.Connection, case_id: str, if_none_match: Optional[str],
+                      build) -> Tuple[int, Optional[Any]]:
+    """(revisión, build(snapshot)); si el cliente ya tiene esa revisión, (revisión, None) sin cargar el caso."""
+    rev = case_revision(conn, case_id)
+    if _etag_matches(if_none_match, _case_etag(rev)):
+        return rev, None
+    snap = load_case(conn, case_id)
+    return snap.revision, build(snap)
+
+async def _conditional_case_read(db_path: str, case_id: str, request: Request, build) -> Response:
+    """200 con ETag, o 304 vacío si If-None-Match coincide. no-cache: el navegador revalida siempre."""
+    rev, body = await _db(db_path, _read_if_modified, case_id, request.headers.get("if-none-match"), build)
+    headers = {"ETag": _case_etag(rev), "Cache-Control": "no-cache"}
+    if body is None:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(jsonable_encoder(body), headers=headers)
+
 # ------------------------------------------------------------
 # Pydantic models
 # ------------------------------------------------------------
@@ -1237,6 +1451,12 @@ class CaseListItem(BaseModel):
     status: str
     updated_at: str
 
+class CaseListResp(BaseModel):
+    items: List[CaseListItem]
+    next_cursor: Optional[str] = None   # pásalo como ?cursor= para la página siguiente
+    total_estimate: int
+    total_exact: bool
+
 class PartyUpsertReq(BaseModel):
     id: Optional[str] = None
     role: str  # 'accionante' | 'accionado'
@@ -1251,9 +1471,19 @@ class PartyUpsertReq(BaseModel):
 class SectionSaveReq(BaseModel):
     user_text: str
 
+class BatchSectionReq(BaseModel):
+    name: str
+    user_text: str
+
+class BatchReq(BaseModel):
+    parties: List[PartyUpsertReq] = []
+    sections: List[BatchSectionReq] = []
+    since: Optional[int] = None  # si viene, la respuesta trae también /changes?since=
+
 class SectionImproveResp(BaseModel):
     ai_text: str
     citations: List[Dict[str, Any]] = []
+    partial: bool = False  # alguna parte quedó pendiente: la sección sigue obsoleta
 
 class SectionApproveReq(BaseModel):
     source: str = "ai"  # 'ai' | 'user'
@@ -1261,13 +1491,29 @@ class SectionApproveReq(BaseModel):
 class RightsDetectResp(BaseModel):
     rights: List[str]
 
-class RunPipelineResp(BaseModel):
-    ran: List[str]
+class RightsScanReq(BaseModel):
+    texts: List[str]
+    offsets: bool = True  # False: sólo conteos (más liviano para lotes grandes)
+
+class JobResp(BaseModel):
+    job_id: str
+    status: str
+    status_url: str
+    events_url: str
 
 class ExportDocxResp(BaseModel):
     docx_url: str
     json_url: str
 
+class BulkExportReq(BaseModel):
+    case_ids: Optional[List[str]] = None  # si viene, manda sobre los filtros
+    status: Optional[str] = None          # "approved,draft"
+    updated_from: Optional[str] = None    # ISO, como en /cases
+    updated_to: Optional[str] = None
+    limit: int = 500                      # tope: BULK_EXPORT_MAX
+    include_json: bool = False            # añade el bundle .json de cada caso
+    template: Optional[str] = None        # plantilla con membrete (ver /export/templates)
+
 class ComposeFinalResp(BaseModel):
     full_text: str
 
@@ -1304,57 +1550,87 @@ def _contains_economic_claim(text: str) -> bool:
 # Gating / Dependencias para IA
 # ------------------------------------------------------------
 
-def _check_dependencies_or_409(conn: sqlite3.Connection, case_id: str, section_name: str):
+def _norm_ws(text: str) -> str:
+    """Colapsa espacios: una edición sólo de espacios/saltos no cambia la entrada efectiva."""
+    return " ".join((text or "").split())
+
+def _dep_values(snap: CaseSnapshot) -> Dict[str, str]:
+    """Valores actuales de todas las entradas que aparecen en SECTION_DEPS."""
+    values: Dict[str, str] = {}
+    for name, row in snap.sections.items():
+        values[name] = _get_best_text(row)
+        values[f"{name}.user"] = row["user_text"] or ""
+    values["@derechos_detectados"] = ",".join(
+        _detect_rights(" ".join([values.get("hechos", ""), values.get("pruebas_y_anexos", "")])))
+    values["@partes"] = (_people_inline(snap.parties, "accionante") + "|"
+                         + _people_inline(snap.parties, "accionado"))
+    return values
+
+def _section_input_hash(values: Dict[str, str], name: str) -> str:
+    raw = json.dumps([[dep, _norm_ws(values.get(dep, ""))] for dep in SECTION_DEPS[name]], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def _section_freshness(conn: sqlite3.Connection, case_id: str) -> Tuple[List[str], List[str]]:
     """
-    Asegura el orden lógico cuando se llama improve/ensure manualmente.
-    - Derechos vulnerados: requiere Hechos mejorados.
-    - Fundamentos jurídicos: requiere Derechos vulnerados + Hechos (y Pruebas si existen).
-    - Fundamentos de derecho: requiere Fundamentos jurídicos.
-    - REF: requiere Derechos + Fund. jurídicos + Fund. de derecho.
+    (frescas, obsoletas) entre las secciones con texto generado por IA.
+    Obsoleta = su input_hash no coincide con las entradas actuales o depende de una obsoleta.
     """
-    cur = conn.cursor()
-
-    def _ready(name: str) -> bool:
-        row = cur.execute("SELECT status, ai_text, final_text, user_text FROM sections WHERE case_id=? AND name=?",
-                          (case_id, name)).fetchone()
-        if not row:
-            return False
-        txt = (row["final_text"] or row["ai_text"] or row["user_text"] or "").strip()
-        return bool(txt)
-
-    if section_name == "derechos_vulnerados":
-        if not _ready("hechos"):
-            raise HTTPException(status_code=409, detail="Completa y mejora HECHOS antes de DERECHOS VULNERADOS")
+    snap = load_case(conn, case_id)
+    values = _dep_values(snap)
+    rows = snap.sections
+    fresh: List[str] = []
+    stale: List[str] = []
+    for name, deps in SECTION_DEPS.items():
+        row = rows.get(name)
+        if not row or not ((row["ai_text"] or "").strip() or (row["final_text"] or "").strip()):
+            continue  # nada generado: ni fresca ni obsoleta
+        if row["input_hash"] != _section_input_hash(values, name) or any(d in stale for d in deps):
+            stale.append(name)
+        else:
+            fresh.append(name)
+    return fresh, stale
 
-    if section_name == "fundamentos_juridicos":
-        if not _ready("hechos") or not _ready("derechos_vulnerados"):
-            raise HTTPException(status_code=409, detail="Faltan HECHOS y/o DERECHOS VULNERADOS para FUNDAMENTOS JURÍDICOS")
+def _invalidate_stale(conn: sqlite3.Connection, case_id: str) -> List[str]:
+    """Invalida sólo las secciones cuyas entradas efectivas cambiaron (reemplaza las reglas fijas)."""
+    _, stale = _section_freshness(conn, case_id)
+    # Las de usuario+IA (hechos, pretensiones, pruebas) se re-mejoran al guardar: no se borran aquí
+    stale = [n for n in stale if n not in USER_IMPROVED]
+    _invalidate_sections(conn, case_id, stale)
+    return stale
 
-    if section_name == "fundamentos_de_derecho":
-        if not _ready("fundamentos_juridicos"):
-            raise HTTPException(status_code=409, detail="Faltan FUNDAMENTOS JURÍDICOS para FUNDAMENTOS DE DERECHO")
+def _is_fresh(conn: sqlite3.Connection, case_id: str, name: str) -> bool:
+    return name in _section_freshness(conn, case_id)[0]
 
-    if section_name == "ref":
-        if not (_ready("derechos_vulnerados") and _ready("fundamentos_juridicos") and _ready("fundamentos_de_derecho")):
-            raise HTTPException(status_code=409, detail="REF requiere D + FJ + FD listos")
+def _check_dependencies_or_409(conn: sqlite3.Connection, case_id: str, section_name: str):
+    """
+    Asegura el orden lógico cuando se llama improve/ensure manualmente, según SECTION_DEPS:
+    cada sección de entrada (no derivada, no opcional) debe tener texto.
+    """
+    deps = [d for d in SECTION_DEPS.get(section_name, [])
+            if not d.startswith("@") and "." not in d and d not in OPTIONAL_DEPS]
+    if section_name in USER_IMPROVED:
+        return
+    values = _dep_values(load_case(conn, case_id))
+    missing = [d for d in deps if not (values.get(d) or "").strip()]
+    if missing:
+        label = lambda n: n.replace("_", " ").upper()
+        raise HTTPException(
+            status_code=409,
+            detail=f"Faltan {', '.join(label(m) for m in missing)} para {label(section_name)}",
+        )
 
 # ------------------------------------------------------------
 # Cadena automática (ACTIVADA: endpoint específico + pipeline)
 # ------------------------------------------------------------
 
-def _build_ctx(conn: sqlite3.Connection, case_id: str) -> Dict[str, Any]:
-    cur = conn.cursor()
-    hechos = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='hechos'", (case_id,)).fetchone())
-    dv = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='derechos_vulnerados'", (case_id,)).fetchone())
-    fj = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='fundamentos_juridicos'", (case_id,)).fetchone())
-    pruebas = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='pruebas_y_anexos'", (case_id,)).fetchone())
-
-    acc = _compose_people_inline(conn, case_id, "accionante")
-    ads = _compose_people_inline(conn, case_id, "accionado")
+def _build_ctx(snap: CaseSnapshot) -> Dict[str, Any]:
+    hechos = snap.best("hechos")
+    dv = snap.best("derechos_vulnerados")
+    fj = snap.best("fundamentos_juridicos")
+    pruebas = snap.best("pruebas_y_anexos")
+
+    acc = _people_inline(snap.parties, "accionante")
+    ads = _people_inline(snap.parties, "accionado")
     people = "Accionante(s): " + (acc or "-") + "\nAccionado(s): " + (ads or "-")
 
     derechos_detectados = _detect_rights(" ".join([hechos or "", pruebas or ""]))
@@ -1369,91 +1645,242 @@ def _build_ctx(conn: sqlite3.Connection, case_id: str) -> Dict[str, Any]:
         "derechos_detectados_dic": derechos_detectados,
     }
 
-def _improve_store(conn: sqlite3.Connection, case_id: str, name: str, llm=None, retriever=None) -> Dict[str, Any]:
-    cur = conn.cursor()
-    row = cur.execute("SELECT * FROM sections WHERE case_id=? AND name=?", (case_id, name)).fetchone()
-    user_text = (row["user_text"] or "").strip()
-    ctx = _build_ctx(conn, case_id)
-    ai_text, citations = _llm_improve_for_section(
-        name=name, user_text=user_text, ctx=ctx, llm=llm, retriever=retriever
+def _generation_hash(values: Dict[str, str], name: str) -> Optional[str]:
+    return _section_input_hash(values, name) if name in SECTION_DEPS else None
+
+def _load_improve_inputs(conn: sqlite3.Connection, case_id: str,
+                         name: str) -> Tuple[str, Dict[str, Any], Optional[str]]:
+    """(texto del usuario, ctx, hash de entradas) leídos de la MISMA instantánea."""
+    snap = load_case(conn, case_id)
+    row = snap.section(name)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Sección no existe para este caso")
+    return (row["user_text"] or "").strip(), _build_ctx(snap), _generation_hash(_dep_values(snap), name)
+
+# Mejoras en curso por (base, caso, sección): doble clic, reintentos del autosave o varias
+# pantallas pidiendo /ensure a la vez comparten UNA generación en vez de pisarse
+IMPROVE_FLIGHTS = SingleFlight()
+
+def _improve_key(db_path: str, case_id: str, name: str) -> Tuple[str, str, str]:
+    return (db_path, case_id, name)
+
+async def _improve_generate(db_path: str, case_id: str, name: str, user_text: str, ctx: Dict[str, Any],
+                            input_hash: str, llm=None, retriever=None, no_cache: bool = False) -> Dict[str, Any]:
+    ai_text, citations = await _llm_improve_for_section(
+        name=name, user_text=user_text, ctx=ctx, llm=llm, retriever=retriever, no_cache=no_cache
     )
-    return _save_section_ai(conn, case_id, name, ai_text, citations)
+    return await _db(db_path, _save_section_ai, case_id, name, ai_text, citations, input_hash)
+
+async def _improve_store(db_path: str, case_id: str, name: str, llm=None, retriever=None,
+                         no_cache: bool = False) -> Dict[str, Any]:
+    user_text, ctx, input_hash = await _db(db_path, _load_improve_inputs, case_id, name)
+
+    async def run() -> Dict[str, Any]:
+        return await _improve_generate(db_path, case_id, name, user_text, ctx, input_hash,
+                                       llm=llm, retriever=retriever, no_cache=no_cache)
+
+    # Misma etiqueta = mismas entradas: se comparte el resultado. Si cambiaron, se espera el turno.
+    return await IMPROVE_FLIGHTS.do(_improve_key(db_path, case_id, name), run,
+                                    tag=content_hash(user_text, ctx, no_cache))
 
-def _suggest_pretensiones(conn: sqlite3.Connection, case_id: str, llm=None) -> str:
+def _improve_start(db_path: str, case_id: str, name: str, check: Callable[..., None], llm=None,
+                   retriever=None, no_cache: bool = False):
+    """
+    Sin await: arranca la mejora como vuelo propio (validación incluida) o None si la sección ya
+    se está regenerando. Así dos peticiones simultáneas no pasan ambas el chequeo antes de registrarse.
+    """
+    async def run(flight) -> Dict[str, Any]:
+        await _db(db_path, check, case_id, name)
+        user_text, ctx, input_hash = await _db(db_path, _load_improve_inputs, case_id, name)
+        flight.tag = content_hash(user_text, ctx, no_cache)  # desde aquí ?join=true puede unirse
+        return await _improve_generate(db_path, case_id, name, user_text, ctx, input_hash,
+                                       llm=llm, retriever=retriever, no_cache=no_cache)
+
+    return IMPROVE_FLIGHTS.start(_improve_key(db_path, case_id, name), run)
+
+def _load_texts(conn: sqlite3.Connection, case_id: str, names: List[str]) -> Dict[str, str]:
+    """Mejor texto (final > ai > user) de cada sección pedida."""
+    return load_case(conn, case_id).texts(names)
+
+async def _suggest_pretensiones(db_path: str, case_id: str, llm=None) -> str:
     """Genera sugerencias extra de pretensiones con base en HECHOS (+pret limpias)."""
     if not llm:
         return ""
-    cur = conn.cursor()
-    hechos = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='hechos'", (case_id,)).fetchone())
-    pret = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='pretensiones'", (case_id,)).fetchone())
-    prompt = PROMPT_SUGIERE_PRETENSIONES.format(hechos=hechos, pret=pret)
+    texts = await _db(db_path, _load_texts, case_id, ["hechos", "pretensiones"])
+    prompt = PROMPT_SUGIERE_PRETENSIONES.format(hechos=texts["hechos"], pret=texts["pretensiones"])
     try:
-        resp = llm.invoke(prompt)
-        txt = getattr(resp, "content", None) or str(resp)
-        return (txt or "").strip()
+        return await _allm(llm, prompt)
     except Exception:
         return ""
 
-def _chain_autogen(conn: sqlite3.Connection, case_id: str, llm=None, retriever=None) -> Dict[str, str]:
-    cur = conn.cursor()
-    hechos = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='hechos'", (case_id,)
-    ).fetchone())
-    pruebas = _get_best_text(cur.execute(
-        "SELECT * FROM sections WHERE case_id=? AND name='pruebas_y_anexos'", (case_id,)
-    ).fetchone())
+def _append_suggested_pretensiones(conn: sqlite3.Connection, case_id: str, extra: str) -> None:
+    prev = conn.execute("SELECT * FROM sections WHERE case_id=? AND name='pretensiones'", (case_id,)).fetchone()
+    ai_base = (prev["ai_text"] or prev["user_text"] or "").strip()
+    combined = (ai_base + ("\n\nPretensiones sugeridas:\n" + extra)).strip()
+    # Sólo se añade texto: conserva el sello de las entradas con que se generó la base
+    _save_section_ai(conn, case_id, "pretensiones", combined, citations=None, input_hash=prev["input_hash"])
+
+def _set_rights(conn: sqlite3.Connection, case_id: str, rights: List[str]) -> None:
+    with conn.unit_of_work():  # N upserts, un commit
+        for r in rights:
+            _set_right(conn, case_id, r)
+
+CHAIN_STEPS = ["derechos_vulnerados", "fundamentos_juridicos", "fundamentos_de_derecho", "ref"]
+CHAIN_MODES = ("multi", "single")
+
+def _chain_mode_or_400(mode: Optional[str]) -> str:
+    mode = (mode or CHAIN_MODE or "multi").strip().lower()
+    if mode not in CHAIN_MODES:
+        raise HTTPException(status_code=400, detail=f"Modo de cadena inválido: {mode} (usa {' | '.join(CHAIN_MODES)})")
+    return mode
+
+def _chain_job_steps(mode: str) -> List[str]:
+    return (["cadena_json"] if mode == "single" else []) + CHAIN_STEPS
+
+async def _single_shot_chain(
+    llm, ctx: Dict[str, Any], retriever=None, no_cache: bool = False,
+) -> Tuple[Dict[str, str], List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Las 4 secciones de la cadena en UNA llamada (PROMPT_CADENA_JSON). Devuelve (campos válidos,
+    citas RAG para FD, fallback). Un error o timeout devuelve {} y la cadena sigue por la vía
+    multi-llamada; `fallback` dice qué campos caen a ella y por qué ({} si ninguno), para el paso
+    del trabajo. Sólo se cachea la respuesta si trae los 4 campos: una salida parcial se vuelve a pedir.
+    """
+    # Sin FJ todavía: la base de FD se recupera con los hechos
+    rag_chunks, citations = await _docs_for_prompt(retriever, ctx.get("hechos") or "", k=8)
+    prompt = PROMPT_CADENA_JSON.format(
+        hechos=ctx.get("hechos", ""),
+        pret=ctx.get("pretensiones", "") or "-",
+        pruebas=ctx.get("pruebas", "") or "-",
+        detectados=", ".join(ctx.get("derechos_detectados_dic", [])) or "(ninguno)",
+        accionantes=ctx.get("accionantes_inline", "") or "(sin registrar)",
+        accionados=ctx.get("accionados_inline", "") or "(sin registrar)",
+        base="\n".join(rag_chunks) if rag_chunks else "-",
+    )
+
+    key = model = None
+    if LLM_CACHE is not None:
+        model, temperature = _llm_identity(llm)
+        chunk_ids = [(c.get("meta") or {}).get("chunk_id") for c in citations]
+        key = cache_key("cadena_json", model, temperature, prompt, chunk_ids)
+        if no_cache:
+            LLM_CACHE.note_bypass()
+        else:
+            hit = await run_blocking(LLM_CACHE.get, key)
+            if hit is not None:
+                return _parse_chain_json(hit[0]), hit[1], {}
+
+    try:
+        raw = await _allm(llm, prompt, timeout=CHAIN_JSON_TIMEOUT)
+    except Exception as e:
+        reason = "tiempo agotado" if isinstance(e, asyncio.TimeoutError) else f"error del modelo ({type(e).__name__})"
+        return {}, citations, {"fallback": list(CHAIN_JSON_FIELDS), "fallback_reason": reason}
+    fields = _parse_chain_json(raw)
+    missing = [f for f in CHAIN_JSON_FIELDS if f not in fields]
+    if missing:
+        return fields, citations, {"fallback": missing, "fallback_reason": "campos ausentes o malformados"}
+    if key is not None:
+        await run_blocking(LLM_CACHE.put, key, "cadena_json", model, raw, citations)
+    return fields, citations, {}
+
+async def _chain_autogen(db_path: str, case_id: str, llm=None, retriever=None,
+                         job: Optional[JobContext] = None, no_cache: bool = False,
+                         skip_fresh: bool = False, mode: str = "multi") -> Dict[str, str]:
+    """
+    Cadena D → FJ → FD → REF. Con `job`, informa el progreso por paso y, al reanudar un
+    trabajo interrumpido, reutiliza lo ya guardado de los pasos completados.
+    Con `skip_fresh`, los pasos cuyas entradas no cambiaron (SECTION_DEPS) no se regeneran.
+    Con mode="single", el primer paso pendiente dispara una sola llamada JSON para las 4 secciones;
+    cada campo ausente o malformado cae a su llamada individual de siempre.
+    """
+    # Una instantánea: de ella salen los prompts y el sello de entradas de cada paso
+    snap = await _db(db_path, load_case, case_id)
+    texts = snap.texts(["hechos", "pruebas_y_anexos", "pretensiones"])
+    hechos, pruebas = texts["hechos"], texts["pruebas_y_anexos"]
 
     if not hechos.strip():
         raise HTTPException(status_code=400, detail="Faltan HECHOS (mejorados) para encadenar.")
 
     # 0) Derechos detectados por diccionario para enriquecer el prompt
     derechos_detectados_dic = _detect_rights(" ".join([hechos or "", pruebas or ""]))
+    acc_str, ads_str = _people_inline(snap.parties, "accionante"), _people_inline(snap.parties, "accionado")
+    # Entradas de SECTION_DEPS tal como las ve cada paso: las de la instantánea más lo que
+    # la propia cadena va generando (cada paso alimenta al siguiente)
+    values = _dep_values(snap)
+
+    draft: Optional[Tuple[Dict[str, str], List[Dict[str, Any]]]] = None
+
+    async def _single_shot() -> Tuple[Dict[str, str], List[Dict[str, Any]]]:
+        # Perezoso: si todos los pasos están hechos o al día, no se llama al modelo
+        nonlocal draft
+        if draft is None:
+            if job is not None:
+                await job.begin("cadena_json")
+            fields, cites, fallback = await _single_shot_chain(llm, {
+                "hechos": hechos,
+                "pretensiones": texts["pretensiones"],
+                "pruebas": pruebas,
+                "derechos_detectados_dic": derechos_detectados_dic,
+                "accionantes_inline": acc_str,
+                "accionados_inline": ads_str,
+            }, retriever=retriever, no_cache=no_cache)
+            draft = fields, cites
+            if job is not None:
+                await job.end("cadena_json", **fallback)  # el estado del paso muestra el fallback
+        return draft
+
+    async def _step(name: str, ctx: Dict[str, Any], rag=None) -> str:
+        if job is not None and job.is_done(name):
+            values[name] = (await _db(db_path, _load_texts, case_id, [name]))[name]
+            return values[name]
+        if skip_fresh and await _db(db_path, _is_fresh, case_id, name):
+            if job is not None:
+                await job.skip(name)
+            values[name] = (await _db(db_path, _load_texts, case_id, [name]))[name]
+            return values[name]
+        input_hash = _generation_hash(values, name)
+        fields, rag_cites = await _single_shot() if mode == "single" and llm else ({}, [])
+        if job is not None:
+            await job.begin(name)
+        if name in fields:
+            ai_text, cites = fields[name], (rag_cites if name == "fundamentos_de_derecho" else [])
+        else:
+            ai_text, cites = await _llm_improve_for_section(name, user_text="", ctx=ctx, llm=llm, retriever=rag,
+                                                            no_cache=no_cache)
+        await _db(db_path, _save_section_ai, case_id, name, ai_text, cites, input_hash)
+        values[name] = ai_text
+        if job is not None:
+            await job.end(name, **({"partial": True} if _is_partial(ai_text) else {}))
+        return ai_text
 
     # 1) Derechos (desde Hechos + lista detectada)
-    ctx_d = {"hechos": hechos, "derechos_detectados_dic": derechos_detectados_dic}
-    ai_d, _ = _llm_improve_for_section(
-        "derechos_vulnerados", user_text="", ctx=ctx_d, llm=llm, retriever=None
-    )
-    _save_section_ai(conn, case_id, "derechos_vulnerados", ai_d, citations=None)
+    ai_d = await _step("derechos_vulnerados", {"hechos": hechos, "derechos_detectados_dic": derechos_detectados_dic})
 
     # 2) Fundamentos jurídicos (4 subpartes, con contexto completo)
-    ctx_fj = {
+    ai_fj = await _step("fundamentos_juridicos", {
         "hechos": hechos,
         "derechos_vulnerados": ai_d,
         "pruebas": pruebas,
         "derechos_detectados_dic": derechos_detectados_dic,
-    }
-    ai_fj, _ = _llm_improve_for_section(
-        "fundamentos_juridicos", user_text="", ctx=ctx_fj, llm=llm, retriever=None
-    )
-    _save_section_ai(conn, case_id, "fundamentos_juridicos", ai_fj, citations=None)
+    })
 
     # 3) Fundamentos de derecho (RAG, desde FJ)
-    ctx_fd = {"fundamentos_juridicos": ai_fj, "hechos": hechos}
-    ai_fd, cites_fd = _llm_improve_for_section(
-        "fundamentos_de_derecho", user_text="", ctx=ctx_fd, llm=llm, retriever=retriever
-    )
-    _save_section_ai(conn, case_id, "fundamentos_de_derecho", ai_fd, citations=cites_fd)
+    ai_fd = await _step("fundamentos_de_derecho", {"fundamentos_juridicos": ai_fj, "hechos": hechos}, rag=retriever)
 
     # 4) REF (síntesis D + FJ + FD)
-    acc_str = _compose_people_inline(conn, case_id, "accionante")
-    ads_str = _compose_people_inline(conn, case_id, "accionado")
-    ctx_ref = {
+    ai_ref = await _step("ref", {
         "derechos_vulnerados": ai_d,
         "fundamentos_juridicos": ai_fj,
         "fundamentos_de_derecho": ai_fd,
         "accionantes_inline": acc_str,   # <— NUEVO
         "accionados_inline": ads_str,    # <— NUEVO
-    }
-    ai_ref, _ = _llm_improve_for_section("ref", user_text="", ctx=ctx_ref, llm=llm, retriever=None)
-    _save_section_ai(conn, case_id, "ref", ai_ref, citations=None)
+    })
 
+    if job is not None and mode == "single" and draft is None and not job.is_done("cadena_json"):
+        await job.skip("cadena_json")  # todo estaba al día: no hizo falta la llamada única
 
     # Refresca rights_detected simples (diccionario) para panel
-    for r in derechos_detectados_dic:
-        _set_right(conn, case_id, r)
+    await _db(db_path, _set_rights, case_id, derechos_detectados_dic)
 
     return {
         "derechos_vulnerados": ai_d,
@@ -1473,16 +1900,20 @@ def create_router(
     db_path: str = os.path.join(DATA_DIR_DEFAULT, "tutelas.db"),
     top_k_default: Optional[int] = None,
     max_tokens_default: Optional[int] = None,
+    job_queue: Optional[JobQueue] = None,
     **_ignore
 ) -> APIRouter:
-    os.makedirs(export_dir, exist_ok=True)
     _init_db(db_path)
     router = APIRouter()
+    exports = ExportStore(export_dir, max_age=EXPORT_MAX_AGE_DAYS * 86400, max_bytes=EXPORT_MAX_BYTES,
+                          gc_interval=EXPORT_GC_INTERVAL)
+    exports.gc()
+    bulk_last: Dict[str, Any] = {}  # resumen de la última exportación masiva (/metrics)
+    # Trabajos largos (cadena/pipeline): cola persistente; app.py la arranca en su lifespan
+    jobs = job_queue or JobQueue(db_path)
 
     # ---------------------- CASES ----------------------------
-    @router.post("/case", response_model=CaseCreateResp)
-    def create_case():
-        conn = _connect(db_path)
+    def _create_case(conn: sqlite3.Connection) -> str:
         cur = conn.cursor()
         case_id = uuid.uuid4().hex[:12]
         now = _now()
@@ -1499,218 +1930,441 @@ def create_router(
         cur.execute("UPDATE sections SET user_text=? WHERE case_id=? AND name='ref'",
                     ("Acción de Tutela para proteger el derecho a la salud en conexidad con el derecho a la vida.", case_id))
         conn.commit()
-        conn.close()
+        return case_id
+
+    @router.post("/case", response_model=CaseCreateResp)
+    async def create_case():
+        case_id = await _db(db_path, _create_case)
         return CaseCreateResp(case_id=case_id)
 
-    @router.get("/cases", response_model=List[CaseListItem])
-    def list_cases():
-        conn = _connect(db_path)
-        cur = conn.cursor()
-        rows = cur.execute("SELECT id, title, status, updated_at FROM cases ORDER BY updated_at DESC").fetchall()
-        conn.close()
-        return [CaseListItem(case_id=r["id"], title=r["title"], status=r["status"], updated_at=r["updated_at"]) for r in rows]
+    def _date_bound(value: Optional[str], end: bool) -> Optional[str]:
+        """ISO (fecha o fecha-hora) → cota comparable con updated_at; una fecha sola cubre el día entero."""
+        if not value:
+            return None
+        try:
+            dt = datetime.fromisoformat(value)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Fecha inválida: {value}")
+        if end and len(value) == 10:
+            dt = dt.replace(hour=23, minute=59, second=59)
+        return dt.isoformat(timespec="seconds")
+
+    @router.get("/cases", response_model=CaseListResp)
+    async def list_cases(
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        status: Optional[str] = None,
+        updated_from: Optional[str] = None,
+        updated_to: Optional[str] = None,
+    ):
+        """Paginado por cursor (más recientes primero). ?status=draft,approved filtra por estado."""
+        page = await _db(
+            db_path, case_list,
+            limit=max(1, min(limit, CASES_PAGE_MAX)),
+            cursor=cursor,
+            statuses=[s.strip() for s in (status or "").split(",") if s.strip()] or None,
+            updated_from=_date_bound(updated_from, end=False),
+            updated_to=_date_bound(updated_to, end=True),
+        )
+        return CaseListResp(
+            items=[CaseListItem(case_id=r["id"], title=r["title"], status=r["status"], updated_at=r["updated_at"])
+                   for r in page["items"]],
+            next_cursor=page["next_cursor"],
+            total_estimate=page["total_estimate"],
+            total_exact=page["total_exact"],
+        )
 
     @router.get("/case/{case_id}")
-    def get_case(case_id: str):
-        conn = _connect(db_path)
-        bundle = _get_case_bundle(conn, case_id)
-        conn.close()
-        return bundle
+    async def get_case(case_id: str, request: Request):
+        return await _conditional_case_read(db_path, case_id, request, CaseSnapshot.as_bundle)
+
+    @router.get("/case/{case_id}/changes")
+    async def get_changes(case_id: str, since: int = 0):
+        """Sólo lo escrito después de la revisión `since` (la `revision` de la respuesta anterior)."""
+        return await _db(db_path, case_changes, case_id, since)
 
     # ---------------------- PARTIES --------------------------
+    def _upsert_party_checked(conn: sqlite3.Connection, case_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        require_case(conn, case_id)
+        return _upsert_party(conn, case_id, data)
+
     @router.post("/case/{case_id}/party")
-    def upsert_party(case_id: str, req: PartyUpsertReq):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        data = _upsert_party(conn, case_id, req.dict())
-        conn.close()
-        return data
+    async def upsert_party(case_id: str, req: PartyUpsertReq):
+        return await _tx(db_path, _upsert_party_checked, case_id, req.dict())
 
     # ---------------------- SECTIONS -------------------------
-    @router.post("/case/{case_id}/section/{name}")
-    def save_section(case_id: str, name: str, req: SectionSaveReq):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)  # valida
+    def _save_section_checked(conn: sqlite3.Connection, case_id: str, name: str, user_text: str) -> Dict[str, Any]:
+        require_case(conn, case_id)  # valida
 
         # normalización de INTRO (reemplazos por personas)
-        if name == "intro" and (req.user_text or "").strip():
+        if name == "intro" and (user_text or "").strip():
             ads = _compose_people_inline(conn, case_id, "accionado")
             if ads:
-                txt = req.user_text
+                txt = user_text
                 txt = X_RE.sub(ads, txt)
                 txt = RE_SENTINEL.sub(ads, txt)
                 txt = RE_CONTRA_BLOCK.sub(rf"\1{ads}\3", txt)
-                req.user_text = txt
-
-        row = _save_section_user_text(conn, case_id, name, req.user_text or "")
-
-        # --- Mejora automática al guardar + invalidaciones dependientes ---
-        if name == "hechos":
-            _improve_store(conn, case_id, "hechos", llm=llm, retriever=retriever)
-            # Derechos dependen de Hechos; y a su vez FJ, FD, REF dependen en cadena
-            _invalidate_sections(conn, case_id, ["derechos_vulnerados", "fundamentos_juridicos", "fundamentos_de_derecho", "ref"])
-
-        elif name == "pretensiones":
-            # Mejora + sugerencias (aunque no alimenta Derechos)
-            _improve_store(conn, case_id, "pretensiones", llm=llm, retriever=retriever)
-            extra = _suggest_pretensiones(conn, case_id, llm=llm)
-            if extra.strip():
-                cur2 = conn.cursor()
-                prev = cur2.execute("SELECT * FROM sections WHERE case_id=? AND name='pretensiones'", (case_id,)).fetchone()
-                ai_base = (prev["ai_text"] or prev["user_text"] or "").strip()
-                combined = (ai_base + ("\n\nPretensiones sugeridas:\n" + extra)).strip()
-                _save_section_ai(conn, case_id, "pretensiones", combined, citations=None)
-            # NO invalida cadena (por tu regla, Derechos salen SOLO de Hechos)
-
-        elif name == "pruebas_y_anexos":
-            _improve_store(conn, case_id, "pruebas_y_anexos", llm=llm, retriever=retriever)
-            # Fundamentos jurídicos (y en consecuencia FD, REF) dependen de Pruebas
-            _invalidate_sections(conn, case_id, ["fundamentos_juridicos", "fundamentos_de_derecho", "ref"])
-
-        conn.close()
-        return {"row": row, "cascade": []}
+                user_text = txt
+
+        return _save_section_user_text(conn, case_id, name, user_text or "")
+
+    def _save_section_uow(conn: sqlite3.Connection, case_id: str, name: str, user_text: str,
+                          no_cache: bool) -> Tuple[Dict[str, Any], Optional[List[str]]]:
+        """
+        Guardado + (si no hace falta LLM) cascada en una sola transacción.
+        Devuelve (fila, cascada); cascada None = falta la mejora IA y la cascada va después.
+        """
+        row = _save_section_checked(conn, case_id, name, user_text)
+        if name in USER_IMPROVED:
+            if no_cache or not _is_fresh(conn, case_id, name):
+                return row, None
+            # Mismo texto (salvo espacios): se conserva la mejora previa, sin LLM
+            _mark_ai_suggested(conn, case_id, name)
+        # --- Invalidación según el grafo: sólo lo que depende de entradas que cambiaron ---
+        return row, _invalidate_stale(conn, case_id)
+
+    def _append_and_cascade(conn: sqlite3.Connection, case_id: str, extra: str) -> List[str]:
+        if extra.strip():
+            _append_suggested_pretensiones(conn, case_id, extra)
+        return _invalidate_stale(conn, case_id)
 
-    @router.post("/case/{case_id}/section/{name}/improve", response_model=SectionImproveResp)
-    def improve_section(case_id: str, name: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
+    @router.post("/case/{case_id}/section/{name}")
+    async def save_section(case_id: str, name: str, req: SectionSaveReq, no_cache: bool = False):
+        row, cascade = await _tx(db_path, _save_section_uow, case_id, name, req.user_text or "", no_cache)
+
+        # --- Mejora automática al guardar (sólo si el texto cambió de verdad) ---
+        if cascade is None:
+            await _improve_store(db_path, case_id, name, llm=llm, retriever=retriever, no_cache=no_cache)
+            # Mejora + sugerencias (no alimentan la cadena)
+            extra = await _suggest_pretensiones(db_path, case_id, llm=llm) if name == "pretensiones" else ""
+            cascade = await _tx(db_path, _append_and_cascade, case_id, extra)
+        return {"row": row, "cascade": cascade}
+
+    def _check_improvable(conn: sqlite3.Connection, case_id: str, name: str) -> None:
+        require_case(conn, case_id)
         meta = SECTIONS_CONFIG.get(name)
         if not meta:
-            conn.close()
             raise HTTPException(status_code=404, detail=f"Sección desconocida: {name}")
         if not meta["needs_llm"]:
-            conn.close()
             raise HTTPException(status_code=400, detail="Esta sección no requiere LLM")
-
         _check_dependencies_or_409(conn, case_id, name)
-        updated = _improve_store(conn, case_id, name, llm=llm, retriever=retriever)
+
+    def _in_flight_resp(request: Request, case_id: str, name: str) -> Optional[JSONResponse]:
+        """202 con puntero al trabajo si la sección ya se está regenerando (None si no)."""
+        flight = IMPROVE_FLIGHTS.get(_improve_key(db_path, case_id, name))
+        if flight is None:
+            return None
+        url = request.url_for("section_flight", case_id=case_id, name=name).path
+        return JSONResponse(
+            status_code=202,
+            content={"status": "in_progress", "case_id": case_id, "name": name, **flight.info(), "status_url": url},
+            headers={"Location": url},
+        )
+
+    async def _improve_or_202(request: Request, case_id: str, name: str, check: Callable[..., None],
+                              no_cache: bool, join: bool) -> Union[Dict[str, Any], JSONResponse]:
+        """Fila guardada tras mejorar la sección, o 202 si ya hay una regeneración en curso (salvo ?join=true)."""
+        if join:
+            await _db(db_path, check, case_id, name)
+            return await _improve_store(db_path, case_id, name, llm=llm, retriever=retriever, no_cache=no_cache)
+        flight = _improve_start(db_path, case_id, name, check, llm=llm, retriever=retriever, no_cache=no_cache)
+        if flight is None:
+            return _in_flight_resp(request, case_id, name)
+        return await asyncio.shield(flight.task)
+
+    def _load_section_ai(conn: sqlite3.Connection, case_id: str, name: str) -> Dict[str, Any]:
+        require_case(conn, case_id)
+        row = conn.execute("SELECT ai_text, citations_json, updated_at FROM sections WHERE case_id=? AND name=?",
+                           (case_id, name)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Sección no existe para este caso")
+        return {"ai_text": row["ai_text"] or "", "citations": json.loads(row["citations_json"] or "[]"),
+                "updated_at": row["updated_at"]}
+
+    @router.get("/case/{case_id}/section/{name}/flight")
+    async def section_flight(case_id: str, name: str, request: Request, wait: float = 0):
+        """
+        Estado de la regeneración en curso de una sección. ?wait=<s> (máx. 30) espera a que
+        termine; al terminar (o si no hay ninguna) devuelve el texto IA guardado.
+        """
+        if wait > 0:
+            await IMPROVE_FLIGHTS.wait(_improve_key(db_path, case_id, name), timeout=min(wait, 30.0))
+        busy = _in_flight_resp(request, case_id, name)
+        if busy is not None:
+            return busy
+        return {"status": "idle", "case_id": case_id, "name": name,
+                **await _db(db_path, _load_section_ai, case_id, name)}
+
+    @router.post("/case/{case_id}/section/{name}/improve", response_model=SectionImproveResp)
+    async def improve_section(case_id: str, name: str, request: Request, no_cache: bool = False, join: bool = False):
+        """Si la sección ya se está regenerando: 202 + status_url; ?join=true espera ese resultado."""
+        updated = await _improve_or_202(request, case_id, name, _check_improvable, no_cache, join)
+        if isinstance(updated, JSONResponse):
+            return updated
 
         # Si mejoramos derechos → actualizar derechos_detected (encadenes mínimos)
         if name in ("derechos_vulnerados",):
             rights = _detect_rights(updated["ai_text"] or updated["user_text"] or "")
-            for r in rights:
-                _set_right(conn, case_id, r)
+            await _db(db_path, _set_rights, case_id, rights)
+
+        return SectionImproveResp(ai_text=updated["ai_text"], citations=json.loads(updated["citations_json"] or "[]"),
+                                  partial=_is_partial(updated["ai_text"]))
 
-        conn.close()
-        return SectionImproveResp(ai_text=updated["ai_text"], citations=json.loads(updated["citations_json"] or "[]"))
+    def _approve_section_checked(conn: sqlite3.Connection, case_id: str, name: str, source: str) -> Dict[str, Any]:
+        require_case(conn, case_id)
+        return _approve_section(conn, case_id, name, source=source)
 
     @router.post("/case/{case_id}/section/{name}/approve")
-    def approve_section(case_id: str, name: str, req: SectionApproveReq):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        updated = _approve_section(conn, case_id, name, source=req.source)
-        conn.close()
-        return updated
+    async def approve_section(case_id: str, name: str, req: SectionApproveReq):
+        return await _db(db_path, _approve_section_checked, case_id, name, req.source)
 
     # ---------------------- RIGHTS ---------------------------
-    @router.post("/case/{case_id}/rights/detect", response_model=RightsDetectResp)
-    def detect_rights(case_id: str):
-        conn = _connect(db_path)
-        cur = conn.cursor()
-        hechos = cur.execute("SELECT * FROM sections WHERE case_id=? AND name='hechos'", (case_id,)).fetchone()
-        derechos = cur.execute("SELECT * FROM sections WHERE case_id=? AND name='derechos_vulnerados'", (case_id,)).fetchone()
-        text = " ".join([
-            (hechos["final_text"] or hechos["ai_text"] or hechos["user_text"] or ""),
-            (derechos["final_text"] or derechos["ai_text"] or derechos["user_text"] or ""),
-        ])
+    def _detect_and_store_rights(conn: sqlite3.Connection, case_id: str) -> List[str]:
+        snap = load_case(conn, case_id)
+        text = " ".join([snap.best("hechos"), snap.best("derechos_vulnerados")])
         rights = _detect_rights(text)
-        for r in rights:
-            _set_right(conn, case_id, r)
-        conn.close()
+        _set_rights(conn, case_id, rights)
+        return rights
+
+    @router.post("/case/{case_id}/rights/detect", response_model=RightsDetectResp)
+    async def detect_rights(case_id: str):
+        rights = await _db(db_path, _detect_and_store_rights, case_id)
         return RightsDetectResp(rights=rights)
 
-    @router.post("/case/{case_id}/rights/{right_name}/argue")
-    def argue_right(case_id: str, right_name: str):
-        conn = _connect(db_path)
-        cur = conn.cursor()
-        hechos = cur.execute("SELECT * FROM sections WHERE case_id=? AND name='hechos'", (case_id,)).fetchone()
-        derechos = cur.execute("SELECT * FROM sections WHERE case_id=? AND name='derechos_vulnerados'", (case_id,)).fetchone()
-        user_text = (
-            f"Hechos:\n{(hechos['final_text'] or hechos['ai_text'] or hechos['user_text'] or '').strip()}\n\n"
-            f"Derechos:\n{(derechos['final_text'] or derechos['ai_text'] or derechos['user_text'] or '').strip()}\n\n"
+    @router.post("/rights/scan")
+    async def scan_rights(req: RightsScanReq):
+        """Lote de textos libres: por texto, derechos con nº de coincidencias (y offsets)."""
+        results = await run_blocking(lambda: list(RIGHTS_MATCHER.scan_many(req.texts, offsets=req.offsets)))
+        return {"results": results}
+
+    def _rights_tally(conn: sqlite3.Connection, section: str, statuses: Optional[List[str]]) -> Dict[str, Any]:
+        sql = """
+            SELECT s.final_text, s.ai_text, s.user_text FROM sections s
+            JOIN cases c ON c.id = s.case_id WHERE s.name=?
+        """
+        params: List[Any] = [section]
+        if statuses:
+            sql += f" AND c.status IN ({','.join('?' * len(statuses))})"
+            params += statuses
+        n, tally = 0, {}
+        texts = (_get_best_text(r) for r in conn.execute(sql, params))
+        for found in RIGHTS_MATCHER.scan_many(texts):
+            n += 1
+            for right, hit in found.items():
+                t = tally.setdefault(right, {"cases": 0, "matches": 0})
+                t["cases"] += 1
+                t["matches"] += hit["count"]
+        return {"section": section, "cases": n, "rights": dict(sorted(tally.items()))}
+
+    @router.get("/analytics/rights")
+    async def rights_analytics(section: str = "hechos", status: Optional[str] = None):
+        """Derechos detectados en una sección de todos los casos (una pasada, sin cargar casos)."""
+        if section not in SECTIONS_CONFIG:
+            raise HTTPException(status_code=404, detail=f"Sección desconocida: {section}")
+        statuses = [s.strip() for s in (status or "").split(",") if s.strip()] or None
+        return await _db(db_path, _rights_tally, section, statuses)
+
+    def _argue_inputs(conn: sqlite3.Connection, case_id: str, right_name: str) -> str:
+        snap = load_case(conn, case_id)
+        return (
+            f"Hechos:\n{snap.best('hechos')}\n\n"
+            f"Derechos:\n{snap.best('derechos_vulnerados')}\n\n"
             f"Derecho específico: {right_name}"
         )
-        ai_text, citations = _llm_improve_for_section(
+
+    @router.post("/case/{case_id}/rights/{right_name}/argue")
+    async def argue_right(case_id: str, right_name: str, no_cache: bool = False):
+        user_text = await _db(db_path, _argue_inputs, case_id, right_name)
+        ai_text, citations = await _llm_improve_for_section(
             name="derechos_vulnerados",
             user_text=user_text,
             ctx={},
             llm=llm,
-            retriever=retriever
+            retriever=retriever,
+            no_cache=no_cache,
         )
-        row = _set_right(conn, case_id, right_name, argument_ai=ai_text, sources=citations)
-        conn.close()
-        return row
+        return await _db(db_path, _set_right, case_id, right_name, argument_ai=ai_text, sources=citations)
 
     # Endpoint para refrescar intro manualmente (útil para casos viejos)
-    @router.post("/case/{case_id}/intro/refresh")
-    def refresh_intro(case_id: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
+    def _refresh_intro_checked(conn: sqlite3.Connection, case_id: str) -> str:
+        require_case(conn, case_id)
         _refresh_intro_after_party(conn, case_id)
         row = conn.execute("SELECT * FROM sections WHERE case_id=? AND name='intro'", (case_id,)).fetchone()
-        conn.close()
-        return {"ok": True, "intro": _get_best_text(row)}
+        return _get_best_text(row)
 
-    # ---------------------- CADENA (nuevo endpoint) ----------
-    @router.post("/case/{case_id}/chain/autogen")
-    def chain_autogen(case_id: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        out = _chain_autogen(conn, case_id, llm=llm, retriever=retriever)
-        conn.close()
+    @router.post("/case/{case_id}/intro/refresh")
+    async def refresh_intro(case_id: str):
+        intro = await _db(db_path, _refresh_intro_checked, case_id)
+        return {"ok": True, "intro": intro}
+
+    # ---------------------- LOTE -----------------------------
+    def _apply_batch(conn: sqlite3.Connection, case_id: str, parties: List[Dict[str, Any]],
+                     sections: List[Dict[str, Any]], no_cache: bool):
+        """Partes y luego secciones (la intro ya ve las partes nuevas); un error deshace todo."""
+        require_case(conn, case_id)
+        party_rows = [_upsert_party(conn, case_id, p) for p in parties]
+        section_rows, pending, cascade = [], [], []
+        for sec in sections:
+            row, sc = _save_section_uow(conn, case_id, sec["name"], sec["user_text"] or "", no_cache)
+            section_rows.append(row)
+            if sc is None:
+                pending.append(sec["name"])
+            else:
+                cascade += [n for n in sc if n not in cascade]
+        return party_rows, section_rows, pending, cascade
+
+    @router.post("/case/{case_id}/batch")
+    async def batch(case_id: str, req: BatchReq, no_cache: bool = False):
+        """Varias ediciones de partes y secciones en una petición y una transacción."""
+        parties, sections, pending, cascade = await _tx(
+            db_path, _apply_batch, case_id,
+            [p.dict() for p in req.parties], [sec.dict() for sec in req.sections], no_cache)
+
+        # Como en save_section: la mejora IA (si el texto cambió) y su cascada van después
+        if pending:
+            extra = ""
+            for name in pending:
+                await _improve_store(db_path, case_id, name, llm=llm, retriever=retriever, no_cache=no_cache)
+                if name == "pretensiones":
+                    extra = await _suggest_pretensiones(db_path, case_id, llm=llm)
+            cascade += [n for n in await _tx(db_path, _append_and_cascade, case_id, extra) if n not in cascade]
+
+        out: Dict[str, Any] = {"parties": parties, "sections": sections, "cascade": cascade}
+        if req.since is not None:
+            out["changes"] = await _db(db_path, case_changes, case_id, req.since)
+        return out
+
+    # ---------------------- TRABAJOS (cola persistente) -------
+    # La cadena y el pipeline encadenan 7–9 llamadas al LLM: se encolan y responden 202 con
+    # job_id al instante; el progreso por paso se consulta por sondeo o SSE.
+    async def _job_chain(job: JobContext) -> Dict[str, Any]:
+        out = await _chain_autogen(db_path, job.case_id, llm=llm, retriever=retriever, job=job,
+                                   no_cache=job.payload.get("no_cache", False),
+                                   mode=job.payload.get("mode", "multi"))
         return {"ok": True, "generated": out}
 
-    # ---------------------- PIPELINE (IA controlada) ---------
     # Ahora el pipeline corre: HECHOS -> (opcional) PRETENSIONES + sugerencias -> CADENA
-    @router.post("/case/{case_id}/run-pipeline", response_model=RunPipelineResp)
-    def run_pipeline(case_id: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        ran: List[str] = []
+    async def _job_pipeline(job: JobContext) -> Dict[str, Any]:
+        case_id = job.case_id
+        no_cache = job.payload.get("no_cache", False)
+        skip_fresh = not job.payload.get("force", False)
+
+        async def _fresh(name: str) -> bool:
+            return skip_fresh and await _db(db_path, _is_fresh, case_id, name)
 
         # 1) Hechos
-        _improve_store(conn, case_id, "hechos", llm=llm, retriever=retriever)
-        ran.append("hechos")
+        if not job.is_done("hechos") and await _fresh("hechos"):
+            await job.skip("hechos")
+        if not job.is_done("hechos"):
+            await job.begin("hechos")
+            await _improve_store(db_path, case_id, "hechos", llm=llm, retriever=retriever, no_cache=no_cache)
+            await job.end("hechos")
 
         # 2) Pretensiones (si hay texto del usuario)
-        cur = conn.cursor()
-        pret_row = cur.execute("SELECT * FROM sections WHERE case_id=? AND name='pretensiones'", (case_id,)).fetchone()
-        if (pret_row["user_text"] or "").strip():
-            _improve_store(conn, case_id, "pretensiones", llm=llm, retriever=retriever)
-            extra = _suggest_pretensiones(conn, case_id, llm=llm)
-            if extra.strip():
-                prev = cur.execute("SELECT * FROM sections WHERE case_id=? AND name='pretensiones'", (case_id,)).fetchone()
-                ai_base = (prev["ai_text"] or prev["user_text"] or "").strip()
-                combined = (ai_base + ("\n\nPretensiones sugeridas:\n" + extra)).strip()
-                _save_section_ai(conn, case_id, "pretensiones", combined, citations=None)
-            ran.append("pretensiones")
+        if not job.is_done("pretensiones") and await _fresh("pretensiones"):
+            await job.skip("pretensiones")
+        if not job.is_done("pretensiones"):
+            pret_row = await _db(db_path, lambda conn: conn.execute(
+                "SELECT * FROM sections WHERE case_id=? AND name='pretensiones'", (case_id,)).fetchone())
+            if (pret_row["user_text"] or "").strip():
+                await job.begin("pretensiones")
+                await _improve_store(db_path, case_id, "pretensiones", llm=llm, retriever=retriever, no_cache=no_cache)
+                extra = await _suggest_pretensiones(db_path, case_id, llm=llm)
+                if extra.strip():
+                    await _db(db_path, _append_suggested_pretensiones, case_id, extra)
+                await job.end("pretensiones")
+            else:
+                await job.skip("pretensiones")
 
         # 3) Cadena (derechos → fundamentos → fundamentos de derecho → ref)
-        _chain_autogen(conn, case_id, llm=llm)
-        ran.extend(["derechos_vulnerados","fundamentos_juridicos","fundamentos_de_derecho","ref"])
+        await _chain_autogen(db_path, case_id, llm=llm, job=job, no_cache=no_cache, skip_fresh=skip_fresh,
+                             mode=job.payload.get("mode", "multi"))
+
+        ran = [st["name"] for st in job.steps if st["status"] == "done"]
+        skipped = [st["name"] for st in job.steps if st["status"] == "skipped"]
+        partial = [st["name"] for st in job.steps if st.get("partial")]
+        return {"ran": ran, "skipped": skipped, "partial": partial}
+
+    jobs.register("chain_autogen", _job_chain)
+    jobs.register("run_pipeline", _job_pipeline)
+
+    def _job_resp(request: Request, job: Dict[str, Any]) -> JobResp:
+        return JobResp(
+            job_id=job["id"],
+            status=job["status"],
+            status_url=request.url_for("job_status", job_id=job["id"]).path,
+            events_url=request.url_for("job_events", job_id=job["id"]).path,
+        )
+
+    # ---------------------- CADENA (nuevo endpoint) ----------
+    @router.post("/case/{case_id}/chain/autogen", response_model=JobResp, status_code=202)
+    async def chain_autogen(case_id: str, request: Request, no_cache: bool = False, mode: Optional[str] = None):
+        """?mode=single: las 4 secciones en una sola llamada JSON (fallback por sección a multi)."""
+        mode = _chain_mode_or_400(mode)
+        await _db(db_path, require_case, case_id)
+        job = await jobs.enqueue("chain_autogen", case_id=case_id, payload={"no_cache": no_cache, "mode": mode},
+                                 steps=_chain_job_steps(mode))
+        return _job_resp(request, job)
 
-        conn.close()
-        return RunPipelineResp(ran=ran)
+    # ---------------------- PIPELINE (IA controlada) ---------
+    @router.post("/case/{case_id}/run-pipeline", response_model=JobResp, status_code=202)
+    async def run_pipeline(case_id: str, request: Request, no_cache: bool = False, force: bool = False,
+                           mode: Optional[str] = None):
+        """Salta los pasos al día (entradas sin cambios); ?force=1 los regenera todos; ?mode= como la cadena."""
+        mode = _chain_mode_or_400(mode)
+        await _db(db_path, require_case, case_id)
+        job = await jobs.enqueue("run_pipeline", case_id=case_id,
+                                 payload={"no_cache": no_cache, "force": force, "mode": mode},
+                                 steps=["hechos", "pretensiones", *_chain_job_steps(mode)])
+        return _job_resp(request, job)
+
+    @router.get("/metrics")
+    async def wizard_metrics():
+        return {
+            "llm_cache": await run_blocking(LLM_CACHE.metrics) if LLM_CACHE is not None else None,
+            "sqlite": get_pool(db_path).metrics(),
+            "exports": await run_blocking(exports.metrics),
+            "bulk_export": bulk_last or None,
+            "improve_flights": IMPROVE_FLIGHTS.metrics(),
+        }
+
+    @router.get("/jobs/{job_id}")
+    async def job_status(job_id: str):
+        return await jobs.get(job_id)
+
+    @router.post("/jobs/{job_id}/cancel")
+    async def job_cancel(job_id: str):
+        return await jobs.cancel(job_id)
+
+    @router.get("/jobs/{job_id}/events")
+    async def job_events(job_id: str):
+        """SSE: un evento 'job' (instantánea completa) por cada cambio; 'end' al terminar."""
+        await jobs.get(job_id)  # 404 antes de abrir el stream
+
+        async def _events():
+            last = None
+            async for snap in jobs.watch(job_id):
+                last = snap
+                yield f"event: job\ndata: {json.dumps(snap, ensure_ascii=False)}\n\n"
+            yield f"event: end\ndata: {json.dumps({'status': last and last['status']})}\n\n"
+
+        return StreamingResponse(
+            _events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     # ---------------------- COMPOSE / EXPORT -----------------
     @router.get("/case/{case_id}/compose-final", response_model=ComposeFinalResp)
-    def compose_final(case_id: str):
+    async def compose_final(case_id: str, request: Request):
         """Devuelve el documento completo concatenado en texto plano."""
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        text = _compose_full_text(conn, case_id)
-        conn.close()
-        return ComposeFinalResp(full_text=text)
+        return await _conditional_case_read(
+            db_path, case_id, request, lambda snap: ComposeFinalResp(full_text=_compose_full_text(snap)))
 
     # NUEVO: bundle estructurado (útil para render.html editable)
-    @router.get("/case/{case_id}/compose-structured")
-    def compose_structured(case_id: str):
-        conn = _connect(db_path)
-        cur = conn.cursor()
-        _get_case_bundle(conn, case_id)
-
+    def _compose_structured(snap: CaseSnapshot) -> Dict[str, Any]:
         def row(name: str):
-            r = cur.execute("SELECT * FROM sections WHERE case_id=? AND name=?", (case_id, name)).fetchone()
+            r = snap.section(name)
             return {
                 "user": (r["user_text"] if r else "") or "",
                 "ai": (r["ai_text"] if r else "") or "",
@@ -1718,12 +2372,12 @@ def create_router(
                 "status": (r["status"] if r else "empty")
             }
 
-        out = {
+        return {
             "auto": {
-                "intro": _get_best_text(cur.execute("SELECT * FROM sections WHERE case_id=? AND name='intro'", (case_id,)).fetchone()),
-                "notificaciones": _get_best_text(cur.execute("SELECT * FROM sections WHERE case_id=? AND name='notificaciones'", (case_id,)).fetchone()),
-                "firmas": _get_best_text(cur.execute("SELECT * FROM sections WHERE case_id=? AND name='firmas'", (case_id,)).fetchone()),
-                "cumplimiento_art_37": _get_best_text(cur.execute("SELECT * FROM sections WHERE case_id=? AND name='cumplimiento_art_37'", (case_id,)).fetchone()),
+                "intro": snap.best("intro"),
+                "notificaciones": snap.best("notificaciones"),
+                "firmas": snap.best("firmas"),
+                "cumplimiento_art_37": snap.best("cumplimiento_art_37"),
             },
             "hechos": row("hechos"),
             "pretensiones": row("pretensiones"),
@@ -1735,72 +2389,187 @@ def create_router(
                 "ref": row("ref"),
             }
         }
-        conn.close()
-        return out
+
+    @router.get("/case/{case_id}/compose-structured")
+    async def compose_structured(case_id: str, request: Request):
+        return await _conditional_case_read(db_path, case_id, request, _compose_structured)
 
     # ---------------------- ENSURE (auto por pantalla) -------------------------
+    def _ensure_ready(conn: sqlite3.Connection, case_id: str, name: str) -> None:
+        require_case(conn, case_id)
+        _check_dependencies_or_409(conn, case_id, name)
+
     @router.get("/case/{case_id}/ensure/derechos_vulnerados")
-    def ensure_derechos(case_id: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        _check_dependencies_or_409(conn, case_id, "derechos_vulnerados")
-        updated = _improve_store(conn, case_id, "derechos_vulnerados", llm=llm, retriever=retriever)
+    async def ensure_derechos(case_id: str, request: Request, no_cache: bool = False, join: bool = False):
+        updated = await _improve_or_202(request, case_id, "derechos_vulnerados", _ensure_ready, no_cache, join)
+        if isinstance(updated, JSONResponse):
+            return updated
         # refresca derechos_detected simples
         rights = _detect_rights((updated["ai_text"] or updated["user_text"] or ""))
-        for r in rights:
-            _set_right(conn, case_id, r)
-        conn.close()
+        await _db(db_path, _set_rights, case_id, rights)
         return {"name": "derechos_vulnerados", "ai_text": updated["ai_text"]}
 
     @router.get("/case/{case_id}/ensure/fundamentos_juridicos")
-    def ensure_fund_j(case_id: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        _check_dependencies_or_409(conn, case_id, "fundamentos_juridicos")
-        updated = _improve_store(conn, case_id, "fundamentos_juridicos", llm=llm, retriever=retriever)
-        conn.close()
-        return {"name": "fundamentos_juridicos", "ai_text": updated["ai_text"]}
+    async def ensure_fund_j(case_id: str, request: Request, no_cache: bool = False, join: bool = False):
+        updated = await _improve_or_202(request, case_id, "fundamentos_juridicos", _ensure_ready, no_cache, join)
+        if isinstance(updated, JSONResponse):
+            return updated
+        return {"name": "fundamentos_juridicos", "ai_text": updated["ai_text"], "partial": _is_partial(updated["ai_text"])}
 
     @router.get("/case/{case_id}/ensure/fundamentos_de_derecho")
-    def ensure_fund_d(case_id: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        _check_dependencies_or_409(conn, case_id, "fundamentos_de_derecho")
-        updated = _improve_store(conn, case_id, "fundamentos_de_derecho", llm=llm, retriever=retriever)
-        conn.close()
+    async def ensure_fund_d(case_id: str, request: Request, no_cache: bool = False, join: bool = False):
+        updated = await _improve_or_202(request, case_id, "fundamentos_de_derecho", _ensure_ready, no_cache, join)
+        if isinstance(updated, JSONResponse):
+            return updated
         return {"name": "fundamentos_de_derecho", "ai_text": updated["ai_text"]}
 
     @router.get("/case/{case_id}/ensure/ref")
-    def ensure_ref(case_id: str):
-        conn = _connect(db_path)
-        _get_case_bundle(conn, case_id)
-        _check_dependencies_or_409(conn, case_id, "ref")
-        updated = _improve_store(conn, case_id, "ref", llm=llm, retriever=retriever)
-        conn.close()
+    async def ensure_ref(case_id: str, request: Request, no_cache: bool = False, join: bool = False):
+        updated = await _improve_or_202(request, case_id, "ref", _ensure_ready, no_cache, join)
+        if isinstance(updated, JSONResponse):
+            return updated
         return {"name": "ref", "ai_text": updated["ai_text"]}
 
     @router.post("/case/{case_id}/export-docx", response_model=ExportDocxResp)
-    def export_docx(case_id: str):
-        conn = _connect(db_path)
-        urls = _export_docx(conn, case_id, export_dir)
-        conn.close()
+    async def export_docx(case_id: str, template: Optional[str] = None):
+        urls = await _db(db_path, _export_docx, case_id, exports, _template_or_400(template))
         return ExportDocxResp(**urls)
 
     # NUEVOS shortcuts GET para descargas (útiles en front simple)
     @router.get("/export/docx/{case_id}")
-    def export_docx_get(case_id: str):
-        conn = _connect(db_path)
-        urls = _export_docx(conn, case_id, export_dir)
-        conn.close()
+    async def export_docx_get(case_id: str, template: Optional[str] = None):
+        url = await _db(db_path, _export_docx_only, case_id, exports, _template_or_400(template))
         # compat con UIs que esperan 'path'/'filename'
-        return {"path": urls["docx_url"], "filename": os.path.basename(urls["docx_url"])}
+        return {"path": url, "filename": os.path.basename(url)}
 
     @router.get("/export/json/{case_id}")
-    def export_json_get(case_id: str):
-        # exporta el bundle de caso (no el texto concatenado)
-        conn = _connect(db_path)
-        urls = _export_docx(conn, case_id, export_dir)
-        conn.close()
-        return {"path": urls["json_url"], "filename": os.path.basename(urls["json_url"])}
+    async def export_json_get(case_id: str):
+        # exporta el bundle de caso (no el texto concatenado); no genera el .docx
+        url = await _db(db_path, _export_json, case_id, exports)
+        return {"path": url, "filename": os.path.basename(url)}
+
+    @router.get("/export/templates")
+    async def export_templates():
+        """Plantillas con membrete disponibles para ?template= (y la usada por defecto)."""
+        return {"templates": _list_templates(), "default": os.path.basename(DOCX_TEMPLATE) or None}
+
+    # ---------------------- EXPORTACIÓN MASIVA ---------------
+    # Los .docx se renderizan en el pool de procesos (python-docx es CPU y GIL); el ZIP sale
+    # por streaming en orden de llegada, entrada por entrada, sin armarlo en memoria.
+    def _bulk_case_ids(conn: sqlite3.Connection, case_ids: Optional[List[str]], statuses: Optional[List[str]],
+                       updated_from: Optional[str], updated_to: Optional[str], cap: int) -> List[str]:
+        if case_ids:
+            return list(dict.fromkeys(i.strip() for i in case_ids if i and i.strip()))[:cap]
+        ids: List[str] = []
+        cursor = None
+        while len(ids) < cap:
+            page = case_list(conn, limit=min(CASES_PAGE_MAX, cap - len(ids)), cursor=cursor, statuses=statuses,
+                             updated_from=updated_from, updated_to=updated_to)
+            ids += [r["id"] for r in page["items"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        return ids
+
+    async def _bulk_render(case_id: str, include_json: bool, template: Optional[str],
+                           stats: Dict[str, int]) -> Tuple[str, Optional[str]]:
+        snap = await _db(db_path, load_case, case_id)
+        inputs = _docx_inputs(snap, template)
+
+        async def write(tmp: str) -> None:
+            await run_in_process(render_docx, inputs, tmp)
+            stats["rendered"] += 1
+
+        docx_path = await exports.aget_or_create(case_id, content_hash(inputs), "docx", write)
+        json_path = await run_blocking(_export_json_file, snap, exports) if include_json else None
+        return docx_path, json_path
+
+    @router.post("/export/bulk")
+    async def export_bulk(req: BulkExportReq):
+        """ZIP con el .docx (y opcionalmente el .json) de cada caso, más manifest.json con errores y docs/s."""
+        statuses = [s.strip() for s in (req.status or "").split(",") if s.strip()] or None
+        template = _template_or_400(req.template)
+        cap = max(1, min(req.limit, BULK_EXPORT_MAX))
+        ids = await _db(db_path, _bulk_case_ids, req.case_ids, statuses,
+                        _date_bound(req.updated_from, end=False), _date_bound(req.updated_to, end=True), cap)
+        if not ids:
+            raise HTTPException(status_code=404, detail="Ningún caso coincide con el filtro")
+
+        window = max(1, PROCESS_WORKERS) * 2  # casos en vuelo
+        stats = {"rendered": 0}
+
+        async def one(case_id: str):
+            try:
+                return case_id, await _bulk_render(case_id, req.include_json, template, stats), None
+            except HTTPException as e:
+                return case_id, None, str(e.detail)
+            except Exception as e:
+                return case_id, None, f"{type(e).__name__}: {e}"
+
+        async def body():
+            zs = ZipStream()
+            t0 = time.perf_counter()
+            errors: List[Dict[str, str]] = []
+            docs = 0
+            # Las tareas se crean al ritmo de la ventana, no todas de golpe (hasta BULK_EXPORT_MAX)
+            pending_ids = iter(ids)
+            in_flight: Set[asyncio.Task] = set()
+
+            def refill() -> None:
+                while len(in_flight) < window:
+                    case_id = next(pending_ids, None)
+                    if case_id is None:
+                        return
+                    in_flight.add(asyncio.create_task(one(case_id)))
+
+            try:
+                refill()
+                while in_flight:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    refill()  # se sigue renderizando mientras se comprime lo terminado
+                    for fut in done:
+                        case_id, paths, error = fut.result()
+                        if error:
+                            errors.append({"case_id": case_id, "error": error})
+                            continue
+                        docx_path, json_path = paths
+                        # El artefacto puede desaparecer entre el render y el ZIP (gc de EXPORT_DIR
+                        # desde otra petición): zipfile falla al abrirlo, antes de escribir la entrada.
+                        try:
+                            yield await run_blocking(zs.add_file, docx_path, f"tutela_{case_id}.docx")
+                        except OSError as e:
+                            errors.append({"case_id": case_id, "error": f"{type(e).__name__}: {e}"})
+                            continue
+                        docs += 1
+                        if json_path:
+                            try:
+                                yield await run_blocking(zs.add_file, json_path, f"tutela_{case_id}.json")
+                            except OSError as e:
+                                errors.append({"case_id": case_id, "error": f"json: {type(e).__name__}: {e}"})
+
+                secs = time.perf_counter() - t0
+                summary = {
+                    "requested": len(ids),
+                    "documents": docs,
+                    "rendered": stats["rendered"],
+                    "reused": max(0, docs - stats["rendered"]),
+                    "errors": errors,
+                    "seconds": round(secs, 3),
+                    "docs_per_second": round(docs / secs, 2) if secs > 0 else None,
+                    "process_workers": PROCESS_WORKERS,
+                }
+                bulk_last.clear()
+                bulk_last.update({k: v for k, v in summary.items() if k != "errors"}, errors=len(errors),
+                                 finished_at=_now())
+                manifest = json.dumps(summary, ensure_ascii=False, indent=2).encode("utf-8")
+                yield await run_blocking(zs.add_bytes, "manifest.json", manifest)
+                yield await run_blocking(zs.close)
+            finally:
+                for t in in_flight:
+                    t.cancel()  # cliente desconectado: no seguir renderizando
+
+        filename = f"tutelas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        return StreamingResponse(body(), media_type="application/zip",
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
     return router
@@ -0,0 +1,55 @@
+# zip_stream.py
+# ZIP escrito por partes para respuestas en streaming (StreamingResponse).
+# - zipfile sobre un sumidero no "seekable": usa descriptores de datos y nunca retrocede,
+#   así cada entrada se puede enviar apenas se escribe.
+# - Cada add_*() devuelve los bytes producidos desde la llamada anterior; close() devuelve el
+#   directorio central. En memoria vive, a lo sumo, una entrada (nunca el archivo completo).
+# - Los .docx ya vienen comprimidos: se guardan tal cual (ZIP_STORED); el resto se deflacta.
+
+from __future__ import annotations
+
+import io
+import zipfile
+from typing import List
+
+
+class _Sink(io.RawIOBase):
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+
+class ZipStream:
+    """Bloqueante (lee archivos y comprime): llamar vía run_blocking."""
+
+    STORED_EXTS = (".docx", ".zip", ".png", ".jpg", ".jpeg", ".pdf")
+
+    def __init__(self):
+        self._sink = _Sink()
+        self._zip = zipfile.ZipFile(self._sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+
+    def _compression(self, arcname: str) -> int:
+        return zipfile.ZIP_STORED if arcname.lower().endswith(self.STORED_EXTS) else zipfile.ZIP_DEFLATED
+
+    def add_file(self, path: str, arcname: str) -> bytes:
+        self._zip.write(path, arcname=arcname, compress_type=self._compression(arcname))
+        return self._sink.drain()
+
+    def add_bytes(self, arcname: str, data: bytes) -> bytes:
+        self._zip.writestr(arcname, data, compress_type=self._compression(arcname))
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._sink.drain()